@@ -16,8 +16,38 @@
 
 set -e
 
+USE_OVERLAY=
+JOBS=$(getconf _NPROCESSORS_ONLN 2>/dev/null || echo 1)
+while [ $# -gt 0 ]; do
+    case "$1" in
+    --overlay)
+        # Provide the lowercase names in a VFS overlay for Clang and LLD,
+        # instead of adding lowercase symlinks. Other native tools can't
+        # find the lowercase names then.
+        USE_OVERLAY=1
+        shift
+        ;;
+    --symlinks)
+        # The default.
+        USE_OVERLAY=
+        shift
+        ;;
+    -j)
+        JOBS=$2
+        shift 2
+        ;;
+    -j*)
+        JOBS=${1#-j}
+        shift
+        ;;
+    *)
+        break
+        ;;
+    esac
+done
+
 if [ $# -lt 1 ]; then
-    echo "$0 {vc.zip sdk.zip target|target}"
+    echo "$0 [--overlay] [-j jobs] {vc.zip sdk.zip target|target}"
     exit 0
 fi
 
@@ -36,10 +66,30 @@ DEST=$(pwd)
 
 ln_s() {
     if [ ! -e "$2" ]; then
+        # Replace a dangling link, e.g. to an MSVC version that was removed.
+        rm -f "$2"
         ln -s "$1" "$2"
     fi
 }
 
+# Stamps for the stages below that are done, and the overlay files written
+# by them.
+STAMPS="$DEST/.install-stamps"
+mkdir -p "$STAMPS"
+
+# Provide lowercase names for headers and libraries to native tools, either
+# by adding lowercase symlinks, or with a VFS overlay for Clang and LLD.
+OVERLAY="$DEST/vfsoverlay.yaml"
+lowercase() {
+    if [ -n "$USE_OVERLAY" ]; then
+        # Each stage writes an overlay of its own, as they run in parallel;
+        # they are merged into one in the end.
+        "$ORIG"/lowercase -overlay "$STAMPS/$STAGE.yaml" "$@"
+    else
+        "$ORIG"/lowercase -symlink "$@"
+    fi
+}
+
 if [ -n "$VC_ZIP" ]; then
     unzip "$VC_ZIP"
 fi
@@ -48,13 +98,17 @@ ln_s VC vc
 ln_s Tools vc/tools
 ln_s MSVC vc/tools/msvc
 
+MSVCVERS=
 for i in $(ls -r vc/tools/msvc); do
     dir="vc/tools/msvc/$i"
-    # Iterate over versions, from highest to lowest, picking the first one
-    # that seem to be complete enough (having bin, include and lib directories).
+    # Iterate over versions, from highest to lowest, picking the ones that
+    # seem to be complete enough (having bin, include and lib directories).
+    # The first one is the default.
     if [ -d $dir/bin ] && [ -d $dir/include ] && [ -d $dir/lib ]; then
-        MSVCVER="$i"
-        break
+        if [ -z "$MSVCVER" ]; then
+            MSVCVER="$i"
+        fi
+        MSVCVERS="$MSVCVERS $i"
     fi
 done
 if [ -z "$MSVCVER" ]; then
@@ -62,61 +116,9 @@ if [ -z "$MSVCVER" ]; then
     exit 1
 fi
 echo Using MSVC version $MSVCVER
-
-# Add symlinks like LIBCMT.lib -> libcmt.lib. These are properly lowercased
-# out of the box, but MSVC produces directives like /DEFAULTLIB:"LIBCMT"
-# /DEFAULTLIB:"OLDNAMES", which lld-link doesn't find on a case sensitive
-# filesystem. Therefore add matching case symlinks for this, to allow
-# linking MSVC built objects with lld-link.
-cd "vc/tools/msvc/$MSVCVER/lib"
-for arch in x86 x64 arm arm64; do
-    if [ ! -d "$arch" ]; then
-        continue
-    fi
-    cd $arch
-    for i in libcmt libcmtd msvcrt msvcrtd oldnames; do
-        ln_s $i.lib $(echo $i | tr [a-z] [A-Z]).lib
-    done
-    cd ..
-done
-cd ..
-# Fix casing issues in the MSVC headers. These headers mostly have consistent
-# lowercase naming among themselves, but they do reference some WinSDK headers
-# with mixed case names (in a spelling that isn't present in the WinSDK).
-# Thus process them to reference the other headers with lowercase names.
-# Also lowercase these files, as a few of them do have non-lowercase names,
-# and the call to fixinclude lowercases those references.
-"$ORIG"/lowercase -symlink include
-"$ORIG"/fixinclude include
-if [ -d "atlmfc/include" ]; then
-    # The ATL headers are lowercased themselves, but they refer to
-    # WinSDK headers with mixed casing.
-    "$ORIG"/fixinclude "atlmfc/include"
-fi
-cd bin
-# vctip.exe is known to cause problems at some times; just remove it.
-# See https://bugs.chromium.org/p/chromium/issues/detail?id=735226 and
-# https://github.com/mstorsjo/msvc-wine/issues/23 for references.
-for i in $(find . -iname vctip.exe); do
-    rm $i
-done
-if [ -d HostX64 ]; then
-    # 15.x - 16.4
-    mv HostX64 Hostx64
-fi
-if [ -d HostARM64 ]; then
-    # 17.2 - 17.3
-    mv HostARM64 Hostarm64
-fi
-if [ -d HostArm64 ]; then
-    # 17.4
-    mv HostArm64 Hostarm64
+if [ "$MSVCVERS" != " $MSVCVER" ]; then
+    echo Also installing MSVC versions${MSVCVERS# $MSVCVER}
 fi
-if [ -d Hostarm64/ARM64 ]; then
-    # 17.2 - 17.3
-    mv Hostarm64/ARM64 Hostarm64/arm64
-fi
-cd "$DEST"
 
 if [ -d kits/10 ]; then
     cd kits/10
@@ -133,6 +135,135 @@ cd ../..
 SDKVER=$(basename $(echo kits/10/include/10.* | awk '{print $NF}'))
 echo Using SDK version $SDKVER
 
+# A stage is redone if the versions, the way of lowercasing, the tools
+# processing the files or the listing of its directory (names, sizes and
+# modification times) differ from when it last was done. The modification
+# times need subsecond resolution, as ls -l only shows them to the minute;
+# GNU find can print them, otherwise (e.g. on macOS) stat is used.
+TOOLS=$(cat "$ORIG/lowercase" "$ORIG/fixinclude" | cksum)
+if find . -maxdepth 0 -printf '' 2>/dev/null; then
+    list_files() {
+        find "$1" -printf '%p %s %T@\n'
+    }
+else
+    list_files() {
+        find "$1" -exec stat -f '%N %z %Fm' {} +
+    }
+fi
+fingerprint() {
+    {
+        echo "$MSVCVER $SDKVER $USE_OVERLAY $TOOLS"
+        list_files "$1" | LC_ALL=C sort
+    } | cksum
+}
+
+run_stage() {
+    STAGE=$1
+    dir=$2
+    shift 2
+    if [ -f "$STAMPS/$STAGE" ] && [ "$(cat "$STAMPS/$STAGE")" = "$(fingerprint "$dir")" ]; then
+        return 0
+    fi
+    rm -f "$STAMPS/$STAGE" "$STAMPS/$STAGE.yaml"
+    ( "$@" )
+    fingerprint "$dir" > "$STAMPS/$STAGE"
+}
+
+# Run up to $JOBS stages at a time, with one token in the fifo for each
+# free job slot.
+mkfifo "$STAMPS/jobs.$$"
+exec 9<>"$STAMPS/jobs.$$"
+rm "$STAMPS/jobs.$$"
+i=0
+while [ $i -lt $JOBS ]; do
+    echo >&9
+    i=$((i+1))
+done
+
+STAGES=
+# stage <name> <dir> <command...>: Run a command that processes dir, unless
+# this already is done.
+stage() {
+    read token <&9
+    STAGES="$STAGES $1"
+    (
+        trap 'echo >&9' EXIT
+        run_stage "$@"
+    ) &
+}
+
+# Add symlinks like LIBCMT.lib -> libcmt.lib. These are properly lowercased
+# out of the box, but MSVC produces directives like /DEFAULTLIB:"LIBCMT"
+# /DEFAULTLIB:"OLDNAMES", which lld-link doesn't find on a case sensitive
+# filesystem. Therefore add matching case symlinks for this, to allow
+# linking MSVC built objects with lld-link.
+msvc_lib() {
+    cd "$1"
+    for arch in x86 x64 arm arm64; do
+        if [ ! -d "$arch" ]; then
+            continue
+        fi
+        for i in libcmt libcmtd msvcrt msvcrtd oldnames; do
+            ln_s $i.lib $arch/$(echo $i | tr [a-z] [A-Z]).lib
+        done
+    done
+}
+
+# Fix casing issues in the MSVC headers. These headers mostly have consistent
+# lowercase naming among themselves, but they do reference some WinSDK headers
+# with mixed case names (in a spelling that isn't present in the WinSDK).
+# Thus process them to reference the other headers with lowercase names.
+# Also lowercase these files, as a few of them do have non-lowercase names,
+# and the call to fixinclude lowercases those references.
+msvc_include() {
+    cd "$1"
+    lowercase include
+    "$ORIG"/fixinclude include
+}
+
+msvc_bin() {
+    cd "$1"
+    # vctip.exe is known to cause problems at some times; just remove it.
+    # See https://bugs.chromium.org/p/chromium/issues/detail?id=735226 and
+    # https://github.com/mstorsjo/msvc-wine/issues/23 for references.
+    for i in $(find . -iname vctip.exe); do
+        rm $i
+    done
+    if [ -d HostX64 ]; then
+        # 15.x - 16.4
+        mv HostX64 Hostx64
+    fi
+    if [ -d HostARM64 ]; then
+        # 17.2 - 17.3
+        mv HostARM64 Hostarm64
+    fi
+    if [ -d HostArm64 ]; then
+        # 17.4
+        mv HostArm64 Hostarm64
+    fi
+    if [ -d Hostarm64/ARM64 ]; then
+        # 17.2 - 17.3
+        mv Hostarm64/ARM64 Hostarm64/arm64
+    fi
+}
+
+winsdk_include() {
+    lowercase -map_winsdk "$1"
+    "$ORIG"/fixinclude -map_winsdk "$1"
+}
+
+for ver in $MSVCVERS; do
+    dir="vc/tools/msvc/$ver"
+    stage msvc-lib-$ver "$dir/lib" msvc_lib "$dir/lib"
+    stage msvc-include-$ver "$dir/include" msvc_include "$dir"
+    if [ -d "$dir/atlmfc/include" ]; then
+        # The ATL headers are lowercased themselves, but they refer to
+        # WinSDK headers with mixed casing.
+        stage atlmfc-include-$ver "$dir/atlmfc/include" "$ORIG"/fixinclude "$dir/atlmfc/include"
+    fi
+    stage msvc-bin-$ver "$dir/bin" msvc_bin "$dir/bin"
+done
+
 # Lowercase the SDK headers and libraries. As long as cl.exe is executed
 # within wine, this is mostly not necessary.
 #
@@ -146,23 +277,22 @@ echo Using SDK version $SDKVER
 # included with a different mix of upper/lower case than what they have
 # on disk).
 #
-# The original casing of file names is preserved though, by adding lowercase
-# symlinks instead of doing a plain rename, so files can be referred to with
-# either the out of the box filename or with the lowercase name.
+# The original casing of file names is preserved though, by providing the
+# lowercase names as lowercase symlinks (or in a VFS overlay) instead of doing
+# a plain rename, so files can be referred to with either the out of the box
+# filename or with the lowercase name.
 for incdir in um shared winrt km; do
     SDK_INCDIR="kits/10/include/$SDKVER/$incdir"
 
     if [ -d "$SDK_INCDIR" ]; then
-        "$ORIG"/lowercase -map_winsdk -symlink "$SDK_INCDIR"
-        "$ORIG"/fixinclude -map_winsdk "$SDK_INCDIR"
+        stage sdk-include-$incdir "$SDK_INCDIR" winsdk_include "$SDK_INCDIR"
     fi
 done
 
 # The WDF is a part of the Windows Driver Kit.
 WDF_INCDIR="kits/10/include/wdf"
 if [ -d "$WDF_INCDIR" ]; then
-    "$ORIG"/lowercase -map_winsdk -symlink "$WDF_INCDIR"
-    "$ORIG"/fixinclude -map_winsdk "$WDF_INCDIR"
+    stage wdf-include "$WDF_INCDIR" winsdk_include "$WDF_INCDIR"
 fi
 
 for arch in x86 x64 arm arm64; do
@@ -170,12 +300,45 @@ for arch in x86 x64 arm arm64; do
     DDK_LIBDIR="kits/10/lib/$SDKVER/km/$arch"
 
     if [ -d "$SDK_LIBDIR" ]; then
-        "$ORIG"/lowercase -symlink "$SDK_LIBDIR"
+        stage sdk-lib-um-$arch "$SDK_LIBDIR" lowercase "$SDK_LIBDIR"
     fi
     if [ -d "$DDK_LIBDIR" ]; then
-        "$ORIG"/lowercase -symlink "$DDK_LIBDIR"
+        stage sdk-lib-km-$arch "$DDK_LIBDIR" lowercase "$DDK_LIBDIR"
+    fi
+done
+
+wait
+exec 9>&-
+for i in $STAGES; do
+    if [ ! -f "$STAMPS/$i" ]; then
+        echo Failed: $i
+        exit 1
     fi
 done
+# Forget the stages that aren't done anymore, e.g. for MSVC versions that
+# have been removed by an incremental vsdownload.py.
+for i in "$STAMPS"/*; do
+    case " $STAGES msvctricks " in
+    *" $(basename "$i" .yaml) "*)
+        ;;
+    *)
+        rm -f "$i"
+        ;;
+    esac
+done
+
+rm -f "$OVERLAY"
+if [ -n "$USE_OVERLAY" ]; then
+    overlays=
+    for i in $STAGES; do
+        if [ -f "$STAMPS/$i.yaml" ]; then
+            overlays="$overlays $STAMPS/$i.yaml"
+        fi
+    done
+    if [ -n "$overlays" ]; then
+        "$ORIG"/lowercase -overlay "$OVERLAY" -merge $overlays
+    fi
+fi
 
 host=x64
 # .NET-based tools use different host arch directories
@@ -190,34 +353,86 @@ if [ -d "VC/Tools/MSVC/$MSVCVER/modules" ]; then
     ln_s VC/Tools/MSVC/$MSVCVER/modules modules
 fi
 
-cat "$ORIG"/wrappers/msvcenv.sh \
-| sed 's/MSVCVER=.*/MSVCVER='$MSVCVER/ \
-| sed 's/SDKVER=.*/SDKVER='$SDKVER/ \
-| sed s/x64/$host/ \
-| sed s/amd64/$dotnet_host/ \
-> msvcenv.sh
+# Remove the wrappers for architectures and MSVC versions that no longer
+# are installed.
+for dir in bin/*/; do
+    name=$(basename "$dir")
+    case "$name" in
+    x86|x64|arm|arm64)
+        if [ ! -f "vc/tools/msvc/$MSVCVER/bin/Host$host/$name/cl.exe" ]; then
+            rm -rf "bin/$name"
+        fi
+        ;;
+    [0-9]*)
+        case "$MSVCVERS " in
+        " $MSVCVER ")
+            rm -rf "bin/$name"
+            ;;
+        *" $name "*)
+            ;;
+        *)
+            rm -rf "bin/$name"
+            ;;
+        esac
+        ;;
+    esac
+done
 
-for arch in x86 x64 arm arm64; do
-    if [ ! -f "vc/tools/msvc/$MSVCVER/bin/Host$host/$arch/cl.exe" ]; then
-        continue
+# Add the wrappers for each architecture in bin/<arch>, for the default
+# MSVC version. If there are multiple versions, the wrappers for each of
+# them also are added in bin/<msvcver>/<arch>.
+for ver in $MSVCVERS; do
+    bindirs=
+    if [ "$ver" = "$MSVCVER" ]; then
+        bindirs=bin
     fi
-    mkdir -p bin/$arch
-    cp -a "$ORIG"/wrappers/* bin/$arch
-    cat msvcenv.sh | sed 's/ARCH=.*/ARCH='$arch/ > bin/$arch/msvcenv.sh
+    if [ "$MSVCVERS" != " $MSVCVER" ]; then
+        bindirs="$bindirs bin/$ver"
+    fi
+
+    cat "$ORIG"/wrappers/msvcenv.sh \
+    | sed 's/MSVCVER=.*/MSVCVER='$ver/ \
+    | sed 's/SDKVER=.*/SDKVER='$SDKVER/ \
+    | sed s/x64/$host/ \
+    | sed s/amd64/$dotnet_host/ \
+    > msvcenv.sh
+
+    for arch in x86 x64 arm arm64; do
+        if [ ! -f "vc/tools/msvc/$ver/bin/Host$host/$arch/cl.exe" ]; then
+            continue
+        fi
+        for dir in $bindirs; do
+            mkdir -p $dir/$arch
+            cp -a "$ORIG"/wrappers/* $dir/$arch
+            cat msvcenv.sh | sed 's/ARCH=.*/ARCH='$arch/ > $dir/$arch/msvcenv.sh
+        done
+    done
+    rm msvcenv.sh
 done
-rm msvcenv.sh
 
-if [ -d "$DEST/bin/$host" ]; then
+# The msvctricks build only is redone if its source or the toolchain changes.
+MSVCTRICKS="$MSVCVER $SDKVER $(cat "$ORIG/msvctricks.cpp" | cksum)"
+if [ -f bin/msvctricks.exe ] && [ "$(cat "$STAMPS/msvctricks" 2>/dev/null)" = "$MSVCTRICKS" ]; then
+    :
+elif [ -d "$DEST/bin/$host" ]; then
     if WINE="$(command -v wine64 || command -v wine)"; then
-        WINEDEBUG=-all "${WINE}" wineboot &>/dev/null
+        WINEDEBUG=-all "${WINE}" wineboot >/dev/null 2>&1
         echo "Build msvctricks ..."
-        "$DEST/bin/$host/cl" /EHsc /O2 "$ORIG/msvctricks.cpp"
-        if [ $? -eq 0 ]; then
+        if "$DEST/bin/$host/cl" /EHsc /O2 "$ORIG/msvctricks.cpp"; then
             mv msvctricks.exe bin/
             rm msvctricks.obj
+            echo "$MSVCTRICKS" > "$STAMPS/msvctricks"
             echo "Build msvctricks done."
         else
             echo "Build msvctricks failed."
         fi
     fi
 fi
+if [ -f bin/msvctricks.exe ]; then
+    for ver in $MSVCVERS; do
+        if [ -d bin/$ver ]; then
+            # The wrappers look for msvctricks.exe in their parent directory.
+            ln_s ../msvctricks.exe bin/$ver/msvctricks.exe
+        fi
+    done
+fi
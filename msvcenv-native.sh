@@ -25,6 +25,9 @@
 # without needing to configure paths manually anywhere.
 # (If linking by invoking clang or clang-cl, instead of directly calling
 # lld-link, it's recommended to use -fuse-ld=lld.)
+# If the installation provides lowercase names for headers and libraries
+# with a VFS overlay, the overlay is passed to clang-cl and lld-link via the
+# _CL_ and _LINK_ variables; for clang, add -vfsoverlay "$VFSOVERLAY".
 
 if [ -z "$BIN" ]; then
     echo Set BIN to point to the directory before launching
@@ -36,6 +39,20 @@ else
         export INCLUDE="$(bash -c ". $ENV && /usr/bin/env echo \"\$INCLUDE\"" | sed s/z://g | sed 's/\\/\//g')"
         export LIB="$(bash -c ". $ENV && /usr/bin/env echo \"\$LIB\"" | sed s/z://g | sed 's/\\/\//g')"
         MSVCARCH="$(bash -c ". $ENV && /usr/bin/env echo \"\$ARCH\"")"
+        VFSOVERLAY="$(bash -c ". $ENV && /usr/bin/env echo \"\$BASE_UNIX\"")/vfsoverlay.yaml"
+        if [ -f "$VFSOVERLAY" ]; then
+            export VFSOVERLAY
+            case "$_CL_" in
+            *"-vfsoverlay \"$VFSOVERLAY\""*) ;;
+            *) export _CL_="$_CL_ -vfsoverlay \"$VFSOVERLAY\"" ;;
+            esac
+            case "$_LINK_" in
+            *"/vfsoverlay:\"$VFSOVERLAY\""*) ;;
+            *) export _LINK_="$_LINK_ /vfsoverlay:\"$VFSOVERLAY\"" ;;
+            esac
+        else
+            unset VFSOVERLAY
+        fi
         case $MSVCARCH in
         x86) TARGET_ARCH=i686 ;;
         x64) TARGET_ARCH=x86_64 ;;
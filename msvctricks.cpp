@@ -16,6 +16,13 @@
 
 #include <windows.h>
 #include <shlwapi.h>
+#include <stdio.h>
+#include <string.h>
+#include <wchar.h>
+
+#include <map>
+#include <string>
+#include <vector>
 
 
 #pragma comment(lib, "shell32.lib")
@@ -29,19 +36,338 @@ static HANDLE hStdOut = INVALID_HANDLE_VALUE;
 static HANDLE hStdErr = INVALID_HANDLE_VALUE;
 static HANDLE hChildJob;
 
-static DWORD run(LPWSTR lpCmdLine)
+// In server mode, the handles of a request are only made inheritable while
+// creating its child process; otherwise concurrently spawned children would
+// keep the output pipes of other requests open.
+static bool bServer;
+static CRITICAL_SECTION csInherit;
+
+static HANDLE openFile(LPCWSTR lpFileName, DWORD dwDesiredAccess, DWORD dwCreationDisposition, BOOL bInheritHandle)
+{
+    SECURITY_ATTRIBUTES attr = {};
+    attr.nLength = sizeof(attr);
+    attr.bInheritHandle = bInheritHandle;
+
+    return CreateFileW(lpFileName, dwDesiredAccess,
+        FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+        &attr, dwCreationDisposition, FILE_ATTRIBUTE_NORMAL, nullptr);
+}
+
+static std::wstring fromUtf8(const std::string& str)
+{
+    int len = MultiByteToWideChar(CP_UTF8, 0, str.data(), (int) str.size(), nullptr, 0);
+    std::wstring wstr(len, L'\0');
+    MultiByteToWideChar(CP_UTF8, 0, str.data(), (int) str.size(), &wstr[0], len);
+    return wstr;
+}
+
+static std::string toUtf8(const std::wstring& wstr)
+{
+    int len = WideCharToMultiByte(CP_UTF8, 0, wstr.data(), (int) wstr.size(), nullptr, 0, nullptr, nullptr);
+    std::string str(len, '\0');
+    WideCharToMultiByte(CP_UTF8, 0, wstr.data(), (int) wstr.size(), &str[0], len, nullptr, nullptr);
+    return str;
+}
+
+// The output of the tools is translated to use Unix paths, with the rules
+// from WINE_MSVC_STDOUT_RULES and WINE_MSVC_STDERR_RULES (set by e.g. the cl
+// wrapper), separated by semicolons. They do the same as the sed expressions
+// that are used when msvctricks isn't available:
+//
+//   path:PREFIX  Lines starting with PREFIX: s/z:([\\/])/\1/i; s,\\,/,g
+//   line         #line directives:          s/z:([\\/])/\1/i; s,\\\\,/,g
+//   note         Diagnostics, "z:\file(1): error C1234: ":
+//                                           s/z:([\\/])/\1/ig; s,\\,/,g
+//
+// Carriage returns are always removed, like s/\r//.
+struct Rule
+{
+    enum Kind { PATH, LINE, NOTE } kind;
+    std::string prefix;
+};
+
+typedef std::vector<Rule> Rules;
+
+static Rules parseRules(const std::wstring& spec)
+{
+    Rules rules;
+    const std::string str = toUtf8(spec);
+    for (size_t pos = 0; pos < str.size(); )
+    {
+        size_t end = str.find(';', pos);
+        if (end == std::string::npos)
+            end = str.size();
+        const std::string rule = str.substr(pos, end - pos);
+        pos = end + 1;
+
+        if (rule.compare(0, 5, "path:") == 0)
+            rules.push_back({ Rule::PATH, rule.substr(5) });
+        else if (rule == "line")
+            rules.push_back({ Rule::LINE, std::string() });
+        else if (rule == "note")
+            rules.push_back({ Rule::NOTE, std::string() });
+    }
+    return rules;
+}
+
+static Rules getRules(LPCWSTR lpName)
+{
+    wchar_t buf[32768];
+    if (GetEnvironmentVariableW(lpName, buf, ARRAYSIZE(buf)))
+        return parseRules(buf);
+    return Rules();
+}
+
+// s/z:([\\/])/\1/i, for the first or all matches.
+static void removeDrive(std::string& line, bool all)
+{
+    for (size_t i = 0; i + 2 < line.size(); i++)
+    {
+        if ((line[i] == 'z' || line[i] == 'Z') && line[i + 1] == ':' &&
+            (line[i + 2] == '\\' || line[i + 2] == '/'))
+        {
+            line.erase(i, 2);
+            if (!all)
+                return;
+        }
+    }
+}
+
+static void replaceAll(std::string& line, const char* from, char to)
+{
+    const size_t len = strlen(from);
+    for (size_t i = 0; (i = line.find(from, i)) != std::string::npos; i++)
+        line.replace(i, len, 1, to);
+}
+
+static bool isBlank(const std::string& line, size_t i)
+{
+    return i < line.size() && (line[i] == ' ' || line[i] == '\t');
+}
+
+// ^[[:blank:]]*#[[:blank:]]*line[[:blank:]]
+static bool isLineDirective(const std::string& line)
+{
+    size_t i = 0;
+    while (isBlank(line, i))
+        i++;
+    if (i >= line.size() || line[i] != '#')
+        return false;
+    i++;
+    while (isBlank(line, i))
+        i++;
+    return line.compare(i, 4, "line") == 0 && isBlank(line, i + 4);
+}
+
+static bool matchDigits(const std::string& line, size_t& i, size_t count)
 {
+    size_t start = i;
+    while (i < line.size() && line[i] >= '0' && line[i] <= '9' && (count == 0 || i - start < count))
+        i++;
+    return count == 0 ? i > start : i - start == count;
+}
+
+// ^[zZ]:.*\([[:digit:]]+\): (note|error C[[:digit:]]{4}|warning C[[:digit:]]{4}):
+static bool isNote(const std::string& line)
+{
+    if (line.size() < 2 || (line[0] != 'z' && line[0] != 'Z') || line[1] != ':')
+        return false;
+
+    for (size_t pos = 2; (pos = line.find('(', pos)) != std::string::npos; pos++)
+    {
+        size_t i = pos + 1;
+        if (!matchDigits(line, i, 0) || line.compare(i, 3, "): ") != 0)
+            continue;
+        i += 3;
+
+        bool matched = false;
+        if (line.compare(i, 4, "note") == 0)
+        {
+            i += 4;
+            matched = true;
+        }
+        else if (line.compare(i, 7, "error C") == 0)
+        {
+            i += 7;
+            matched = matchDigits(line, i, 4);
+        }
+        else if (line.compare(i, 9, "warning C") == 0)
+        {
+            i += 9;
+            matched = matchDigits(line, i, 4);
+        }
+        if (matched && line.compare(i, 2, ": ") == 0)
+            return true;
+    }
+    return false;
+}
+
+static void translateLine(std::string& line, const Rules& rules)
+{
+    size_t cr = line.find('\r');
+    if (cr != std::string::npos)
+        line.erase(cr, 1);
+
+    for (const Rule& rule : rules)
+    {
+        switch (rule.kind)
+        {
+        case Rule::PATH:
+            if (line.compare(0, rule.prefix.size(), rule.prefix) == 0)
+            {
+                removeDrive(line, false);
+                replaceAll(line, "\\", '/');
+            }
+            break;
+        case Rule::LINE:
+            if (isLineDirective(line))
+            {
+                removeDrive(line, false);
+                replaceAll(line, "\\\\", '/');
+            }
+            break;
+        case Rule::NOTE:
+            if (isNote(line))
+            {
+                removeDrive(line, true);
+                replaceAll(line, "\\", '/');
+            }
+            break;
+        }
+    }
+}
+
+// An output stream of the tool, which goes through a pipe that is read and
+// translated by a thread of our own, before being written to hTarget.
+struct Output
+{
+    HANDLE hTarget;
+    Rules rules;
+    HANDLE hRead;
+    HANDLE hWrite;
+    HANDLE hThread;
+};
+
+static void writeAll(HANDLE hFile, const std::string& data)
+{
+    DWORD dwWritten;
+    for (size_t pos = 0; pos < data.size(); pos += dwWritten)
+    {
+        if (!WriteFile(hFile, data.data() + pos, (DWORD) (data.size() - pos), &dwWritten, nullptr))
+            return;
+    }
+}
+
+static DWORD WINAPI pump(LPVOID lpParameter)
+{
+    Output* out = static_cast<Output*>(lpParameter);
+    std::string pending, translated, line;
+    char buf[65536];
+    DWORD dwRead;
+    while (ReadFile(out->hRead, buf, sizeof(buf), &dwRead, nullptr) && dwRead > 0)
+    {
+        pending.append(buf, dwRead);
+
+        translated.clear();
+        size_t pos = 0;
+        for (size_t end; (end = pending.find('\n', pos)) != std::string::npos; pos = end + 1)
+        {
+            line.assign(pending, pos, end - pos);
+            translateLine(line, out->rules);
+            translated += line;
+            translated += '\n';
+        }
+        pending.erase(0, pos);
+
+        writeAll(out->hTarget, translated);
+    }
+    if (!pending.empty())
+    {
+        translateLine(pending, out->rules);
+        writeAll(out->hTarget, pending);
+    }
+    CloseHandle(out->hRead);
+    return 0;
+}
+
+static bool startOutput(Output& out)
+{
+    SECURITY_ATTRIBUTES attr = {};
+    attr.nLength = sizeof(attr);
+    attr.bInheritHandle = !bServer;
+
+    if (!CreatePipe(&out.hRead, &out.hWrite, &attr, 0))
+        return false;
+    SetHandleInformation(out.hRead, HANDLE_FLAG_INHERIT, 0);
+
+    out.hThread = CreateThread(nullptr, 0, pump, &out, 0, nullptr);
+    if (!out.hThread)
+    {
+        CloseHandle(out.hRead);
+        CloseHandle(out.hWrite);
+        return false;
+    }
+    return true;
+}
+
+static void finishOutput(Output& out)
+{
+    WaitForSingleObject(out.hThread, INFINITE);
+    CloseHandle(out.hThread);
+}
+
+static void setInherit(HANDLE hIn, HANDLE hOut, HANDLE hErr, DWORD dwFlags)
+{
+    SetHandleInformation(hIn,  HANDLE_FLAG_INHERIT, dwFlags);
+    SetHandleInformation(hOut, HANDLE_FLAG_INHERIT, dwFlags);
+    SetHandleInformation(hErr, HANDLE_FLAG_INHERIT, dwFlags);
+}
+
+static DWORD run(LPWSTR lpCmdLine, HANDLE hIn, Output& out, Output& err,
+                 LPWSTR lpEnvironment = nullptr, LPCWSTR lpCurrentDirectory = nullptr)
+{
+    if (!startOutput(out))
+        return GetLastError();
+    if (!startOutput(err))
+    {
+        DWORD dwError = GetLastError();
+        CloseHandle(out.hWrite);
+        finishOutput(out);
+        return dwError;
+    }
+
     STARTUPINFOW si = {};
     si.cb = sizeof(si);
     si.dwFlags = STARTF_USESTDHANDLES;
-    si.hStdInput = hStdIn;
-    si.hStdOutput = hStdOut;
-    si.hStdError = hStdErr;
+    si.hStdInput = hIn;
+    si.hStdOutput = out.hWrite;
+    si.hStdError = err.hWrite;
 
     PROCESS_INFORMATION pi = {};
 
-    DWORD dwExitCode;
-    if (CreateProcessW(nullptr, lpCmdLine, nullptr, nullptr, TRUE, 0, nullptr, nullptr, &si, &pi))
+    if (bServer)
+    {
+        EnterCriticalSection(&csInherit);
+        setInherit(hIn, out.hWrite, err.hWrite, HANDLE_FLAG_INHERIT);
+    }
+
+    BOOL bCreated = CreateProcessW(nullptr, lpCmdLine, nullptr, nullptr, TRUE,
+        lpEnvironment ? CREATE_UNICODE_ENVIRONMENT : 0,
+        lpEnvironment, lpCurrentDirectory, &si, &pi);
+    DWORD dwExitCode = GetLastError();
+
+    if (bServer)
+    {
+        setInherit(hIn, out.hWrite, err.hWrite, 0);
+        LeaveCriticalSection(&csInherit);
+    }
+
+    // Only the tool has the pipes open for writing now, so the output ends
+    // when it exits.
+    CloseHandle(out.hWrite);
+    CloseHandle(err.hWrite);
+
+    if (bCreated)
     {
         if (hChildJob)
         {
@@ -58,23 +384,276 @@ static DWORD run(LPWSTR lpCmdLine)
         CloseHandle(pi.hProcess);
         CloseHandle(pi.hThread);
     }
-    else
-    {
-        dwExitCode = GetLastError();
-    }
+
+    finishOutput(out);
+    finishOutput(err);
 
     return dwExitCode;
 }
 
-static DWORD mt(LPWSTR lpCmdLine)
+static DWORD mt(LPWSTR lpCmdLine, HANDLE hIn, Output& out, Output& err,
+                LPWSTR lpEnvironment = nullptr, LPCWSTR lpCurrentDirectory = nullptr)
 {
-    DWORD dwExitCode = run(lpCmdLine);
+    DWORD dwExitCode = run(lpCmdLine, hIn, out, err, lpEnvironment, lpCurrentDirectory);
     // https://gitlab.kitware.com/cmake/cmake/-/blob/v3.26.0/Source/cmcmd.cxx#L2405
     if (dwExitCode == 0x41020001)
         dwExitCode = 0xbb;
     return dwExitCode;
 }
 
+// Quote an argument so that CommandLineToArgvW gives it back as is.
+static void appendArg(std::wstring& cmdLine, const std::wstring& arg)
+{
+    if (!cmdLine.empty())
+        cmdLine += L' ';
+
+    if (!arg.empty() && arg.find_first_of(L" \t\n\v\"") == std::wstring::npos)
+    {
+        cmdLine += arg;
+        return;
+    }
+
+    cmdLine += L'"';
+    for (size_t i = 0; ; ++i)
+    {
+        size_t backslashes = 0;
+        while (i < arg.size() && arg[i] == L'\\')
+        {
+            ++i;
+            ++backslashes;
+        }
+
+        if (i == arg.size())
+        {
+            cmdLine.append(backslashes * 2, L'\\');
+            break;
+        }
+        else if (arg[i] == L'"')
+        {
+            cmdLine.append(backslashes * 2 + 1, L'\\');
+        }
+        else
+        {
+            cmdLine.append(backslashes, L'\\');
+        }
+        cmdLine += arg[i];
+    }
+    cmdLine += L'"';
+}
+
+struct LessNoCase
+{
+    bool operator()(const std::wstring& a, const std::wstring& b) const
+    {
+        return _wcsicmp(a.c_str(), b.c_str()) < 0;
+    }
+};
+
+typedef std::map<std::wstring, std::wstring, LessNoCase> Environment;
+
+static void addVariable(Environment& env, const std::wstring& var)
+{
+    // Names like "=Z:" start with an equals sign.
+    size_t pos = var.find(L'=', 1);
+    if (pos != std::wstring::npos)
+        env[var.substr(0, pos)] = var.substr(pos + 1);
+}
+
+// The environment of a request is the one of the Unix client process, which
+// Wine would have translated when starting a new process. Keep the variables
+// that Wine sets up from the server environment, and build PATH from the
+// WINEPATH of the client.
+static std::wstring buildEnvironment(const std::vector<std::wstring>& vars, Environment& client)
+{
+    static const wchar_t* const ignored[] = {
+        L"PATH", L"TEMP", L"TMP", L"HOME", L"PWD", L"OLDPWD", L"SHLVL", L"_",
+    };
+
+    Environment env;
+
+    LPWCH lpEnv = GetEnvironmentStringsW();
+    for (LPWCH p = lpEnv; *p; p += wcslen(p) + 1)
+        addVariable(env, p);
+    FreeEnvironmentStringsW(lpEnv);
+
+    const std::wstring path = env[L"PATH"];
+
+    for (const std::wstring& var : vars)
+        addVariable(client, var);
+
+    for (const auto& var : client)
+    {
+        bool skip = false;
+        for (const wchar_t* name : ignored)
+            skip = skip || _wcsicmp(var.first.c_str(), name) == 0;
+        if (skip)
+            continue;
+
+        if (_wcsicmp(var.first.c_str(), L"WINEPATH") == 0)
+            env[L"PATH"] = var.second + L";" + path;
+
+        env[var.first] = var.second;
+    }
+
+    std::wstring block;
+    for (const auto& var : env)
+    {
+        block += var.first + L"=" + var.second;
+        block += L'\0';
+    }
+    block += L'\0';
+    return block;
+}
+
+// A request is a directory with the fifos stdout, stderr and status, and
+// a file named request, with the null separated fields cwd, argc, argv and
+// the environment variables.
+static DWORD serve(const std::wstring& dir)
+{
+    HANDLE hOut = openFile((dir + L"/stdout").c_str(), GENERIC_WRITE, CREATE_ALWAYS, FALSE);
+    HANDLE hErr = openFile((dir + L"/stderr").c_str(), GENERIC_WRITE, CREATE_ALWAYS, FALSE);
+
+    std::string data;
+    HANDLE hFile = openFile((dir + L"/request").c_str(), GENERIC_READ, OPEN_EXISTING, FALSE);
+    if (hFile != INVALID_HANDLE_VALUE)
+    {
+        char buf[65536];
+        DWORD dwRead;
+        while (ReadFile(hFile, buf, sizeof(buf), &dwRead, nullptr) && dwRead > 0)
+            data.append(buf, dwRead);
+        CloseHandle(hFile);
+    }
+
+    std::vector<std::wstring> fields;
+    const std::wstring request = fromUtf8(data);
+    for (size_t pos = 0, end; (end = request.find(L'\0', pos)) != std::wstring::npos; pos = end + 1)
+        fields.push_back(request.substr(pos, end - pos));
+
+    DWORD dwExitCode = ERROR_BAD_FORMAT;
+    size_t argc = fields.size() >= 2 ? wcstoul(fields[1].c_str(), nullptr, 10) : 0;
+    if (argc > 0 && argc <= fields.size() - 2)
+    {
+        std::wstring cmdLine;
+        for (size_t i = 0; i < argc; i++)
+            appendArg(cmdLine, fields[2 + i]);
+
+        Environment client;
+        std::wstring env = buildEnvironment(
+            std::vector<std::wstring>(fields.begin() + 2 + argc, fields.end()), client);
+
+        const std::wstring& stdIn = client[L"WINE_MSVC_STDIN"];
+        HANDLE hIn = openFile(stdIn.empty() ? L"NUL" : stdIn.c_str(), GENERIC_READ, OPEN_EXISTING, FALSE);
+
+        Output out = { hOut, parseRules(client[L"WINE_MSVC_STDOUT_RULES"]) };
+        Output err = { hErr, parseRules(client[L"WINE_MSVC_STDERR_RULES"]) };
+
+        LPCWSTR const exe = PathFindFileNameW(fields[2].c_str());
+        if (PathMatchSpecW(exe, L"mt.exe"))
+            dwExitCode = mt(&cmdLine[0], hIn, out, err, &env[0], fields[0].c_str());
+        else
+            dwExitCode = run(&cmdLine[0], hIn, out, err, &env[0], fields[0].c_str());
+
+        if (hIn != INVALID_HANDLE_VALUE)
+            CloseHandle(hIn);
+    }
+
+    if (hOut != INVALID_HANDLE_VALUE)
+        CloseHandle(hOut);
+    if (hErr != INVALID_HANDLE_VALUE)
+        CloseHandle(hErr);
+
+    HANDLE hStatus = openFile((dir + L"/status").c_str(), GENERIC_WRITE, CREATE_ALWAYS, FALSE);
+    if (hStatus != INVALID_HANDLE_VALUE)
+    {
+        char buf[16];
+        DWORD dwWritten;
+        int len = snprintf(buf, sizeof(buf), "%lu\n", (unsigned long) dwExitCode);
+        WriteFile(hStatus, buf, len, &dwWritten, nullptr);
+        CloseHandle(hStatus);
+    }
+
+    return dwExitCode;
+}
+
+static DWORD WINAPI serveThread(LPVOID lpParameter)
+{
+    std::wstring* dir = static_cast<std::wstring*>(lpParameter);
+    DWORD dwExitCode = serve(*dir);
+    delete dir;
+    return dwExitCode;
+}
+
+// Serve requests, one per line with the path of the request directory, that
+// are written to the fifo named requests in the given directory, until
+// getting a line with "quit".
+static int server(LPCWSTR lpDir)
+{
+    bServer = true;
+    InitializeCriticalSection(&csInherit);
+
+    // Opening the fifo for writing too doesn't block until there is a client,
+    // and it doesn't reach the end of file when a client closes it.
+    std::wstring requests = std::wstring(lpDir) + L"/requests";
+    HANDLE hRequests = openFile(requests.c_str(), GENERIC_READ | GENERIC_WRITE, OPEN_EXISTING, FALSE);
+    if (hRequests == INVALID_HANDLE_VALUE)
+        return GetLastError();
+
+    std::vector<HANDLE> threads;
+    std::string line;
+    char buf[4096];
+    DWORD dwRead;
+    bool quit = false;
+    while (!quit && ReadFile(hRequests, buf, sizeof(buf), &dwRead, nullptr) && dwRead > 0)
+    {
+        for (DWORD i = 0; i < dwRead && !quit; i++)
+        {
+            if (buf[i] != '\n')
+            {
+                line += buf[i];
+                continue;
+            }
+
+            if (line == "quit")
+            {
+                quit = true;
+            }
+            else if (!line.empty())
+            {
+                HANDLE hThread = CreateThread(nullptr, 0, serveThread,
+                                              new std::wstring(fromUtf8(line)), 0, nullptr);
+                if (hThread)
+                    threads.push_back(hThread);
+            }
+            line.clear();
+        }
+
+        // Forget about the requests that are done.
+        for (size_t j = 0; j < threads.size(); )
+        {
+            if (WaitForSingleObject(threads[j], 0) == WAIT_OBJECT_0)
+            {
+                CloseHandle(threads[j]);
+                threads[j] = threads.back();
+                threads.pop_back();
+            }
+            else
+            {
+                j++;
+            }
+        }
+    }
+    CloseHandle(hRequests);
+
+    // Let the running requests finish.
+    for (HANDLE hThread : threads)
+    {
+        WaitForSingleObject(hThread, INFINITE);
+        CloseHandle(hThread);
+    }
+
+    return 0;
+}
+
 int WINAPI wWinMain(HINSTANCE hInstance, HINSTANCE hPrevInstance, LPWSTR lpCmdLine, int nCmdShow)
 {
     (void) hInstance;
@@ -85,36 +664,29 @@ int WINAPI wWinMain(HINSTANCE hInstance, HINSTANCE hPrevInstance, LPWSTR lpCmdLi
     wchar_t** argv = CommandLineToArgvW(lpCmdLine, &argc);
     if (argc <= 0) return 0;
 
+    if (hChildJob = CreateJobObjectW(nullptr, nullptr))
+    {
+        JOBOBJECT_EXTENDED_LIMIT_INFORMATION info = {};
+        info.BasicLimitInformation.LimitFlags = JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
+                                              | JOB_OBJECT_LIMIT_SILENT_BREAKAWAY_OK;
+        SetInformationJobObject(hChildJob, JobObjectExtendedLimitInformation, &info, sizeof(info));
+    }
+
+    if (argc == 2 && wcscmp(argv[0], L"--server") == 0)
+        return server(argv[1]);
+
     wchar_t buf[32768];
     if (GetEnvironmentVariableW(L"WINE_MSVC_STDIN", buf, ARRAYSIZE(buf)))
     {
-        SECURITY_ATTRIBUTES attr = {};
-        attr.nLength = sizeof(attr);
-        attr.bInheritHandle = TRUE;
-
-        hStdIn = CreateFileW(buf, GENERIC_READ,
-            FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
-            &attr, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, nullptr);
+        hStdIn = openFile(buf, GENERIC_READ, OPEN_EXISTING, TRUE);
     }
     if (GetEnvironmentVariableW(L"WINE_MSVC_STDOUT", buf, ARRAYSIZE(buf)))
     {
-        SECURITY_ATTRIBUTES attr = {};
-        attr.nLength = sizeof(attr);
-        attr.bInheritHandle = TRUE;
-
-        hStdOut = CreateFileW(buf, GENERIC_WRITE,
-            FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
-            &attr, CREATE_ALWAYS, FILE_ATTRIBUTE_NORMAL, nullptr);
+        hStdOut = openFile(buf, GENERIC_WRITE, CREATE_ALWAYS, FALSE);
     }
     if (GetEnvironmentVariableW(L"WINE_MSVC_STDERR", buf, ARRAYSIZE(buf)))
     {
-        SECURITY_ATTRIBUTES attr = {};
-        attr.nLength = sizeof(attr);
-        attr.bInheritHandle = TRUE;
-
-        hStdErr = CreateFileW(buf, GENERIC_WRITE,
-            FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
-            &attr, CREATE_ALWAYS, FILE_ATTRIBUTE_NORMAL, nullptr);
+        hStdErr = openFile(buf, GENERIC_WRITE, CREATE_ALWAYS, FALSE);
     }
 
     if (hStdIn == INVALID_HANDLE_VALUE)
@@ -130,18 +702,13 @@ int WINAPI wWinMain(HINSTANCE hInstance, HINSTANCE hPrevInstance, LPWSTR lpCmdLi
         hStdErr = GetStdHandle(STD_ERROR_HANDLE);
     }
 
-    if (hChildJob = CreateJobObjectW(nullptr, nullptr))
-    {
-        JOBOBJECT_EXTENDED_LIMIT_INFORMATION info = {};
-        info.BasicLimitInformation.LimitFlags = JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
-                                              | JOB_OBJECT_LIMIT_SILENT_BREAKAWAY_OK;
-        SetInformationJobObject(hChildJob, JobObjectExtendedLimitInformation, &info, sizeof(info));
-    }
-
     LPCWSTR const exe = PathFindFileNameW(argv[0]);
 
+    Output out = { hStdOut, getRules(L"WINE_MSVC_STDOUT_RULES") };
+    Output err = { hStdErr, getRules(L"WINE_MSVC_STDERR_RULES") };
+
     if (PathMatchSpecW(exe, L"mt.exe"))
-        return mt(lpCmdLine);
+        return mt(lpCmdLine, hStdIn, out, err);
 
-    return run(lpCmdLine);
+    return run(lpCmdLine, hStdIn, out, err);
 }
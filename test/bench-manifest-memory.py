@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+# Compare the memory used for the package index of vsdownload.py, between
+# the plain dicts of the parsed manifest and the compact Package records
+# built by parseManifest.
+#
+# Each model is loaded in a separate process, and its peak RSS, the RSS
+# it keeps after loading, and the time it took are reported, along with
+# those of a process that only reads the manifest. By default, a synthetic
+# manifest with a similar structure and field sizes as the real one is
+# generated; a real one (e.g. saved with "vsdownload.py --save-manifest")
+# can be given with --manifest.
+#
+# Usage: ./bench-manifest-memory.py [--packages 30000] [--manifest file] [--output results.json]
+
+import argparse
+import functools
+import gc
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+import vsdownload
+
+MODELS = ["none", "dict", "compact"]
+
+def getArgsParser():
+    parser = argparse.ArgumentParser(description = "Compare the memory use of the manifest package models of vsdownload.py")
+    parser.add_argument("--manifest", metavar="file", help="Installer manifest to load (defaults to a generated one)")
+    parser.add_argument("--packages", metavar="n", type=int, default=30000, help="Number of packages in the generated manifest (defaults to 30000)")
+    parser.add_argument("--seed", metavar="n", type=int, default=1, help="Seed for generating the manifest")
+    parser.add_argument("--output", metavar="file", help="Write the results as JSON to this file")
+    parser.add_argument("--model", choices=MODELS, help=argparse.SUPPRESS)
+    return parser
+
+def generate(args, file):
+    rng = random.Random(args.seed)
+    def text(n):
+        return " ".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for j in range(rng.randint(3, 10))) for i in range(n))
+    packages = []
+    for i in range(args.packages):
+        id = "Microsoft.VisualStudio.Bench.%s%d" % (rng.choice(["Package", "Tools", "Component", "Resources"]), i % (args.packages // 3 + 1))
+        p = {
+            "id": id,
+            "version": "18.0.%d.%d" % (rng.randint(0, 40000), rng.randint(0, 9)),
+            "type": rng.choice(["Vsix", "Vsix", "Msi", "Exe", "Component", "Workload", "Group"]),
+            "installSizes": { "targetDrive": rng.randint(0, 1 << 30) },
+            "localizedResources": [{ "language": "en-US", "title": text(4), "description": text(30) }],
+        }
+        if rng.random() < 0.3:
+            p["chip"] = rng.choice(["x86", "x64", "arm64"])
+        if rng.random() < 0.2:
+            p["language"] = rng.choice(["en-US", "de-DE", "ja-JP", "zh-CN"])
+        if rng.random() < 0.3:
+            p["installSizes"]["sharedDrive"] = rng.randint(0, 1 << 30)
+        if p["type"] not in ["Component", "Workload", "Group"]:
+            p["payloads"] = []
+            for j in range(rng.choice([1, 1, 1, 2, 5])):
+                name = "%s_%d.%s" % (id.split(".")[-1], j, "vsix" if p["type"] == "Vsix" else "msi")
+                p["payloads"].append({
+                    "fileName": name,
+                    "sha256": "%064x" % (rng.getrandbits(256)),
+                    "size": rng.randint(1000, 100000000),
+                    "url": "https://download.visualstudio.microsoft.com/download/pr/%08x-%04x/%064x/%s" % (rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(256), name),
+                })
+        dependencies = {}
+        for j in range(rng.choice([0, 0, 1, 2, 4, 8])):
+            dep = "Microsoft.VisualStudio.Bench.Package%d" % (rng.randrange(args.packages // 3 + 1))
+            if rng.random() < 0.2:
+                dependencies[dep] = { "version": "[18.0,19.0)", "type": rng.choice(["Optional", "Recommended"]) }
+            else:
+                dependencies[dep] = "[18.0,19.0)"
+        if dependencies:
+            p["dependencies"] = dependencies
+        packages.append(p)
+    with open(file, "w") as f:
+        json.dump({ "manifestVersion": "1.1", "info": { "productDisplayVersion": "18.0.0" }, "packages": packages }, f, indent=2)
+
+def getProcStatus(field):
+    # A field of /proc/self/status in bytes, where /proc is available.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def getPeakRss():
+    # ru_maxrss includes the RSS of the parent process at the time it was
+    # forked on Linux, so prefer the high water mark of this process.
+    peak = getProcStatus("VmHWM")
+    if peak != None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS, KiB elsewhere.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def load(model, file):
+    # Load the packages like vsdownload.py did before and after the compact
+    # model, grouped and sorted by id.
+    data = vsdownload.readFile(file)
+    start = time.perf_counter()
+    packages = None
+    if model == "dict":
+        packages = {}
+        for p in json.loads(data)["packages"]:
+            packages.setdefault(p["id"].lower(), []).append(p)
+        for key in packages:
+            packages[key] = sorted(packages[key], key=functools.cmp_to_key(functools.partial(vsdownload.prioritizePackage, "x64")))
+    elif model == "compact":
+        packages = vsdownload.getPackages(vsdownload.parseManifest(data)[1], "x64")
+    elapsed = time.perf_counter() - start
+    del data
+    gc.collect()
+    result = { "time": elapsed, "peakRss": getPeakRss(), "rss": getProcStatus("VmRSS") }
+    # Keep the packages alive until measured.
+    result["packages"] = sum(len(l) for l in packages.values()) if packages != None else 0
+    return result
+
+def formatMB(n):
+    return "%8.1f MB" % (n / (1024 * 1024)) if n != None else "%11s" % "-"
+
+if __name__ == "__main__":
+    args = getArgsParser().parse_args()
+
+    if args.model != None:
+        json.dump(load(args.model, args.manifest), sys.stdout)
+        sys.exit(0)
+
+    tempdir = None
+    manifest = args.manifest
+    if manifest == None:
+        tempdir = tempfile.mkdtemp(prefix="vsbench-")
+        manifest = os.path.join(tempdir, "installer.json")
+        print("Generating a manifest with %d packages" % (args.packages), flush=True)
+        generate(args, manifest)
+
+    try:
+        results = {}
+        for model in MODELS:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--model", model, "--manifest", manifest], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            results[model] = json.loads(out)
+    finally:
+        if tempdir != None:
+            os.remove(manifest)
+            os.rmdir(tempdir)
+
+    print("%d packages" % (results["dict"]["packages"]))
+    print("%-8s %11s %11s %10s" % ("Model", "Peak RSS", "RSS", "Time"))
+    for model in MODELS:
+        r = results[model]
+        print("%-8s %s %s %8.3f s" % (model, formatMB(r["peakRss"]), formatMB(r["rss"]), r["time"]))
+    if results["dict"]["rss"] != None and results["compact"]["rss"] != None:
+        base = results["none"]["rss"]
+        print("The compact model keeps %.1f%% of the memory of the dicts" % ((results["compact"]["rss"] - base) * 100 / max(results["dict"]["rss"] - base, 1)))
+
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2026 Huang Qinjin
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Measure the time of many trivial compiles, with the tools started as new
+# Wine processes, and with them spawned by the msvctricks server.
+#
+# Usage: BIN=/opt/msvc/bin/x64/ ./bench-msvctricks-server.sh [count]
+
+. "${0%/*}/test.sh"
+
+BIN=${BIN:-/opt/msvc/bin/x64/}
+COUNT=${1:-1000}
+
+export WINE_MSVC_SERVER=${CWD}server
+
+echo "int x;" > trivial.c
+
+bench() {
+    # Warm up Wine, so that only the per invocation cost is measured.
+    ${BIN}cl /nologo /c trivial.c >/dev/null || exit 1
+    local TIMEFORMAT=%R
+    { time for ((i = 0; i < $COUNT; i++)); do
+        ${BIN}cl /nologo /c trivial.c >/dev/null 2>&1 || exit 1
+    done; } 2>&1
+}
+
+report() {
+    awk -v name="$1" -v secs="$2" -v count=$COUNT \
+        'BEGIN { printf "%-16s %8.2f s %8.2f ms/call\n", name, secs, secs * 1000 / count }'
+}
+
+without=$(bench) || exit 1
+EXEC "" ${BIN}msvctricks-server start
+with=$(bench) || exit 1
+EXEC "" ${BIN}msvctricks-server stop
+
+echo "$COUNT x cl /c trivial.c"
+report "Without server:" $without
+report "With server:" $with
+awk -v a=$without -v b=$with 'BEGIN { printf "Speedup:         %8.2fx\n", a / b }'
+
+
+EXIT
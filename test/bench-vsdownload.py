@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+# Benchmark the download and install pipeline of vsdownload.py against a
+# synthetic installer manifest, served from a local stand-in for the CDN
+# (see localserver.py).
+#
+# The manifest has a tree of components (with a configurable fan-out and
+# depth) over a number of VSIX packages, some of them with variants for
+# multiple architectures and languages, and a package with MSI and CAB
+# sized stand-ins (which are downloaded but not extracted, as they aren't
+# real installers). The server can add latency to each request and limit
+# the total bandwidth.
+#
+# vsdownload.py is run through its command line, so any version of it can
+# be benchmarked with --vsdownload, e.g. one checked out from an earlier
+# commit. Each run downloads everything into a cold cache with
+# --only-download ("fetch"), then installs from the warm cache
+# ("install"); if that version of vsdownload.py has --timings, the time of
+# each of its phases is included too. The results are written as JSON with
+# --output. With --baseline, the medians are compared with an earlier
+# result file.
+#
+# With --throughput, the download alone is also timed with 1 and with
+# --jobs parallel downloads, both over the connections that vsdownload.py
+# keeps for reuse and over urllib, with a new connection for each file. To
+# make it use urllib, the server is set as its own HTTP proxy.
+#
+# With --extraction, the payloads in the warm cache are also unpacked with
+# --only-unpack, once serially with --unpack-jobs 1 and once with a pool of
+# --unpack-jobs processes, and the unpacked trees are checked to be
+# identical.
+#
+# Usage: ./bench-vsdownload.py [--packages 200] [--latency 20] [--bandwidth 50M] [--vsdownload path] [--output results.json]
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+import vsdownload
+import localserver
+
+MSVCVER = "99.0.12345"
+
+def getArgsParser():
+    parser = argparse.ArgumentParser(description = "Benchmark vsdownload.py with synthetic packages and a local server")
+    parser.add_argument("--packages", metavar="n", type=int, default=200, help="Number of VSIX packages (defaults to 200)")
+    parser.add_argument("--fanout", metavar="n", type=int, default=4, help="Number of child components of each component (defaults to 4)")
+    parser.add_argument("--depth", metavar="n", type=int, default=3, help="Depth of the component tree (defaults to 3)")
+    parser.add_argument("--arches", metavar="arch", nargs="+", default=["x86", "x64", "arm64"], help="Architecture variants of some packages")
+    parser.add_argument("--languages", metavar="lang", nargs="+", default=["en-US", "de-DE", "ja-JP"], help="Language variants of some packages")
+    parser.add_argument("--files", metavar="n", type=int, default=50, help="Number of files in each VSIX (defaults to 50)")
+    parser.add_argument("--file-size", metavar="size", type=vsdownload.parseSize, default=2048, help="Average size of the files in the VSIX packages (defaults to 2K)")
+    parser.add_argument("--msis", metavar="n", type=int, default=4, help="Number of MSI and CAB stand-ins (defaults to 4)")
+    parser.add_argument("--msi-size", metavar="size", type=vsdownload.parseSize, default=4*1024*1024, help="Size of each MSI and CAB stand-in (defaults to 4M)")
+    parser.add_argument("--seed", metavar="n", type=int, default=1, help="Seed for generating the packages")
+    parser.add_argument("--latency", metavar="ms", type=float, default=0, help="Latency added to each request")
+    parser.add_argument("--bandwidth", metavar="size", type=vsdownload.parseSize, help="Total bandwidth of the server, in bytes per second (e.g. 50M)")
+    parser.add_argument("--jobs", metavar="n", type=int, default=5, help="Number of files to download in parallel (defaults to 5)")
+    parser.add_argument("--unpack-jobs", metavar="n", type=int, default=os.cpu_count(), help="Number of packages to unpack in parallel (defaults to the number of CPUs)")
+    parser.add_argument("--vsdownload", metavar="file", default=os.path.join(TOP, "vsdownload.py"), help="The vsdownload.py to benchmark (defaults to the one next to this script)")
+    parser.add_argument("--throughput", const=True, action="store_const", help="Also compare the download throughput over reused connections and urllib, with 1 and --jobs parallel downloads")
+    parser.add_argument("--extraction", const=True, action="store_const", help="Also compare unpacking the packages serially and with --unpack-jobs processes")
+    parser.add_argument("--runs", metavar="n", type=int, default=3, help="Number of runs (defaults to 3)")
+    parser.add_argument("--work", metavar="dir", help="Directory for the generated packages and the installs (defaults to a temporary directory); the packages are reused if they were generated with the same options")
+    parser.add_argument("--output", metavar="file", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", metavar="file", help="Compare with the results in this file")
+    parser.add_argument("--verbose", const=True, action="store_const", help="Show the output of vsdownload")
+    return parser
+
+def fileContents(rng, size):
+    # Header-like text, that compresses about as well as the real headers.
+    words = ["int", "void", "const", "struct", "#define", "_In_", "_Out_", "HRESULT", "WINAPI", "typedef", "(", ")", ";", "\n"]
+    out = []
+    n = 0
+    while n < size:
+        w = rng.choice(words) if rng.random() < 0.7 else "x%x" % (rng.getrandbits(24))
+        out.append(w)
+        n += len(w) + 1
+    return " ".join(out).encode("utf-8")[:size]
+
+def writeVsix(file, index, args, rng):
+    # The file names differ in the casing of the top directories between
+    # packages, like in the real packages.
+    vc = "VC/Tools/MSVC" if index % 10 != 0 else "vc/tools/msvc"
+    with zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED) as zip:
+        zip.writestr("[Content_Types].xml", "<Types/>")
+        zip.writestr("extension.vsixmanifest", "<PackageManifest/>")
+        for j in range(args.files):
+            size = max(1, int(rng.expovariate(1 / args.file_size)))
+            if j % 10 == 9:
+                name = "Contents/MSBuild/Microsoft/VC/v180/pkg%d/file%d.props" % (index, j)
+            elif j % 10 == 8:
+                name = "Contents/%s/%s/lib/x64/pkg%d_%d.lib" % (vc, MSVCVER, index, j)
+            else:
+                name = "Contents/%s/%s/include/pkg%d/file%d.h" % (vc, MSVCVER, index, j)
+            zip.writestr(name, fileContents(rng, size))
+
+def addPayload(package, root, url, path, name):
+    size = os.path.getsize(os.path.join(root, path))
+    package.setdefault("payloads", []).append({
+        "fileName": name,
+        "url": url + "/" + path,
+        "size": size,
+        "sha256": vsdownload.sha256File(os.path.join(root, path)),
+    })
+
+# The server gets a new port each time; the generated manifest has this
+# in place of its URL.
+URL = "http://@URL@"
+
+def generate(args, root, url=URL):
+    # Write the payloads and the installer manifest template into root.
+    rng = random.Random(args.seed)
+    packages = []
+
+    vsixes = []
+    for i in range(args.packages):
+        id = "Bench.Vsix.Package%d" % (i)
+        variants = [{}]
+        if i % 3 == 0:
+            variants = [{ "chip": arch } for arch in args.arches]
+        elif i % 5 == 0:
+            variants = [{ "language": lang } for lang in args.languages]
+        for v in variants:
+            p = { "id": id, "version": "1.0.%d" % (i), "type": "Vsix" }
+            p.update(v)
+            path = "payloads/%s/payload.vsix" % (vsdownload.getPackageKey(p) + "".join("-" + x for x in v.values()))
+            os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+            writeVsix(os.path.join(root, path), i, args, rng)
+            addPayload(p, root, url, path, "payload.vsix")
+            packages.append(p)
+        vsixes.append(id)
+
+    # A tree of components, each depending on its children and on a share
+    # of the VSIX packages; some VSIX packages are shared by two components.
+    components = []
+    def component(level, index):
+        id = "Bench.Component.L%d.%d" % (level, index)
+        p = { "id": id, "version": "1.0", "type": "Component", "dependencies": {} }
+        components.append(p)
+        if level < args.depth:
+            for j in range(args.fanout):
+                p["dependencies"][component(level + 1, index * args.fanout + j)] = "1.0"
+        return id
+    top = component(1, 0)
+    for i, id in enumerate(vsixes):
+        components[i % len(components)]["dependencies"][id] = {}
+        components[(i * 7 + 3) % len(components)]["dependencies"][id] = {}
+    packages.extend(components)
+
+    installers = { "id": "Bench.Installers", "version": "1.0", "type": "Msi" }
+    for i in range(args.msis):
+        for ext in ["msi", "cab"]:
+            path = "payloads/Bench.Installers/bench%d.%s" % (i, ext)
+            os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+            with open(os.path.join(root, path), "wb") as f:
+                f.write(rng.randbytes(args.msi_size))
+            addPayload(installers, root, url, path, "Installers\\bench%d.%s" % (i, ext))
+    packages.append(installers)
+
+    # The packages that vsdownload selects by default.
+    deps = { top: "1.0", "Bench.Installers": "1.0" }
+    packages.append({ "id": "Microsoft.VisualStudio.Workload.VCTools", "version": "1.0", "type": "Workload", "dependencies": deps })
+    for id in ["Microsoft.VisualStudio.Component.VC.ATL", "Microsoft.VisualStudio.Component.VC.Tools.ARM", "Microsoft.VisualStudio.Component.VC.ATL.ARM", "Microsoft.VisualStudio.Component.VC.Tools.ARM64", "Microsoft.VisualStudio.Component.VC.ATL.ARM64"]:
+        packages.append({ "id": id, "version": "1.0", "type": "Component", "dependencies": { top: "1.0" } })
+
+    info = { "productDisplayVersion": "99.0 (benchmark)" }
+    with open(os.path.join(root, "installer.template.json"), "w") as f:
+        json.dump({ "info": info, "packages": packages }, f)
+
+def writeManifests(root, url):
+    # Write the installer and channel manifests for the server at url.
+    template = vsdownload.readFile(os.path.join(root, "installer.template.json")).decode("utf-8")
+    installer = template.replace(URL, url).encode("utf-8")
+    with open(os.path.join(root, "installer.json"), "wb") as f:
+        f.write(installer)
+    info = json.loads(installer)["info"]
+    channel = {
+        "info": info,
+        "channelItems": [{ "type": "Manifest", "payloads": [{ "url": url + "/installer.json", "sha256": hashlib.sha256(installer).hexdigest() }] }],
+    }
+    with open(os.path.join(root, "channel.json"), "w") as f:
+        json.dump(channel, f)
+
+@contextlib.contextmanager
+def serve(args, root):
+    server = localserver.Server(root, args.latency, args.bandwidth)
+    with server:
+        writeManifests(root, server.url)
+        yield server
+
+def getOptions(script):
+    # The options of this version of vsdownload.py, to only use the ones it
+    # has when comparing with an older one.
+    help = subprocess.run([sys.executable, script, "--help"], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    return set(re.findall(r"--[a-z-]+", help))
+
+def vsdownloadRun(args, url, cache, extra, env=None):
+    # Run vsdownload.py like a user would, and return the wall time, the
+    # time of each phase if it can write --timings, its output and the
+    # events of --timings.
+    trace = None
+    cmd = [sys.executable, args.vsdownload, "--accept-license", "--manifest", url + "/installer.json", "--cache", cache, "--host-arch", "x64"]
+    for option, value in [("--jobs", args.jobs), ("--unpack-jobs", args.unpack_jobs)]:
+        if option in args.options and option not in extra:
+            cmd += [option, str(value)]
+    cmd += extra
+    if "--timings" in args.options:
+        trace = cache + ".trace.json"
+        cmd += ["--timings", trace]
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, env=env)
+    elapsed = time.perf_counter() - start
+    if args.verbose or proc.returncode != 0:
+        sys.stdout.write(proc.stdout)
+    if proc.returncode != 0:
+        raise Exception("%s failed with exit code %d" % (" ".join(cmd), proc.returncode))
+    phases = {}
+    events = []
+    if trace != None:
+        with open(trace, "r") as f:
+            events = json.load(f)["traceEvents"]
+        os.remove(trace)
+        for e in events:
+            if e.get("cat") == "phase":
+                phases[e["name"]] = phases.get(e["name"], 0) + e["dur"] / 1000000
+    return elapsed, phases, proc.stdout, events
+
+def run(args, url, work):
+    # Download everything into a cold cache with --only-download, then
+    # install from the warm cache.
+    cache = os.path.join(work, "cache")
+    dest = os.path.join(work, "dest")
+    shutil.rmtree(cache, ignore_errors=True)
+    shutil.rmtree(dest, ignore_errors=True)
+    times = {}
+    for name, extra in [("fetch", ["--only-download"]), ("install", ["--dest", dest])]:
+        elapsed, phases, output, events = vsdownloadRun(args, url, cache, extra)
+        times[name] = elapsed
+        for p, t in phases.items():
+            times[name + "." + p] = t
+
+    selected = re.search(r"Selected (\d+) packages", output)
+    stats = {
+        "packages": int(selected.group(1)) if selected else None,
+        "downloadBytes": sum(os.path.getsize(os.path.join(dir, f)) for dir, dirs, files in os.walk(cache) for f in files if not dir.endswith("manifests")),
+        "files": sum(len(files) for dir, dirs, files in os.walk(dest)),
+    }
+    return times, stats
+
+def throughput(args, url, work):
+    # The time to download everything into a cold cache, for each transport
+    # and number of parallel downloads.
+    cache = os.path.join(work, "cache")
+    times = {}
+    for transport in ["pooled", "urllib"]:
+        env = dict(os.environ)
+        if transport == "urllib":
+            env["http_proxy"] = url
+            env.pop("no_proxy", None)
+            env.pop("NO_PROXY", None)
+        if "--jobs" not in args.options:
+            # Older versions have a fixed number of parallel downloads.
+            shutil.rmtree(cache, ignore_errors=True)
+            elapsed, phases, output, events = vsdownloadRun(args, url, cache, ["--only-download"], env)
+            times["%s-default" % (transport)] = phases.get("download", elapsed)
+            continue
+        for jobs in sorted(set([1, args.jobs])):
+            shutil.rmtree(cache, ignore_errors=True)
+            elapsed, phases, output, events = vsdownloadRun(args, url, cache, ["--only-download", "--jobs", str(jobs)], env)
+            times["%s-j%d" % (transport, jobs)] = phases.get("download", elapsed)
+    return times
+
+def treeDigest(dir):
+    tree = {}
+    for parent, dirs, files in os.walk(dir):
+        for name in dirs + files:
+            file = os.path.join(parent, name)
+            if os.path.islink(file):
+                tree[os.path.relpath(file, dir)] = "-> " + os.readlink(file)
+            elif os.path.isfile(file):
+                tree[os.path.relpath(file, dir)] = vsdownload.sha256File(file)
+            else:
+                tree[os.path.relpath(file, dir)] = "dir"
+    return tree
+
+def extraction(args, url, work):
+    # The time to unpack the payloads in the warm cache, serially and with a
+    # pool of processes, and the mean time per package. Both unpack into the
+    # same directory, as the listings of the installers contain its path.
+    cache = os.path.join(work, "cache")
+    dest = os.path.join(work, "unpack")
+    times = {}
+    trees = {}
+    # Older versions only unpack serially.
+    for jobs in sorted(set([1, args.unpack_jobs])) if "--unpack-jobs" in args.options else [1]:
+        shutil.rmtree(dest, ignore_errors=True)
+        elapsed, phases, output, events = vsdownloadRun(args, url, cache, ["--only-unpack", "--dest", dest] + (["--unpack-jobs", str(jobs)] if "--unpack-jobs" in args.options else []))
+        name = "j%d" % (jobs)
+        times[name] = phases.get("extract", elapsed)
+        packages = [e["dur"] / 1000000 for e in events if e.get("cat") == "extract"]
+        if len(packages) > 0:
+            times[name + ".per package"] = statistics.mean(packages)
+        trees[name] = treeDigest(dest)
+    shutil.rmtree(dest, ignore_errors=True)
+
+    first = next(iter(trees))
+    for name, tree in trees.items():
+        if tree != trees[first]:
+            diff = sorted(f for f in set(tree) | set(trees[first]) if tree.get(f) != trees[first].get(f))
+            for f in diff[:20]:
+                print("Differs between %s and %s: %s" % (first, name, f))
+            raise Exception("Unpacking with %s and %s gave different trees" % (first, name))
+    return times
+
+def printComparison(title, median, baseline, rate=None):
+    print("%-24s %10s" % (title, "Median") + ("  %10s" % ("Rate") if rate else "") + ("  %10s %8s" % ("Baseline", "Change") if baseline != None else ""))
+    for p, t in median.items():
+        line = "%-24s %8.3f s" % (p if "." not in p else "  " + p.split(".", 1)[1], t)
+        if rate:
+            line += "  %8s/s" % (vsdownload.formatSize(rate / t) if t > 0 else "-")
+        if baseline != None and p in baseline:
+            b = baseline[p]
+            line += "  %8.3f s %+7.1f%%" % (b, (t - b) * 100 / b if b > 0 else 0)
+        print(line)
+
+def gitCommit(dir):
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    args = getArgsParser().parse_args()
+    args.vsdownload = os.path.abspath(args.vsdownload)
+    args.options = getOptions(args.vsdownload)
+
+    # Connect to the local server directly.
+    for k in ["http_proxy", "HTTP_PROXY", "all_proxy", "ALL_PROXY"]:
+        os.environ.pop(k, None)
+    socket.setdefaulttimeout(15)
+
+    work = args.work
+    if work == None:
+        work = tempfile.mkdtemp(prefix="vsbench-")
+    work = os.path.abspath(work)
+    root = os.path.join(work, "cdn")
+
+    try:
+        # Reuse the generated packages if they were generated with the same
+        # options.
+        params = { k: v for k, v in vars(args).items() if k in ["packages", "fanout", "depth", "arches", "languages", "files", "file_size", "msis", "msi_size", "seed"] }
+        stamp = os.path.join(root, "params.json")
+        current = json.dumps(params, sort_keys=True)
+        if not os.path.isfile(stamp) or vsdownload.readFile(stamp).decode("utf-8") != current:
+            print("Generating packages in %s" % (root), flush=True)
+            start = time.perf_counter()
+            shutil.rmtree(root, ignore_errors=True)
+            os.makedirs(root)
+            generate(args, root)
+            with open(stamp, "w") as f:
+                f.write(current)
+            print("Generated in %.2f s" % (time.perf_counter() - start))
+
+        runs = []
+        transfers = []
+        extracts = []
+        with serve(args, root) as server:
+            for i in range(args.runs):
+                times, stats = run(args, server.url, work)
+                runs.append(times)
+                print("Run %d: %s" % (i + 1, ", ".join("%s %.3f s" % (p, t) for p, t in times.items() if "." not in p)), flush=True)
+                if args.throughput:
+                    transfers.append(throughput(args, server.url, work))
+                    print("Run %d: download %s" % (i + 1, ", ".join("%s %.3f s" % (p, t) for p, t in transfers[-1].items())), flush=True)
+                if args.extraction:
+                    extracts.append(extraction(args, server.url, work))
+                    print("Run %d: unpack %s" % (i + 1, ", ".join("%s %.3f s" % (p, t) for p, t in extracts[-1].items() if "." not in p)), flush=True)
+    finally:
+        if args.work == None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    # The phases of --timings differ between versions; keep them in the
+    # order they ran.
+    phases = []
+    for r in runs:
+        phases.extend(p for p in r if p not in phases)
+    median = { p: statistics.median(r[p] for r in runs if p in r) for p in phases }
+    median["total"] = sum(t for p, t in median.items() if "." not in p)
+    results = {
+        "commit": gitCommit(os.path.dirname(args.vsdownload)),
+        "vsdownload": args.vsdownload,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "params": dict(params, latency=args.latency, bandwidth=args.bandwidth, jobs=args.jobs, unpack_jobs=args.unpack_jobs),
+        "stats": stats,
+        "runs": runs,
+        "median": median,
+    }
+    if args.throughput:
+        results["throughput"] = {
+            "runs": transfers,
+            "median": { p: statistics.median(r[p] for r in transfers) for p in transfers[0] },
+        }
+    if args.extraction:
+        results["extraction"] = {
+            "runs": extracts,
+            "median": { p: statistics.median(r[p] for r in extracts) for p in extracts[0] },
+        }
+
+    baseline = None
+    if args.baseline != None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    print()
+    print("%s packages, %s downloaded, %d files installed" % (stats["packages"], vsdownload.formatSize(stats["downloadBytes"]), stats["files"]))
+    printComparison("Phase", dict(median), baseline.get("median", {}) if baseline != None else None)
+    if args.throughput:
+        print()
+        printComparison("Download", results["throughput"]["median"], baseline.get("throughput", {}).get("median", {}) if baseline != None else None, stats["downloadBytes"])
+    if args.extraction:
+        print()
+        printComparison("Unpack", results["extraction"]["median"], baseline.get("extraction", {}).get("median", {}) if baseline != None else None)
+
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
@@ -0,0 +1,189 @@
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+# A local stand-in for the CDN that vsdownload.py downloads from, for its
+# tests and benchmarks.
+#
+# It serves the files in a directory with support for range requests,
+# keep-alive and revalidation with ETag and Last-Modified, as the CDN
+# does. It also answers requests for absolute URLs, so that it can be
+# used as the proxy for itself, to make vsdownload.py use urllib instead
+# of its own connections. It can add latency to each request and limit
+# the total bandwidth, and for the tests, ignore range requests, drop
+# connections in the middle of a response and redirect requests.
+
+import email.utils
+import http.server
+import os
+import threading
+import time
+import urllib.parse
+
+class Shaper:
+    # Limits the total bandwidth of all connections.
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self, n):
+        if self.bandwidth == None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next = max(self.next, now) + n / self.bandwidth
+            delay = self.next - now
+        time.sleep(delay)
+
+class Server:
+    def __init__(self, root, latency=0, bandwidth=None):
+        self.root = root
+        self.latency = latency
+        self.shaper = Shaper(bandwidth)
+        # Send the whole file even for range requests.
+        self.ignoreRange = False
+        # Close the connection after sending this many bytes of a file, the
+        # first time that file is requested.
+        self.dropAfter = None
+        self.dropped = set()
+        # Paths that are redirected, to the Location given, or without one
+        # if it is None.
+        self.redirects = {}
+        # The path, the request headers, the status and the number of bytes
+        # of the body sent, for each request.
+        self.log = []
+        self.lock = threading.Lock()
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), makeHandler(self))
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % (self.httpd.server_address[1])
+
+    def start(self):
+        # Poll for shutdown more often than the default, for short tests.
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def requests(self, path):
+        with self.lock:
+            return [r for r in self.log if r["path"] == path]
+
+def makeHandler(server):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # The headers and the body are written separately; without this,
+        # on a reused connection the body waits for the delayed ACK of the
+        # headers.
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def record(self, path, status):
+            # This is done before sending the response, so that the request
+            # is in the log once the client has the response.
+            entry = { "path": path, "headers": dict(self.headers), "status": status, "sent": 0 }
+            with server.lock:
+                server.log.append(entry)
+            return entry
+
+        def isNotModified(self, etag, mtime):
+            if "If-None-Match" in self.headers:
+                return self.headers["If-None-Match"] == etag
+            if "If-Modified-Since" in self.headers:
+                try:
+                    since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+                except (TypeError, ValueError):
+                    return False
+                return int(mtime) <= since.timestamp()
+            return False
+
+        def do_GET(self):
+            time.sleep(server.latency / 1000)
+            # Requests through a proxy have the whole URL as the path.
+            path = os.path.normpath(urllib.parse.urlsplit(self.path).path).lstrip("/")
+            if path in server.redirects:
+                self.record(path, 302)
+                self.send_response(302)
+                if server.redirects[path] != None:
+                    self.send_header("Location", server.redirects[path])
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            file = os.path.join(server.root, path)
+            if path.startswith("..") or not os.path.isfile(file):
+                self.record(path, 404)
+                self.send_error(404)
+                return
+            st = os.stat(file)
+            etag = "\"%x-%x\"" % (st.st_mtime_ns, st.st_size)
+            lastModified = email.utils.formatdate(st.st_mtime, usegmt=True)
+            if self.isNotModified(etag, st.st_mtime):
+                self.record(path, 304)
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", lastModified)
+                self.end_headers()
+                return
+
+            size = st.st_size
+            start = 0
+            range = self.headers.get("Range", "")
+            if range.startswith("bytes=") and range.endswith("-") and not server.ignoreRange:
+                start = int(range[6:-1])
+                if start >= size:
+                    self.record(path, 416)
+                    self.send_error(416)
+                    return
+                entry = self.record(path, 206)
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, size - 1, size))
+            else:
+                entry = self.record(path, 200)
+                self.send_response(200)
+            self.send_header("Content-Length", str(size - start))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", lastModified)
+            self.end_headers()
+
+            drop = None
+            if server.dropAfter != None:
+                with server.lock:
+                    if path not in server.dropped:
+                        server.dropped.add(path)
+                        drop = server.dropAfter
+            with open(file, "rb") as f:
+                f.seek(start)
+                for block in iter(lambda: f.read(64 * 1024), b""):
+                    if drop != None and entry["sent"] + len(block) > drop:
+                        block = block[:drop - entry["sent"]]
+                    server.shaper.wait(len(block))
+                    entry["sent"] += len(block)
+                    self.wfile.write(block)
+                    if entry["sent"] == drop:
+                        # The client sees the connection closed before it got
+                        # the whole Content-Length.
+                        self.close_connection = True
+                        break
+    return Handler
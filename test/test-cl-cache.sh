@@ -0,0 +1,125 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+. "${0%/*}/test.sh"
+
+
+export WINE_MSVC_CACHE=${CWD}cache
+
+hits() {
+    ${BIN}cl --cache-stats | awk '$1 == "Hits" { print $2 }'
+}
+misses() {
+    ${BIN}cl --cache-stats | awk '$1 == "Misses" { print $2 }'
+}
+
+cat >test.h <<EOF
+#define VALUE 1
+EOF
+
+cat >test.c <<EOF
+#include "test.h"
+int value = VALUE;
+EOF
+
+cat >other.c <<EOF
+int other = 2;
+EOF
+
+
+EXEC cl-miss ${BIN}cl /nologo /c test.c
+EXEC "" mv test.obj test-miss.obj
+EXEC cl-hit ${BIN}cl /nologo /c test.c
+EXEC "" cmp test.obj test-miss.obj
+DIFF cl-hit.out cl-miss.out
+EXEC "" test "$(hits) $(misses)" = "1 1"
+
+
+# /showIncludes doesn't affect the object, and its output is replayed.
+EXEC cl-showIncludes ${BIN}cl /nologo /showIncludes /c test.c
+DIFF cl-showIncludes.out - <<EOF
+test.c
+Note: including file: ${CWD}test.h
+EOF
+EXEC "" test "$(hits) $(misses)" = "2 1"
+
+
+# Changing a header makes it recompile.
+echo "#define VALUE 3" >test.h
+EXEC "" ${BIN}cl /nologo /c test.c
+EXEC "" test "$(hits) $(misses)" = "2 2"
+EXEC "" ${BIN}cl /nologo /c test.c
+EXEC "" test "$(hits) $(misses)" = "3 2"
+cmp -s test.obj test-miss.obj
+EXEC "" test $? -ne 0
+
+
+# Multiple sources, with /Fo naming a directory.
+mkdir out
+EXEC "" ${BIN}cl /nologo /c /Foout/ test.c other.c
+EXEC "" test "$(hits) $(misses)" = "3 4"
+EXEC "" rm out/test.obj out/other.obj
+EXEC "" ${BIN}cl /nologo /c /Fo${CWD}out\\ test.c ${CWD}other.c
+EXEC "" test "$(hits) $(misses)" = "3 6"
+EXEC "" ${BIN}cl /nologo /c /Foout/ test.c other.c
+EXEC "" test "$(hits) $(misses)" = "5 6"
+EXEC "" test -f out/test.obj -a -f out/other.obj
+
+# A /Fo file name.
+EXEC "" ${BIN}cl /nologo /c /Foout/named.obj test.c
+EXEC "" cmp out/named.obj test.obj
+EXEC "" test "$(hits) $(misses)" = "5 7"
+
+
+# The sources that miss are compiled in one call, and the output of each is
+# stored with its own entry.
+echo "#define VALUE 5" >test.h
+echo "int other = 4;" >other.c
+EXEC cl-multi-miss ${BIN}cl /nologo /showIncludes /c /Foout/ test.c other.c
+DIFF cl-multi-miss.out - <<EOF
+test.c
+Note: including file: ${CWD}test.h
+other.c
+EOF
+EXEC "" test "$(hits) $(misses)" = "5 9"
+EXEC "" mv out/test.obj out/test-miss.obj
+EXEC cl-multi-hit ${BIN}cl /nologo /showIncludes /c /Foout/ test.c other.c
+DIFF cl-multi-hit.out cl-multi-miss.out
+EXEC "" cmp out/test.obj out/test-miss.obj
+EXEC "" test "$(hits) $(misses)" = "7 9"
+EXEC cl-single-hit ${BIN}cl /nologo /showIncludes /c /Foout/ other.c
+DIFF cl-single-hit.out - <<EOF
+other.c
+EOF
+EXEC "" test "$(hits) $(misses)" = "8 9"
+
+
+# Errors aren't cached.
+echo "int broken = ;" >broken.c
+for i in 1 2; do
+    ${BIN}cl /nologo /c broken.c >/dev/null
+    EXEC "" test $? -ne 0
+done
+EXEC "" test "$(hits) $(misses)" = "8 11"
+
+
+EXEC "" ${BIN}cl --cache-clear
+EXEC "" ${BIN}cl /nologo /c test.c
+EXEC "" test "$(hits) $(misses)" = "0 1"
+
+
+EXIT
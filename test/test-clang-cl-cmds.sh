@@ -24,12 +24,16 @@ fi
 
 BASE_UNIX=$(. "${BIN}msvcenv.sh" && echo $BASE_UNIX)
 TARGET_ARCH=$(. "${TESTS}../msvcenv-native.sh" && echo $TARGET_ARCH)
+VFSOVERLAY_ARGS=()
+if [ -f "$BASE_UNIX/vfsoverlay.yaml" ]; then
+    VFSOVERLAY_ARGS=(-vfsoverlay "$BASE_UNIX/vfsoverlay.yaml")
+fi
 
 # Since Clang 13, it's possible to point out the installed MSVC/WinSDK with
 # the /winsysroot parameter. LLD also provides the same parameter since
 # version 15. (For versions 13 and 14, this parameter can still be used
 # for linking, as long as linking is done via Clang.)
-EXEC "" clang-cl --target=$TARGET_ARCH-windows-msvc "${TESTS}hello.c" -Fehello.exe -winsysroot "$BASE_UNIX" -fuse-ld=lld
+EXEC "" clang-cl --target=$TARGET_ARCH-windows-msvc "${TESTS}hello.c" -Fehello.exe -winsysroot "$BASE_UNIX" -fuse-ld=lld "${VFSOVERLAY_ARGS[@]}"
 
 # Set up the INCLUDE/LIB env variables for compilation without directly
 # pointing at the installation.
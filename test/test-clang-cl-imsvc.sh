@@ -0,0 +1,49 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+. "${0%/*}/test.sh"
+
+# ${BIN} set up by the caller
+if [ -z "$BIN" ]; then
+    echo Must set the BIN env variable pointing to the MSVC bin directory
+    exit 1
+fi
+
+# Build with plain clang-cl and lld-link, passing the include and library
+# directories on the command line, without the _CL_ and _LINK_ variables
+# from msvcenv-native.sh or a VFS overlay. This is how other native tools
+# see the installation, so the lowercase names need to exist on disk.
+TARGET_TRIPLE=$(. "${TESTS}../msvcenv-native.sh" && echo $TARGET_TRIPLE)
+IFS=';' read -ra INCLUDE_DIRS <<< "$(. "${TESTS}../msvcenv-native.sh" && echo "$INCLUDE")"
+IFS=';' read -ra LIB_DIRS <<< "$(. "${TESTS}../msvcenv-native.sh" && echo "$LIB")"
+unset INCLUDE LIB _CL_ _LINK_ VFSOVERLAY
+
+IMSVC_ARGS=()
+for dir in "${INCLUDE_DIRS[@]}"; do
+    IMSVC_ARGS+=(/imsvc "$dir")
+done
+LIBPATH_ARGS=()
+for dir in "${LIB_DIRS[@]}"; do
+    LIBPATH_ARGS+=("/libpath:$dir")
+done
+
+EXEC "" clang-cl --target=$TARGET_TRIPLE /X "${IMSVC_ARGS[@]}" "${TESTS}hello.c" -c -Fohello.obj
+EXEC "" lld-link hello.obj -out:hello.exe "${LIBPATH_ARGS[@]}"
+
+# The headers with problematic casing; see test-clang-cl-cmds.sh.
+EXEC "" clang-cl --target=$TARGET_TRIPLE /X "${IMSVC_ARGS[@]}" "${TESTS}headers.cpp" -P -Fiheaders-preproc.cpp
+
+EXIT
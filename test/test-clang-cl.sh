@@ -29,6 +29,7 @@ for arch in x86 x64 arm arm64; do
     fi
 
     EXEC "" BIN=$BIN ./test-clang-cl-cmds.sh
+    EXEC "" BIN=$BIN ./test-clang-cl-imsvc.sh
     EXEC "" BIN=$BIN ./test-cmake-clang-cl.sh
 done
 
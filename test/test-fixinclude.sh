@@ -0,0 +1,62 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+. "${0%/*}/test.sh"
+
+
+# A synthetic header tree.
+mkdir -p include/sub
+printf '#include <Windows.h>\r\n#include "Sub\\Foo.H" // See Other\\Header.h\r\nint X;\r\n' > include/a.h
+printf '#include <GL/GL.h>\n#  include <WinSock2.h>\n#include MACRO_NAME\n  #include "Ole2.h" //\n' > include/b.h
+printf 'int y;\nint z;' > include/sub/c.h
+printf 'int plain;\n' > include/sub/d.h
+: > include/e.h
+ln -s a.h include/link.h
+touch -t 200001010000 include/sub/d.h include/e.h
+touch stamp
+
+# The expected output.
+mkdir -p expected/sub
+printf '#include <windows.h>\n#include "sub/foo.h" // See Other\\Header.h\nint X;\n' > expected/a.h
+printf '#include <GL/gl.h>\n#  include <winsock2.h>\n#include MACRO_NAME\n  #include "ole2.h" //\n' > expected/b.h
+printf 'int y;\nint z;\n' > expected/sub/c.h
+printf 'int plain;\n' > expected/sub/d.h
+: > expected/e.h
+ln -s a.h expected/link.h
+
+cp -a include include-j
+
+EXEC "" ${TESTS}../fixinclude -map_winsdk include
+DIFF expected include
+
+EXEC "" ${TESTS}../fixinclude -map_winsdk -j 3 include-j
+DIFF expected include-j
+
+# Files that don't change are left untouched.
+EXEC "" test include/sub/d.h -ot stamp
+EXEC "" test include/e.h -ot stamp
+EXEC "" test include-j/sub/d.h -ot stamp
+
+# Running it again doesn't rewrite anything.
+touch -t 200001010000 include/a.h include/b.h include/sub/c.h
+EXEC "" ${TESTS}../fixinclude -map_winsdk include
+DIFF expected include
+EXEC "" test include/a.h -ot stamp
+EXEC "" test include/b.h -ot stamp
+EXEC "" test include/sub/c.h -ot stamp
+
+
+EXIT
@@ -0,0 +1,34 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2026 Huang Qinjin
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+. "${0%/*}/test.sh"
+
+
+# Use a server of our own, regardless of one already running for the prefix.
+export WINE_MSVC_SERVER=${CWD}server
+
+EXEC "" ${BIN}msvctricks-server start
+EXEC "" ${BIN}msvctricks-server status
+
+# Rerun the tests with the tools spawned by the server.
+EXEC "" BIN=$BIN ${TESTS}test-cl.sh
+EXEC "" BIN=$BIN ${TESTS}test-mt.sh
+
+EXEC "" ${BIN}msvctricks-server stop
+EXEC "" test ! -e ${WINE_MSVC_SERVER}/requests
+
+
+EXIT
@@ -0,0 +1,660 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+# Tests of the caching and downloading in vsdownload.py, against a local
+# stand-in for the CDN (see localserver.py). They don't need a toolchain.
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+import zipfile
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+import vsdownload
+import localserver
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="msvc-wine.vsdownload.")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.root = os.path.join(self.dir, "cdn")
+        self.cache = os.path.join(self.dir, "cache")
+        os.makedirs(self.root)
+        os.makedirs(self.cache)
+        self.server = localserver.Server(self.root).start()
+        self.addCleanup(self.server.stop)
+
+    def serve(self, path, data):
+        with open(os.path.join(self.root, path), "wb") as f:
+            f.write(data)
+        return self.server.url + "/" + path
+
+class CachedUrlopenTest(ServerTestCase):
+    def fetch(self, url, **kwargs):
+        return vsdownload.cachedUrlopen(url, self.cache, **kwargs)
+
+    def forget(self, url, field):
+        # Drop a validator from the cached metadata, as if the server
+        # hadn't sent it.
+        name = os.path.join(self.cache, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+        with open(name, "r") as f:
+            meta = json.load(f)
+        meta[field] = None
+        with open(name, "w") as f:
+            json.dump(meta, f)
+
+    def testRevalidateWithETag(self):
+        url = self.serve("channel", b"first")
+        self.assertEqual(self.fetch(url), b"first")
+        self.assertEqual(self.fetch(url), b"first")
+        requests = self.server.requests("channel")
+        self.assertEqual([r["status"] for r in requests], [200, 304])
+        self.assertNotIn("If-None-Match", requests[0]["headers"])
+        self.assertIn("If-None-Match", requests[1]["headers"])
+
+    def testRevalidateWithLastModified(self):
+        url = self.serve("channel", b"first")
+        self.assertEqual(self.fetch(url), b"first")
+        self.forget(url, "etag")
+        self.assertEqual(self.fetch(url), b"first")
+        requests = self.server.requests("channel")
+        self.assertEqual([r["status"] for r in requests], [200, 304])
+        self.assertNotIn("If-None-Match", requests[1]["headers"])
+        self.assertIn("If-Modified-Since", requests[1]["headers"])
+
+    def testChangedBody(self):
+        url = self.serve("channel", b"first")
+        self.assertEqual(self.fetch(url), b"first")
+        # A new ETag, as the size differs.
+        self.serve("channel", b"second")
+        self.assertEqual(self.fetch(url), b"second")
+        self.assertEqual(self.fetch(url), b"second")
+        self.assertEqual([r["status"] for r in self.server.requests("channel")], [200, 200, 304])
+
+    def testMaxAge(self):
+        url = self.serve("channel", b"first")
+        self.assertEqual(self.fetch(url), b"first")
+        self.assertEqual(self.fetch(url, maxAge=3600), b"first")
+        self.assertEqual(len(self.server.requests("channel")), 1)
+
+    def testKnownHash(self):
+        url = self.serve("installer.json", b"manifest")
+        sha256 = hashlib.sha256(b"manifest").hexdigest()
+        self.assertEqual(self.fetch(url, sha256=sha256), b"manifest")
+        self.assertEqual(self.fetch(url, sha256=sha256.upper()), b"manifest")
+        self.assertEqual(len(self.server.requests("installer.json")), 1)
+
+class PackageIndexTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        payload = { "fileName": "a.vsix", "url": "https://example.com/a.vsix", "size": 3, "sha256": "00" }
+        manifest = {
+            "info": { "productDisplayVersion": "99.0 (test)" },
+            "packages": [
+                { "id": "A", "version": "1.0", "type": "Vsix", "chip": "x86", "payloads": [payload] },
+                { "id": "A", "version": "1.0", "type": "Vsix", "chip": "x64", "payloads": [payload], "installSizes": { "targetDrive": 10, "sharedDrive": 5 } },
+                { "id": "B", "version": "2.0", "type": "Component", "dependencies": { "A": "1.0", "C": { "version": "1.0", "type": "Recommended" } },
+                  "localizedResources": [{ "language": "en-us", "license": "https://example.com/license" }] },
+            ],
+        }
+        self.url = self.serve("installer.json", json.dumps(manifest).encode("utf-8"))
+
+    def load(self):
+        args = vsdownload.getArgsParser().parse_args(["--manifest", self.url, "--cache", self.cache])
+        args.host_arch = "x64"
+        with contextlib.redirect_stdout(io.StringIO()):
+            return vsdownload.loadPackages(args)
+
+    def getIndexFiles(self):
+        return [f for f in os.listdir(os.path.join(self.cache, "manifests")) if f.startswith("packages-")]
+
+    def assertSamePackages(self, a, b):
+        self.assertEqual(list(a), list(b))
+        for id in a:
+            self.assertEqual([p.getRecord() for p in a[id]], [p.getRecord() for p in b[id]])
+
+    def testIndexIsReused(self):
+        first = self.load()
+        self.assertEqual([p["chip"] for p in first["a"]], ["x64", "x86"])
+        self.assertEqual(first["a"][0]["installSize"], 15)
+        self.assertEqual(first["b"][0]["license"], "https://example.com/license")
+        index = self.getIndexFiles()
+        self.assertEqual(len(index), 1)
+        self.assertIn("-v%d-" % (vsdownload.Package.recordVersion), index[0])
+        # The index is plain JSON.
+        with open(os.path.join(self.cache, "manifests", index[0]), "r") as f:
+            self.assertIn("b", json.load(f)["packages"])
+
+        second = self.load()
+        self.assertSamePackages(first, second)
+        self.assertEqual(second["a"][0]["payloads"][0]["fileName"], "a.vsix")
+        self.assertEqual(second["b"][0]["dependencies"]["C"]["type"], "Recommended")
+
+    def testBrokenIndexIsRebuilt(self):
+        first = self.load()
+        file = os.path.join(self.cache, "manifests", self.getIndexFiles()[0])
+        for content in [b"garbage", b"{}", b"{\"info\": {}, \"packages\": {\"a\": [[1, 2]]}}"]:
+            with open(file, "wb") as f:
+                f.write(content)
+            self.assertSamePackages(first, self.load())
+            with open(file, "rb") as f:
+                self.assertNotEqual(f.read(), content)
+
+class ParseManifestTest(unittest.TestCase):
+    def testChunks(self):
+        # Values split between the chunks, including numbers and multibyte
+        # characters, are parsed the same as in one go.
+        payload = { "fileName": "\u00e9\u4e2d.vsix", "url": "https://example.com/a.vsix", "size": 1234567, "sha256": "00" }
+        manifest = {
+            "manifestVersion": "1.1",
+            "info": { "productDisplayVersion": "99.0 (test)" },
+            "other": [1234567890, { "a": [True, None, 1.5] }],
+            "packages": [{ "id": "P%d" % (i), "version": "1.%d" % (i), "type": "Vsix", "payloads": [payload], "installSizes": { "targetDrive": 1000 + i } } for i in range(20)],
+            "last": 1234567890,
+        }
+        for indent in [None, 2]:
+            data = ("\ufeff" + json.dumps(manifest, indent=indent, ensure_ascii=False)).encode("utf-8")
+            for chunkSize in [1, 3, 100, 1 << 20]:
+                info, packages = vsdownload.parseManifest(data, chunkSize)
+                self.assertEqual(info, manifest["info"])
+                self.assertEqual([p.getRecord() for p in packages], [vsdownload.Package(p).getRecord() for p in manifest["packages"]])
+
+    def testInvalid(self):
+        for data in [b"[]", b"{\"packages\": {}}", b"{\"packages\": [{\"id\": \"A\""]:
+            with self.assertRaises(ValueError):
+                vsdownload.parseManifest(data, 3)
+
+class ConnectionPoolTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = self.serve("file", b"data")
+
+    def getPool(self):
+        pool = vsdownload.ConnectionPool()
+        self.addCleanup(pool.close)
+        return pool
+
+    def testRedirect(self):
+        self.server.redirects["old"] = "/file"
+        with self.getPool().open(self.server.url + "/old") as response:
+            self.assertEqual(response.read(), b"data")
+
+    def testRedirectWithoutLocation(self):
+        self.server.redirects["old"] = None
+        with self.assertRaises(vsdownload.urllib.error.HTTPError) as cm:
+            self.getPool().open(self.server.url + "/old")
+        self.assertEqual(cm.exception.code, 302)
+
+    def testProxy(self):
+        # The server answers requests for absolute URLs, so it can be its
+        # own proxy.
+        with unittest.mock.patch.dict(os.environ, { "http_proxy": self.server.url, "no_proxy": "" }):
+            pool = self.getPool()
+        with pool.open(self.url) as response:
+            self.assertNotIsInstance(response, vsdownload.PooledResponse)
+            self.assertEqual(response.read(), b"data")
+
+    def testNoProxy(self):
+        # Nothing listens on the discard port.
+        with unittest.mock.patch.dict(os.environ, { "http_proxy": "http://127.0.0.1:9", "no_proxy": "127.0.0.1" }):
+            pool = self.getPool()
+            with pool.open(self.url) as response:
+                self.assertIsInstance(response, vsdownload.PooledResponse)
+                self.assertEqual(response.read(), b"data")
+
+class DownloadPackagesTest(ServerTestCase):
+    def testFailedPayload(self):
+        # The hashes of the files that were downloaded before a payload
+        # failed are kept.
+        data = b"a" * 300
+        good = { "fileName": "good.vsix", "url": self.serve("good.vsix", data), "size": len(data), "sha256": hashlib.sha256(data).hexdigest() }
+        bad = { "fileName": "bad.vsix", "url": self.server.url + "/missing.vsix", "size": 100, "sha256": "00" }
+        selected = [vsdownload.Package({ "id": "Good", "version": "1.0", "payloads": [good] }),
+                    vsdownload.Package({ "id": "Bad", "version": "1.0", "payloads": [bad] })]
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(vsdownload.urllib.error.HTTPError):
+                vsdownload.downloadPackages(selected, self.cache, jobs=1)
+        index = vsdownload.loadVerifiedIndex(self.cache)
+        self.assertEqual(list(index), [os.path.join(vsdownload.getPackageKey(selected[0]), "good.vsix")])
+
+class VsixTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="msvc-wine.vsdownload.")
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def makeVsix(self, name, files):
+        file = os.path.join(self.dir, name)
+        with zipfile.ZipFile(file, "w") as zip:
+            for n, data in files.items():
+                zip.writestr(n, data)
+        return file
+
+    def getTree(self, dir):
+        tree = {}
+        for root, dirs, files in os.walk(dir):
+            for n in dirs:
+                tree[os.path.relpath(os.path.join(root, n), dir)] = None
+            for n in files:
+                with open(os.path.join(root, n), "rb") as f:
+                    tree[os.path.relpath(os.path.join(root, n), dir)] = f.read()
+        return tree
+
+    def unpackOld(self, vsix, unpack):
+        # Extract the whole archive and merge it into the unpack directory,
+        # as this was done before the VSIX contents were filtered.
+        temp = os.path.join(unpack, "vsix")
+        with zipfile.ZipFile(vsix, "r") as zip:
+            for f in zip.infolist():
+                name = os.path.join(temp, vsdownload.urllib.parse.unquote(f.filename))
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+                with zip.open(f) as src, open(name, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+        vsdownload.mergeTrees(os.path.join(temp, "Contents"), unpack)
+        vsdownload.mergeTrees(os.path.join(temp, "$MSBuild"), os.path.join(unpack, "MSBuild"))
+        shutil.rmtree(temp)
+
+    def testSameTree(self):
+        vsixes = [
+            self.makeVsix("a.vsix", {
+                "extension.vsixmanifest": b"manifest",
+                "Contents/VC/Tools/MSVC/1.0/include/a.h": b"a",
+                "Contents/VC/Tools/MSVC/1.0/include/with%20space.h": b"space",
+                "Contents/Common7/IDE/devenv.exe": b"ide",
+                "Contents/Common7/Tools/VsDevCmd.bat": b"bat",
+                "$MSBuild/Microsoft/VC/v170/x.props": b"props",
+            }),
+            self.makeVsix("b.vsix", {
+                "Contents/vc/tools/msvc/1.0/include/b.h": b"b",
+                "Contents/VC/Tools/MSVC/1.0/include/a.h": b"a2",
+                "Contents/DIA SDK/bin/msdia140.dll": b"dia",
+                "Contents/Other/file": b"other",
+            }),
+        ]
+        old = os.path.join(self.dir, "old")
+        new = os.path.join(self.dir, "new")
+        for vsix in vsixes:
+            self.unpackOld(vsix, os.path.join(old, "unpack"))
+            vsdownload.unpackVsix(vsix, os.path.join(new, "unpack"), os.path.join(self.dir, "listing.txt"), vsdownload.getVCSDKComponents())
+        for dir in [old, new]:
+            vsdownload.moveVCSDK(os.path.join(dir, "unpack"), os.path.join(dir, "dest"))
+        tree = self.getTree(os.path.join(new, "dest"))
+        self.assertEqual(tree, self.getTree(os.path.join(old, "dest")))
+        self.assertEqual(tree[os.path.join("VC", "Tools", "MSVC", "1.0", "include", "a.h")], b"a2")
+        self.assertIn(os.path.join("VC", "Tools", "MSVC", "1.0", "include", "b.h"), tree)
+        self.assertEqual(tree[os.path.join("MSBuild", "Microsoft", "VC", "v170", "x.props")], b"props")
+        self.assertNotIn(os.path.join("Common7", "IDE"), tree)
+
+    def testLinksNotWrittenThrough(self):
+        shared = os.path.join(self.dir, "shared")
+        with open(shared, "wb") as f:
+            f.write(b"shared")
+        unpack = os.path.join(self.dir, "unpack")
+        os.makedirs(os.path.join(unpack, "VC"))
+        os.link(shared, os.path.join(unpack, "VC", "hardlink.h"))
+        os.symlink(shared, os.path.join(unpack, "VC", "symlink.h"))
+        vsix = self.makeVsix("a.vsix", { "Contents/VC/hardlink.h": b"new1", "Contents/VC/symlink.h": b"new2" })
+        vsdownload.unpackVsix(vsix, unpack, os.path.join(self.dir, "listing.txt"))
+        with open(shared, "rb") as f:
+            self.assertEqual(f.read(), b"shared")
+        self.assertEqual(self.getTree(os.path.join(unpack, "VC")), { "hardlink.h": b"new1", "symlink.h": b"new2" })
+        self.assertFalse(os.path.islink(os.path.join(unpack, "VC", "symlink.h")))
+
+class InstallDeltaTest(unittest.TestCase):
+    def package(self, id, digest, type="Vsix"):
+        return vsdownload.Package({ "id": id, "version": "1.0", "type": type, "payloads": [{ "fileName": id + ".vsix", "sha256": digest }] })
+
+    def state(self, packages, files):
+        return { vsdownload.getPackageKey(p): { "payloads": vsdownload.getPayloadDigests(p), "files": files[p["id"]] } for p in packages }
+
+    def keys(self, packages):
+        return [vsdownload.getPackageKey(p) for p in packages]
+
+    def testDelta(self):
+        a, b, c = self.package("A", "a"), self.package("B", "b"), self.package("C", "c")
+        state = self.state([a, b, c], { "A": ["a.h"], "B": ["b.h"], "C": ["c.h"] })
+        b2 = self.package("B", "b2")
+        install, installed = vsdownload.getInstallDelta([a, b2], state)
+        self.assertEqual(self.keys(install), self.keys([b2]))
+        self.assertEqual(list(installed), self.keys([a]))
+
+    def testOverlappingDroppedFiles(self):
+        # A package that is kept is reinstalled, if a dropped package
+        # installed some of the same files.
+        a, b, c = self.package("A", "a"), self.package("B", "b"), self.package("C", "c")
+        state = self.state([a, b, c], { "A": ["a.h", "shared.h"], "B": ["b.h"], "C": ["shared.h"] })
+        install, installed = vsdownload.getInstallDelta([a, b], state)
+        self.assertEqual(self.keys(install), self.keys([a]))
+        self.assertEqual(list(installed), self.keys([b]))
+
+    def testWDK(self):
+        a, sdk = self.package("A", "a"), self.package("Win11SDK_10.0.22621", "s", "Msi")
+        state = self.state([a, sdk], { "A": ["a.h"], "Win11SDK_10.0.22621": ["s.h"] })
+        install, installed = vsdownload.getInstallDelta([a, sdk], state)
+        self.assertEqual(install, [])
+        # Adding the WDK reinstalls the SDK packages, which it restructures.
+        install, installed = vsdownload.getInstallDelta([a, sdk], state, ["wdk.msi:1:1"])
+        self.assertEqual(self.keys(install), self.keys([sdk]))
+        state.update(self.state([sdk], { "Win11SDK_10.0.22621": ["s.h"] }))
+        state["$WDK"] = { "payloads": ["wdk.msi:1:1"], "files": ["wdk.h"] }
+        install, installed = vsdownload.getInstallDelta([a, sdk], state, ["wdk.msi:1:1"])
+        self.assertEqual(install, [])
+        self.assertIn("$WDK", installed)
+        # So does removing it.
+        install, installed = vsdownload.getInstallDelta([a, sdk], state)
+        self.assertEqual(self.keys(install), self.keys([sdk]))
+
+class IncrementalInstallTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dest = os.path.join(self.dir, "dest")
+
+    def payload(self, name, files):
+        with zipfile.ZipFile(os.path.join(self.root, name), "w") as zip:
+            for n, data in files.items():
+                zip.writestr("Contents/" + n, data)
+        file = os.path.join(self.root, name)
+        return { "fileName": name, "url": self.server.url + "/" + name, "size": os.path.getsize(file), "sha256": vsdownload.sha256File(file) }
+
+    def install(self, packages, *args):
+        manifest = { "info": { "productDisplayVersion": "99.0 (test)" }, "packages": packages }
+        url = self.serve("installer.json", json.dumps(manifest).encode("utf-8"))
+        cmd = [sys.executable, os.path.join(TOP, "vsdownload.py"), "--accept-license", "--manifest", url, "--cache", self.cache, "--dest", self.dest, "--host-arch", "x64", "--skip-patch"] + list(args) + [p["id"] for p in packages]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dict(os.environ, http_proxy="", https_proxy=""))
+        self.assertEqual(result.returncode, 0, result.stdout.decode("utf-8", "replace"))
+        return result.stdout.decode("utf-8")
+
+    def path(self, *names):
+        return os.path.join(self.dest, "VC", "Tools", "MSVC", *names)
+
+    def testRemoval(self):
+        a = { "id": "A", "version": "1.0", "type": "Vsix", "payloads": [self.payload("a.vsix", { "VC/Tools/MSVC/1.0/include/a.h": b"a" })] }
+        b = { "id": "B", "version": "1.0", "type": "Vsix", "payloads": [self.payload("b.vsix", { "VC/Tools/MSVC/1.0/include/B.h": b"b", "VC/Tools/MSVC/1.0/lib/x64/B.lib": b"b" })] }
+        self.install([a, b], "--incremental")
+        self.assertTrue(os.path.isfile(self.path("1.0", "include", "B.h")))
+        # Like the lowercase links made by install.sh.
+        os.symlink("B.h", self.path("1.0", "include", "b.h"))
+        os.symlink("B.lib", self.path("1.0", "lib", "x64", "b.lib"))
+        os.symlink(os.path.join("1.0", "lib"), self.path("lib"))
+        self.install([a], "--incremental")
+        self.assertTrue(os.path.isfile(self.path("1.0", "include", "a.h")))
+        for name in [("1.0", "include", "B.h"), ("1.0", "include", "b.h"), ("1.0", "lib"), ("lib",)]:
+            self.assertFalse(os.path.lexists(self.path(*name)), name)
+
+    def testUpgrade(self):
+        a1 = { "id": "A", "version": "1.0", "type": "Vsix", "payloads": [self.payload("a1.vsix", { "VC/Tools/MSVC/1.0/include/a.h": b"a1" })] }
+        a2 = { "id": "A", "version": "2.0", "type": "Vsix", "payloads": [self.payload("a2.vsix", { "VC/Tools/MSVC/2.0/include/a.h": b"a2" })] }
+        b = { "id": "B", "version": "1.0", "type": "Vsix", "payloads": [self.payload("b.vsix", { "VC/Auxiliary/b.txt": b"b" })] }
+        self.install([a1, b], "--incremental")
+        output = self.install([a2, b], "--incremental")
+        self.assertIn("1 packages already installed, 1 packages to install", output)
+        self.assertFalse(os.path.lexists(self.path("1.0")))
+        with open(self.path("2.0", "include", "a.h"), "rb") as f:
+            self.assertEqual(f.read(), b"a2")
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "VC", "Auxiliary", "b.txt")))
+        # Reinstalling an unchanged set doesn't extract anything.
+        output = self.install([a2, b], "--incremental")
+        self.assertIn("2 packages already installed, 0 packages to install", output)
+
+    def testNotIncremental(self):
+        a = { "id": "A", "version": "1.0", "type": "Vsix", "payloads": [self.payload("a.vsix", { "VC/Tools/MSVC/1.0/include/a.h": b"a" })] }
+        state = vsdownload.getInstallStateFile(self.dest)
+        self.install([a])
+        self.assertTrue(os.path.isfile(self.path("1.0", "include", "a.h")))
+        self.assertFalse(os.path.exists(state))
+        self.install([a], "--incremental")
+        self.assertTrue(os.path.exists(state))
+        # The files installed without --incremental aren't tracked.
+        self.install([a])
+        self.assertFalse(os.path.exists(state))
+
+class SDKInstallersTest(unittest.TestCase):
+    # The tables of the MSIs, as (columns with their types, keys, rows).
+    tables = {
+        "Directory": ([("Directory", "s72"), ("Directory_Parent", "S72"), ("DefaultDir", "l255")], ["Directory"]),
+        "Component": ([("Component", "s72"), ("ComponentId", "S38"), ("Directory_", "s72"), ("Attributes", "i2"), ("Condition", "S255"), ("KeyPath", "S72")], ["Component"]),
+        "File": ([("File", "s72"), ("Component_", "s72"), ("FileName", "l255"), ("FileSize", "i4"), ("Version", "S72"), ("Language", "S20"), ("Attributes", "I2"), ("Sequence", "i2")], ["File"]),
+        "Media": ([("DiskId", "i2"), ("LastSequence", "i2"), ("DiskPrompt", "L64"), ("Cabinet", "S255"), ("VolumeLabel", "S32"), ("Source", "S72")], ["DiskId"]),
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="msvc-wine.vsdownload.")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = os.path.join(self.dir, "cache")
+        names = ["Installers\\Kits.msi", "Installers\\kits1.cab", "Installers\\Other.msi", "Installers\\other1.cab", "Installers\\unused.cab", "winsdksetup.exe"]
+        self.package = vsdownload.Package({ "id": "Win11SDK_10.0.26100", "version": "10.0.26100.1", "type": "Exe", "payloads": [{ "fileName": name, "size": 10 } for name in names] })
+        os.makedirs(os.path.join(self.cache, vsdownload.getPackageKey(self.package)))
+        # Kits.msi installs a header into Windows Kits, from an external and
+        # an embedded cabinet; Other.msi only installs outside of the kept
+        # components.
+        self.msis = {
+            "Kits.msi": {
+                "Directory": [["TARGETDIR", "", "SourceDir"], ["ProgramFilesFolder", "TARGETDIR", "."], ["KitsDir", "ProgramFilesFolder", "WINDOW~1|Windows Kits"], ["TenDir", "KitsDir", "10"], ["IncludeDir", "TenDir", "Include"]],
+                "Component": [["Headers", "{11111111-1111-1111-1111-111111111111}", "IncludeDir", "0", "", "a.h"]],
+                "File": [["a.h", "Headers", "a.h", "1", "", "", "", "1"], ["b.h", "Headers", "b.h", "1", "", "", "", "2"]],
+                "Media": [["1", "1", "", "kits1.cab", "", ""], ["2", "2", "", "#embedded.cab", "", ""]],
+            },
+            "Other.msi": {
+                "Directory": [["TARGETDIR", "", "SourceDir"], ["ProgramFilesFolder", "TARGETDIR", "."], ["SDKsDir", "ProgramFilesFolder", "MICROS~1|Microsoft SDKs"]],
+                "Component": [["Tools", "{22222222-2222-2222-2222-222222222222}", "SDKsDir", "0", "", "tool.exe"]],
+                "File": [["tool.exe", "Tools", "tool.exe", "1", "", "", "", "1"]],
+                "Media": [["1", "1", "", "other1.cab", "", ""]],
+            },
+        }
+
+    def select(self):
+        downloaded = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected = vsdownload.selectSDKInstallers([self.package], self.cache, vsdownload.getVCSDKComponents(), downloaded.extend)
+        self.assertEqual([[vsdownload.getPayloadName(payload) for payload in p["payloads"]] for p in downloaded], [["Kits.msi", "Other.msi"]])
+        return [payload["fileName"] for payload in selected[0]["payloads"]]
+
+    @unittest.skipUnless(shutil.which("msibuild") and shutil.which("msiinfo"), "msitools isn't installed")
+    def testMsiTables(self):
+        for name, tables in self.msis.items():
+            idts = []
+            for table, rows in tables.items():
+                columns, keys = self.tables[table]
+                idt = os.path.join(self.dir, table + ".idt")
+                with open(idt, "w", newline="\r\n") as f:
+                    f.write("\t".join(c for c, t in columns) + "\n")
+                    f.write("\t".join(t for c, t in columns) + "\n")
+                    f.write("\t".join([table] + keys) + "\n")
+                    for row in rows:
+                        f.write("\t".join(row) + "\n")
+                idts.append(idt)
+            msi = os.path.join(self.cache, vsdownload.getPackageKey(self.package), name)
+            subprocess.run(["msibuild", msi, "-s", name, "msvc-wine", "Intel;1033", "{33333333-3333-3333-3333-333333333333}", "-i"] + idts, check=True)
+        self.assertEqual(vsdownload.getMsiCabinets(os.path.join(self.cache, vsdownload.getPackageKey(self.package), "Kits.msi")), ["kits1.cab"])
+        self.assertEqual(self.select(), ["Installers\\Kits.msi", "Installers\\kits1.cab", "winsdksetup.exe"])
+
+    def readTable(self, msi, table):
+        columns, keys = self.tables[table]
+        return [dict(zip([c for c, t in columns], row)) for row in self.msis[os.path.basename(msi)][table]]
+
+    def testSelection(self):
+        with unittest.mock.patch.object(vsdownload.shutil, "which", return_value="msiinfo"), \
+             unittest.mock.patch.object(vsdownload, "readMsiTable", self.readTable):
+            self.assertEqual(self.select(), ["Installers\\Kits.msi", "Installers\\kits1.cab", "winsdksetup.exe"])
+
+    def testReadTable(self):
+        # As exported by msiinfo, with a trailing empty nullable column.
+        output = "DiskId\tLastSequence\tDiskPrompt\tCabinet\tVolumeLabel\tSource\ni2\ti2\tL64\tS255\tS32\tS72\nMedia\tDiskId\n1\t1\t\tkits1.cab\t\t\n2\t2\t\t#embedded.cab\n"
+        with unittest.mock.patch.object(vsdownload.subprocess, "run", return_value=subprocess.CompletedProcess([], 0, output)):
+            rows = vsdownload.readMsiTable("Kits.msi", "Media")
+            self.assertEqual(vsdownload.getMsiCabinets("Kits.msi"), ["kits1.cab"])
+        self.assertEqual(rows[1], { "DiskId": "2", "LastSequence": "2", "DiskPrompt": "", "Cabinet": "#embedded.cab", "VolumeLabel": "", "Source": "" })
+
+    def testUnreadableTables(self):
+        # If the tables of an MSI can't be read, it and all the cabinets
+        # are kept.
+        def readTable(msi, table):
+            if os.path.basename(msi) == "Other.msi":
+                raise subprocess.CalledProcessError(1, ["msiinfo"])
+            return self.readTable(msi, table)
+        with unittest.mock.patch.object(vsdownload.shutil, "which", return_value="msiinfo"), \
+             unittest.mock.patch.object(vsdownload, "readMsiTable", readTable):
+            self.assertEqual(self.select(), [payload["fileName"] for payload in self.package["payloads"]])
+
+class DependsTreeTest(unittest.TestCase):
+    def setUp(self):
+        manifest = [
+            { "id": "Top", "version": "1.0", "dependencies": { "Left": "1.0", "Right": "1.0" } },
+            { "id": "Left", "version": "1.0", "dependencies": { "Shared": "1.0" } },
+            { "id": "Right", "version": "1.0", "dependencies": { "Shared": "1.0", "Top": { "version": "1.0", "type": "Recommended" } } },
+            { "id": "Shared", "version": "1.0", "dependencies": { "Leaf": "1.0", "Missing": "1.0" } },
+            { "id": "Leaf", "version": "1.0" },
+        ]
+        packages = vsdownload.getPackages([vsdownload.Package(p) for p in manifest], "x64")
+        args = vsdownload.getArgsParser().parse_args([])
+        args.host_arch = "x64"
+        args.architecture = ["x64"]
+        args.ignore = []
+        self.graph = vsdownload.DependencyGraph(packages, args)
+
+    def output(self, f, target):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            f(target)
+        return output.getvalue().splitlines()
+
+    def testDepends(self):
+        # A shared package is only expanded once.
+        self.assertEqual(self.output(self.graph.printDepends, "Top"), [
+            "Top",
+            "  Left",
+            "    Shared",
+            "      Leaf",
+            "      Missing (NotFound)",
+            "  Right",
+            "    Shared (see above)",
+            "    Top (Recommended) (Cycle)",
+        ])
+
+    def testReverseDepends(self):
+        self.assertEqual(self.output(self.graph.printReverseDepends, "Leaf"), [
+            "Leaf",
+            "  Shared",
+            "    Left",
+            "      Top",
+            "        Right (Recommended)",
+            "          Top (Cycle)",
+            "    Right (see above)",
+        ])
+
+class ResumeTest(ServerTestCase):
+    # The server drops the connection after part of the first response for
+    # each file; the download is then resumed, or restarted if the server
+    # ignores the range request. Over urllib and over reused connections.
+    size = 300000
+    dropAfter = 100000
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(self.size)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.url = self.serve("payload.vsix", self.data)
+        self.file = os.path.join(self.dir, "payload.vsix.part")
+        self.server.dropAfter = self.dropAfter
+
+    def getConnections(self):
+        pool = vsdownload.ConnectionPool()
+        self.addCleanup(pool.close)
+        return [("urllib", None), ("pooled", pool)]
+
+    def interrupt(self, connections, state):
+        with self.assertRaises(vsdownload.urllib.error.ContentTooShortError):
+            vsdownload.downloadFile(self.url, self.file, self.size, self.sha256, state, connections)
+        self.assertEqual(os.path.getsize(self.file), self.dropAfter)
+
+    def check(self, digest, status, sent):
+        self.assertEqual(digest, self.sha256)
+        with open(self.file, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        last = self.server.requests("payload.vsix")[-1]
+        self.assertEqual(last["status"], status)
+        self.assertEqual(last["sent"], sent)
+
+    def reset(self):
+        vsdownload.removePartialFile(self.file)
+        self.server.dropped.clear()
+        self.server.log.clear()
+
+    def testResume(self):
+        for name, connections in self.getConnections():
+            with self.subTest(name):
+                state = {}
+                self.interrupt(connections, state)
+                digest = vsdownload.downloadFile(self.url, self.file, self.size, self.sha256, state, connections)
+                self.check(digest, 206, self.size - self.dropAfter)
+                self.assertEqual(self.server.requests("payload.vsix")[-1]["headers"].get("Range"), "bytes=%d-" % (self.dropAfter))
+                self.reset()
+
+    def testResumeInNewProcess(self):
+        # Without the hash state of the interrupted download, the partial
+        # file is hashed again.
+        for name, connections in self.getConnections():
+            with self.subTest(name):
+                self.interrupt(connections, {})
+                digest = vsdownload.downloadFile(self.url, self.file, self.size, self.sha256, {}, connections)
+                self.check(digest, 206, self.size - self.dropAfter)
+                self.reset()
+
+    def testRangeIgnored(self):
+        self.server.ignoreRange = True
+        for name, connections in self.getConnections():
+            with self.subTest(name):
+                state = {}
+                self.interrupt(connections, state)
+                digest = vsdownload.downloadFile(self.url, self.file, self.size, self.sha256, state, connections)
+                self.check(digest, 200, self.size)
+                self.reset()
+
+    def testOtherFileNotResumed(self):
+        # A partial file for another expected hash is downloaded again.
+        self.interrupt(None, {})
+        other = hashlib.sha256(b"other").hexdigest()
+        vsdownload.downloadFile(self.url, self.file, self.size, other, {}, None)
+        self.assertNotIn("Range", self.server.requests("payload.vsix")[-1]["headers"])
+
+    def testDownloadPayload(self):
+        # The retries of a payload resume it.
+        payload = { "url": self.url, "size": self.size, "sha256": self.sha256.upper() }
+        dest = os.path.join(self.dir, "payload.vsix")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(vsdownload._downloadPayload(payload, dest, "payload.vsix", False, None), (self.size, True))
+        self.assertIn("Resuming payload.vsix", output.getvalue())
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(self.file))
+        self.assertFalse(os.path.exists(self.file + ".json"))
+        self.assertEqual([r["status"] for r in self.server.requests("payload.vsix")], [200, 206])
+
+if __name__ == "__main__":
+    # Connect to the local server directly.
+    for k in ["http_proxy", "HTTP_PROXY", "all_proxy", "ALL_PROXY"]:
+        os.environ.pop(k, None)
+    socket.setdefaulttimeout(15)
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+. "${0%/*}/test.sh"
+
+# Keep the scratch files (response files and outputs) in a temporary
+# directory of our own, regardless of where this is run from.
+SCRATCH=$(mktemp -d -t msvc-wine-msvc.XXXX) || exit 1
+trap "rm -rf '$SCRATCH' '$CWD'" EXIT
+cd "$SCRATCH"
+CWD=$SCRATCH/
+
+# A stand-in for Wine, printing the arguments and the contents of the
+# response files it gets.
+mkdir bin
+cat >bin/wine64 <<'EOF'
+#!/usr/bin/env bash
+shift
+for a; do
+    case "$a" in
+    @z:*) echo "@"; cat "${a#@z:}" ;;
+    *) echo "$a" ;;
+    esac
+done
+EOF
+chmod +x bin/wine64
+export PATH=${CWD}bin:$PATH
+export WINE_MSVC_RAW_STDOUT=1
+export WINE_MSVC_SERVER=${CWD}server
+
+mkdir -p dir/sub
+
+
+EXEC args ${TESTS}../wrappers/wine-msvc.sh cl.exe /nologo ${CWD}dir/a.c -I${CWD}dir \
+    -I${CWD}missing/dir /Fo${CWD}dir/ -MANIFESTINPUT:${CWD}dir/a.manifest \
+    /tmp / rel/b.c /DX=${CWD}dir "${CWD}dir/[a] b.c"
+DIFF args.out - <<EOF
+/nologo
+z:${CWD}dir/a.c
+-Iz:${CWD}dir
+-I${CWD}missing/dir
+/Foz:${CWD}dir/
+-MANIFESTINPUT:z:${CWD}dir/a.manifest
+/tmp
+/
+rel/b.c
+/DX=${CWD}dir
+z:${CWD}dir/[a] b.c
+EOF
+
+
+# Response files get the same rewrites, in a copy of the file.
+printf '%s\r\n' "/nologo ${CWD}dir/a.obj  rel.obj" "\"${CWD}dir/a b.obj\" /OUT:\"${CWD}dir/o.exe\"" \
+    'x\\"y z" \"q\\ t\\' > a.rsp
+printf '%s\n' "/nologo rel.obj" > rel.rsp
+EXEC rsp ${TESTS}../wrappers/wine-msvc.sh link.exe @a.rsp @rel.rsp
+DIFF rsp.out - <<EOF
+@
+/nologo
+z:${CWD}dir/a.obj
+rel.obj
+"z:${CWD}dir/a b.obj"
+/OUT:z:${CWD}dir/o.exe
+"x\\y z"
+"\"q\\\\\\\\"
+t\\\\
+@rel.rsp
+EOF
+
+
+# With msvctricks, which the stand-in for Wine runs like any other tool,
+# WINE_MSVC_STDOUT_SED and WINE_MSVC_STDERR_SED still are applied for the
+# outputs that have no rules for msvctricks.
+mkdir -p tricks/bin/x64
+cp ${TESTS}../wrappers/wine-msvc.sh tricks/bin/x64/
+touch tricks/bin/msvctricks.exe
+EXEC sed env -u WINE_MSVC_RAW_STDOUT WINE_MSVC_STDOUT_SED='s/nologo/NOLOGO/' \
+    ${TESTS}../wrappers/wine-msvc.sh link.exe /nologo
+DIFF sed.out - <<EOF
+/NOLOGO
+EOF
+EXEC sed env -u WINE_MSVC_RAW_STDOUT WINE_MSVC_STDOUT_SED='s/nologo/NOLOGO/' \
+    tricks/bin/x64/wine-msvc.sh link.exe /nologo
+DIFF sed.out - <<EOF
+link.exe
+/NOLOGO
+EOF
+EXEC rules env -u WINE_MSVC_RAW_STDOUT WINE_MSVC_STDOUT_SED='s/nologo/NOLOGO/' \
+    WINE_MSVC_STDOUT_RULES=line tricks/bin/x64/wine-msvc.sh link.exe /nologo
+DIFF rules.out - <<EOF
+link.exe
+/nologo
+EOF
+
+
+# Huge argument lists, like for linking thousands of object files.
+args=()
+for i in $(seq 5000); do
+    args+=(${CWD}dir/sub/obj$i.obj)
+done
+printf '%s\n' "${args[@]}" > big.rsp
+
+EXEC big-args ${TESTS}../wrappers/wine-msvc.sh link.exe "${args[@]}"
+EXEC big-rsp ${TESTS}../wrappers/wine-msvc.sh link.exe @big.rsp
+EXEC "" test $(grep -c "^z:${CWD}dir/sub/obj[0-9]*\.obj$" big-args.out) -eq 5000
+EXEC "" test $(grep -c "^z:${CWD}dir/sub/obj[0-9]*\.obj$" big-rsp.out) -eq 5000
+
+TIMEFORMAT=%R
+secs=$( { time ${TESTS}../wrappers/wine-msvc.sh link.exe "${args[@]}" >/dev/null; } 2>&1 )
+echo "5000 arguments: $secs s"
+EXEC "" awk -v secs=$secs 'BEGIN { exit !(secs < 5) }'
+
+
+EXIT
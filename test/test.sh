@@ -85,6 +85,10 @@ else
     cd "$CWD"
 fi
 
+EXEC "" ./test-fixinclude.sh
+EXEC "" ./test-wine-msvc.sh
+EXEC "" ./test-vsdownload.py
+
 for arch in x86 x64 arm arm64; do
     BIN="${1:-/opt/msvc}/bin/$arch/"
     if [ ! -d "$BIN" ]; then
@@ -97,6 +101,10 @@ for arch in x86 x64 arm arm64; do
 
     EXEC "" BIN=$BIN ./test-cl.sh
     EXEC "" BIN=$BIN ./test-mt.sh
+    EXEC "" BIN=$BIN ./test-cl-cache.sh
+    if [ -f "${BIN}../msvctricks.exe" ]; then
+        EXEC "" BIN=$BIN ./test-msvctricks-server.sh
+    fi
     EXEC "" BIN=$BIN ./test-dumpbin.sh
     EXEC "" BIN=$BIN ./test-asm.sh
     EXEC "" BIN=$BIN ./test-midl.sh
@@ -15,19 +15,31 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import argparse
+import codecs
+import contextlib
+import copy
 import functools
 import glob
 import hashlib
+import http.client
+import io
 import os
 import multiprocessing.pool
 import json
 import platform
+import queue
 import re
 import shutil
 import socket
+import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
 import xml.etree.ElementTree as ET
 import zipfile
@@ -65,6 +77,13 @@ def getArgsParser():
     parser.add_argument("--major", default=18, type=int, metavar="version", help="The major version to download (defaults to 18)")
     parser.add_argument("--preview", const=True, action="store_const", help="Download the preview version instead of the release version")
     parser.add_argument("--cache", metavar="dir", help="Directory to use as a persistent cache for downloaded files")
+    parser.add_argument("--manifest-max-age", metavar="seconds", type=int, help="Use a channel manifest from the cache without revalidating it, if it was fetched less than this many seconds ago")
+    parser.add_argument("--cache-by-hash", const=True, action="store_const", help="Store downloaded files in the cache by their hash, sharing identical files between packages")
+    parser.add_argument("--cache-max-size", metavar="size", type=parseSize, help="Remove the least recently used files stored by hash, that aren't needed for the current selection, to keep the cache within this size (e.g. 20G)")
+    parser.add_argument("--cache-gc", const=True, action="store_const", help="Remove all files stored by hash that aren't needed for the current selection from the cache, then exit")
+    parser.add_argument("--paranoid", const=True, action="store_const", help="Verify the hashes of all existing files in the cache, even if they have been verified before")
+    parser.add_argument("--jobs", metavar="n", type=int, default=5, help="Number of files to download in parallel (defaults to 5)")
+    parser.add_argument("--jobs-per-host", metavar="n", type=int, help="Maximum number of parallel downloads from a single host")
     parser.add_argument("--dest", metavar="dir", help="Directory to install into")
     parser.add_argument("package", metavar="package", help="Package to install. If omitted, installs the default command line tools.", nargs="*")
     parser.add_argument("--ignore", metavar="component", help="Package to skip", action="append")
@@ -77,11 +96,21 @@ def getArgsParser():
     parser.add_argument("--skip-recommended", const=True, action="store_const", help="Don't include recommended dependencies")
     parser.add_argument("--print-deps-tree", const=True, action="store_const", help="Print a tree of resolved dependencies for the given selection")
     parser.add_argument("--print-reverse-deps", const=True, action="store_const", help="Print a tree of packages that depend on the given selection")
+    parser.add_argument("--print-deps-graph", metavar="format", choices=["json", "dot"], help="Print the resolved dependency graph for the given selection, in json or dot format")
     parser.add_argument("--print-selection", const=True, action="store_const", help="Print a list of the individual packages that are selected to be installed")
     parser.add_argument("--only-download", const=True, action="store_const", help="Stop after downloading package files")
+    parser.add_argument("--unpack-jobs", metavar="n", type=int, default=os.cpu_count(), help="Number of packages and installers to unpack in parallel (defaults to the number of CPUs)")
+    parser.add_argument("--pipeline", const=True, action="store_const", help="Unpack packages while the rest of the packages are being downloaded")
     parser.add_argument("--only-unpack", const=True, action="store_const", help="Unpack the selected packages and keep all files, in the layout they are unpacked, don't restructure and prune files other than what's needed for MSVC CLI tools")
     parser.add_argument("--keep-unpack", const=True, action="store_const", help="Keep the unpacked files that aren't otherwise selected as needed output")
-    parser.add_argument("--msvc-version", metavar="version", help="Install a specific MSVC toolchain version")
+    parser.add_argument("--incremental", const=True, action="store_const", help="Record which files each package installs into the destination directory, and if it already has such a record, only install the packages that changed and remove the files of the ones that no longer are selected")
+    parser.add_argument("--full-install", const=True, action="store_const", help="With --incremental, extract all selected packages, even if they already are installed in the destination directory")
+    parser.add_argument("--dedupe", metavar="mode", nargs="?", const="hardlink", choices=["hardlink", "reflink"], help="Replace identical files in the destination with hardlinks (the default) or reflinks, after installing")
+    parser.add_argument("--dedupe-dry-run", const=True, action="store_const", help="Only report how much space --dedupe would save, without changing any files")
+    parser.add_argument("--export-layout", metavar="file", help="Pack the destination directory, after running install.sh in it, into an archive that can be installed elsewhere with --import-layout")
+    parser.add_argument("--import-layout", metavar="file", help="Install the toolchain from an archive written with --export-layout into the destination directory, instead of downloading it")
+    parser.add_argument("--timings", metavar="file", help="Write the time spent on each phase, package and payload to a file, in the Chrome trace event format, and print a summary of the slowest packages")
+    parser.add_argument("--msvc-version", metavar="version", help="Install specific MSVC toolchain versions, side by side", nargs="+")
     parser.add_argument("--sdk-version", metavar="version", help="Install a specific Windows SDK version")
     parser.add_argument("--architecture", metavar="arch", choices=["host", "x86", "x64", "arm", "arm64"], help="Target architectures to include (defaults to all)", nargs="+")
     parser.add_argument("--with-wdk-installers", metavar="dir", help="Install Windows Driver Kit using the provided MSI installers")
@@ -104,8 +133,7 @@ def setPackageSelectionMSVC16(args, packages, userversion, sdk, toolversion, def
             args.package.append("Microsoft.VisualStudio.Component.VC." + toolversion + ".ARM64")
             args.package.append("Microsoft.VisualStudio.Component.VC." + toolversion + ".ATL.ARM64")
 
-        if args.sdk_version == None:
-            args.sdk_version = sdk
+        return sdk
     else:
         # Options for toolchains for specific versions. The latest version in
         # each manifest isn't available as a pinned version though, so if that
@@ -123,6 +151,88 @@ def setPackageSelectionMSVC15(args, packages, userversion, sdk, toolversion, def
         print("Didn't find exact version packages for " + userversion + ", assuming this is provided by the default/latest version")
         args.package.extend(defaultPackages)
 
+def setPackageSelectionVersion(args, packages, version, defaultPackages):
+    # Select the packages for one toolchain version, returning the SDK
+    # version to use with it, if any.
+
+    # Note, that in the manifest for MSVC version X.Y, only version X.Y-1
+    # exists with a package name like "Microsoft.VisualStudio.Component.VC."
+    # + toolversion + ".x86.x64".
+    if version == "preview":
+        return setPackageSelectionMSVC16(args, packages, version, None, "Preview", defaultPackages)
+    elif version == "16.0":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.17763", "14.20", defaultPackages)
+    elif version == "16.1":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.21", defaultPackages)
+    elif version == "16.2":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.22", defaultPackages)
+    elif version == "16.3":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.23", defaultPackages)
+    elif version == "16.4":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.24", defaultPackages)
+    elif version == "16.5":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.25", defaultPackages)
+    elif version == "16.6":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.26", defaultPackages)
+    elif version == "16.7":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.27", defaultPackages)
+    elif version == "16.8":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.18362", "14.28", defaultPackages)
+    elif version == "16.9":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.19041", "14.28.16.9", defaultPackages)
+    elif version == "16.10":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.19041", "14.29.16.10", defaultPackages)
+    elif version == "16.11":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.19041", "14.29.16.11", defaultPackages)
+    elif version == "17.0":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.19041", "14.30.17.0", defaultPackages)
+    elif version == "17.1":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.19041", "14.31.17.1", defaultPackages)
+    elif version == "17.2":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.19041", "14.32.17.2", defaultPackages)
+    elif version == "17.3":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.19041", "14.33.17.3", defaultPackages)
+    elif version == "17.4":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.34.17.4", defaultPackages)
+    elif version == "17.5":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.35.17.5", defaultPackages)
+    elif version == "17.6":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.36.17.6", defaultPackages)
+    elif version == "17.7":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.37.17.7", defaultPackages)
+    elif version == "17.8":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.38.17.8", defaultPackages)
+    elif version == "17.9":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.39.17.9", defaultPackages)
+    elif version == "17.10":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.40.17.10", defaultPackages)
+    elif version == "17.11":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.41.17.11", defaultPackages)
+    elif version == "17.12":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.42.17.12", defaultPackages)
+    elif version == "17.13":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.22621", "14.43.17.13", defaultPackages)
+    elif version == "17.14":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.26100", "14.44.17.14", defaultPackages)
+    elif version == "18.0":
+        return setPackageSelectionMSVC16(args, packages, version, "10.0.26100", "14.50.18.0", defaultPackages)
+
+    elif version == "15.4":
+        return setPackageSelectionMSVC15(args, packages, version, "10.0.16299", "14.11", defaultPackages)
+    elif version == "15.5":
+        return setPackageSelectionMSVC15(args, packages, version, "10.0.16299", "14.12", defaultPackages)
+    elif version == "15.6":
+        return setPackageSelectionMSVC15(args, packages, version, "10.0.16299", "14.13", defaultPackages)
+    elif version == "15.7":
+        return setPackageSelectionMSVC15(args, packages, version, "10.0.17134", "14.14", defaultPackages)
+    elif version == "15.8":
+        return setPackageSelectionMSVC15(args, packages, version, "10.0.17134", "14.15", defaultPackages)
+    elif version == "15.9":
+        return setPackageSelectionMSVC15(args, packages, version, "10.0.17763", "14.16", defaultPackages)
+    else:
+        print("Unsupported MSVC toolchain version " + version)
+        sys.exit(1)
+
 def setPackageSelection(args, packages):
     if not args.architecture:
         args.architecture = ["host", "x86", "x64", "arm", "arm64"]
@@ -141,88 +251,20 @@ def setPackageSelection(args, packages):
         defaultPackages.append("Microsoft.VisualStudio.Component.VC.Tools.ARM64")
         defaultPackages.append("Microsoft.VisualStudio.Component.VC.ATL.ARM64")
 
-    # Note, that in the manifest for MSVC version X.Y, only version X.Y-1
-    # exists with a package name like "Microsoft.VisualStudio.Component.VC."
-    # + toolversion + ".x86.x64".
-    if args.msvc_version == "preview":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, None, "Preview", defaultPackages)
-    elif args.msvc_version == "16.0":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.17763", "14.20", defaultPackages)
-    elif args.msvc_version == "16.1":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.21", defaultPackages)
-    elif args.msvc_version == "16.2":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.22", defaultPackages)
-    elif args.msvc_version == "16.3":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.23", defaultPackages)
-    elif args.msvc_version == "16.4":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.24", defaultPackages)
-    elif args.msvc_version == "16.5":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.25", defaultPackages)
-    elif args.msvc_version == "16.6":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.26", defaultPackages)
-    elif args.msvc_version == "16.7":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.27", defaultPackages)
-    elif args.msvc_version == "16.8":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.18362", "14.28", defaultPackages)
-    elif args.msvc_version == "16.9":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.19041", "14.28.16.9", defaultPackages)
-    elif args.msvc_version == "16.10":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.19041", "14.29.16.10", defaultPackages)
-    elif args.msvc_version == "16.11":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.19041", "14.29.16.11", defaultPackages)
-    elif args.msvc_version == "17.0":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.19041", "14.30.17.0", defaultPackages)
-    elif args.msvc_version == "17.1":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.19041", "14.31.17.1", defaultPackages)
-    elif args.msvc_version == "17.2":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.19041", "14.32.17.2", defaultPackages)
-    elif args.msvc_version == "17.3":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.19041", "14.33.17.3", defaultPackages)
-    elif args.msvc_version == "17.4":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.34.17.4", defaultPackages)
-    elif args.msvc_version == "17.5":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.35.17.5", defaultPackages)
-    elif args.msvc_version == "17.6":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.36.17.6", defaultPackages)
-    elif args.msvc_version == "17.7":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.37.17.7", defaultPackages)
-    elif args.msvc_version == "17.8":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.38.17.8", defaultPackages)
-    elif args.msvc_version == "17.9":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.39.17.9", defaultPackages)
-    elif args.msvc_version == "17.10":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.40.17.10", defaultPackages)
-    elif args.msvc_version == "17.11":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.41.17.11", defaultPackages)
-    elif args.msvc_version == "17.12":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.42.17.12", defaultPackages)
-    elif args.msvc_version == "17.13":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.22621", "14.43.17.13", defaultPackages)
-    elif args.msvc_version == "17.14":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.26100", "14.44.17.14", defaultPackages)
-    elif args.msvc_version == "18.0":
-        setPackageSelectionMSVC16(args, packages, args.msvc_version, "10.0.26100", "14.50.18.0", defaultPackages)
-
-    elif args.msvc_version == "15.4":
-        setPackageSelectionMSVC15(args, packages, args.msvc_version, "10.0.16299", "14.11", defaultPackages)
-    elif args.msvc_version == "15.5":
-        setPackageSelectionMSVC15(args, packages, args.msvc_version, "10.0.16299", "14.12", defaultPackages)
-    elif args.msvc_version == "15.6":
-        setPackageSelectionMSVC15(args, packages, args.msvc_version, "10.0.16299", "14.13", defaultPackages)
-    elif args.msvc_version == "15.7":
-        setPackageSelectionMSVC15(args, packages, args.msvc_version, "10.0.17134", "14.14", defaultPackages)
-    elif args.msvc_version == "15.8":
-        setPackageSelectionMSVC15(args, packages, args.msvc_version, "10.0.17134", "14.15", defaultPackages)
-    elif args.msvc_version == "15.9":
-        setPackageSelectionMSVC15(args, packages, args.msvc_version, "10.0.17763", "14.16", defaultPackages)
-    elif args.msvc_version != None:
-        print("Unsupported MSVC toolchain version " + args.msvc_version)
-        sys.exit(1)
+    # Multiple toolchain versions are installed side by side, sharing one
+    # Windows SDK; the newest of the ones they would use by default.
+    sdks = []
+    for version in args.msvc_version or []:
+        sdk = setPackageSelectionVersion(args, packages, version, defaultPackages)
+        if sdk != None:
+            sdks.append(sdk)
+    if args.sdk_version == None and len(sdks) > 0:
+        args.sdk_version = max(sdks, key=lambda v: [int(i) for i in v.split(".")])
 
     if len(args.package) == 0:
         args.package = defaultPackages
 
-    if args.msvc_version == "preview" and args.sdk_version is None:
+    if args.msvc_version != None and "preview" in args.msvc_version and args.sdk_version is None:
         # Find which SDK the workload would include, even the whole workload might not be installd.
         # Temporarily backup and overwrite args variables for a call to getSelectedPackages.
         package = args.package
@@ -275,7 +317,70 @@ def lowercaseIgnores(args):
             ignore.append(i.lower())
     args.ignore = ignore
 
-def getManifest(args):
+def readFile(file):
+    with open(file, "rb") as f:
+        return f.read()
+
+def writeFileAtomic(file, data):
+    tmp = file + ".tmp%d" % (os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, file)
+
+def getManifestCacheDir(args):
+    if args.cache == None:
+        return None
+    dir = os.path.join(os.path.abspath(args.cache), "manifests")
+    makedirs(dir)
+    return dir
+
+def cachedUrlopen(url, cachedir, maxAge=None, sha256=None):
+    # Fetch a URL, keeping the body and its validators in cachedir. A cached
+    # body is used as is if it matches the expected sha256 or is younger than
+    # maxAge seconds; otherwise it is revalidated with a conditional request.
+    if cachedir == None:
+        return urllib.request.urlopen(url).read()
+    name = os.path.join(cachedir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+    meta = None
+    if os.path.isfile(name + ".data"):
+        try:
+            with open(name + ".json", "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+    if meta != None:
+        if sha256 != None and meta.get("sha256", "").lower() == sha256.lower():
+            return readFile(name + ".data")
+        if maxAge != None and time.time() - meta.get("fetched", 0) < maxAge:
+            return readFile(name + ".data")
+    request = urllib.request.Request(url)
+    if meta != None:
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("lastModified"):
+            request.add_header("If-Modified-Since", meta["lastModified"])
+    try:
+        with urllib.request.urlopen(request) as response:
+            data = response.read()
+            headers = response.headers
+        writeFileAtomic(name + ".data", data)
+        meta = {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "lastModified": headers.get("Last-Modified"),
+            "sha256": hashlib.sha256(data).hexdigest(),
+        }
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or meta == None:
+            raise
+        data = readFile(name + ".data")
+    meta["fetched"] = time.time()
+    writeFileAtomic(name + ".json", json.dumps(meta).encode("utf-8"))
+    return data
+
+def getManifestData(args):
+    cachedir = getManifestCacheDir(args)
+    sha256 = None
     if args.manifest == None:
         if args.major < 18:
             type = "release"
@@ -288,37 +393,64 @@ def getManifest(args):
                 type = "insiders"
         url = "https://aka.ms/vs/%s/%s/channel" % (args.major, type)
         print("Fetching %s" % (url))
-        manifest = json.loads(urllib.request.urlopen(url).read())
+        manifest = json.loads(cachedUrlopen(url, cachedir, maxAge=args.manifest_max_age))
         print("Got toplevel manifest for %s" % (manifest["info"]["productDisplayVersion"]))
         for item in manifest["channelItems"]:
             if "type" in item and item["type"] == "Manifest":
                 args.manifest = item["payloads"][0]["url"]
+                sha256 = item["payloads"][0].get("sha256")
         if args.manifest == None:
             print("Unable to find an intaller manifest!")
             sys.exit(1)
 
     if not args.manifest.startswith("http"):
-        args.manifest = "file:" + args.manifest
+        return urllib.request.urlopen("file:" + args.manifest).read()
 
-    manifestdata = urllib.request.urlopen(args.manifest).read()
-    manifest = json.loads(manifestdata)
-    print("Loaded installer manifest for %s" % (manifest["info"]["productDisplayVersion"]))
+    return cachedUrlopen(args.manifest, cachedir, sha256=sha256)
 
-    if args.save_manifest:
-        filename = "%s.manifest" % (manifest["info"]["productDisplayVersion"])
-        if os.path.isfile(filename):
-            oldfile = open(filename, "rb").read()
-            if oldfile != manifestdata:
-                print("Old saved manifest in \"%s\" differs from newly downloaded one, not overwriting!" % (filename))
-            else:
-                print("Old saved manifest in \"%s\" is still current" % (filename))
+def saveManifest(manifestdata, info):
+    filename = "%s.manifest" % (info["productDisplayVersion"])
+    if os.path.isfile(filename):
+        oldfile = open(filename, "rb").read()
+        if oldfile != manifestdata:
+            print("Old saved manifest in \"%s\" differs from newly downloaded one, not overwriting!" % (filename))
         else:
-            f = open(filename, "wb")
-            f.write(manifestdata)
-            f.close()
-            print("Saved installer manifest to \"%s\"" % (filename))
+            print("Old saved manifest in \"%s\" is still current" % (filename))
+    else:
+        f = open(filename, "wb")
+        f.write(manifestdata)
+        f.close()
+        print("Saved installer manifest to \"%s\"" % (filename))
+
+def loadPackages(args):
+    # The parsed, grouped and sorted packages are stored in the cache as
+    # JSON records, keyed by the record version, the manifest hash and host
+    # arch, to avoid redoing it on every run.
+    manifestdata = getManifestData(args)
+    cachedir = getManifestCacheDir(args)
+    compiled = None
+    info = None
+    if cachedir != None:
+        compiled = os.path.join(cachedir, "packages-v%d-%s-%s.json" % (Package.recordVersion, hashlib.sha256(manifestdata).hexdigest(), args.host_arch))
+        try:
+            with open(compiled, "r") as f:
+                index = json.load(f)
+            packages = { id: [packageFromRecord(r) for r in records] for id, records in index["packages"].items() }
+            info = index["info"]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            info = None
+    if info == None:
+        info, packages = parseManifest(manifestdata)
+        packages = getPackages(packages, args.host_arch)
+        if compiled != None:
+            index = { "info": info, "packages": { id: [p.getRecord() for p in l] for id, l in packages.items() } }
+            writeFileAtomic(compiled, json.dumps(index, separators=(",", ":")).encode("utf-8"))
+    print("Loaded installer manifest for %s" % (info["productDisplayVersion"]))
 
-    return manifest
+    if args.save_manifest:
+        saveManifest(manifestdata, info)
+
+    return packages
 
 def prioritizePackage(arch, a, b):
     def archOrd(k, x):
@@ -345,9 +477,183 @@ def prioritizePackage(arch, a, b):
             return 1
     return 0
 
-def getPackages(manifest, arch):
+class Package:
+    # A package of the installer manifest, with only the fields that are
+    # used here. The manifest has tens of thousands of packages, most of
+    # which never are selected, so the strings are interned (ids and
+    # versions recur in the dependencies of other packages), and the
+    # payloads are kept as JSON until they are needed. The fields are
+    # accessed like in the dicts of the manifest, e.g. p["id"],
+    # p.get("chip") or "language" in p.
+    __slots__ = ["id", "version", "type", "chip", "machineArch", "productArch", "language", "dependencies", "installSize", "license", "_payloads"]
+    strings = ["id", "version", "type", "chip", "machineArch", "productArch", "language"]
+    fields = frozenset(strings + ["dependencies", "installSize", "license", "payloads"])
+    # The version of the records from getRecord; it is part of the name of
+    # the package index in the cache, so bump it when the fields change.
+    recordVersion = 1
+
+    def __init__(self, p):
+        for k in Package.strings:
+            v = p.get(k)
+            setattr(self, k, sys.intern(v) if v != None else None)
+        self.dependencies = None
+        if p.get("dependencies"):
+            self.dependencies = { sys.intern(k): sys.intern(v) if isinstance(v, str) else v for k, v in p["dependencies"].items() }
+        self.installSize = sum(p["installSizes"].values()) if "installSizes" in p else None
+        self.license = None
+        for r in p.get("localizedResources", []):
+            if "license" in r:
+                self.license = r["license"]
+                break
+        self._payloads = json.dumps(p["payloads"], separators=(",", ":")) if "payloads" in p else None
+
+    @property
+    def payloads(self):
+        if isinstance(self._payloads, str):
+            self._payloads = json.loads(self._payloads)
+        return self._payloads
+
+    def get(self, k, default=None):
+        if k not in Package.fields:
+            return default
+        if k == "payloads":
+            return self.payloads if self._payloads != None else default
+        v = getattr(self, k)
+        return v if v != None else default
+
+    def __getitem__(self, k):
+        v = self.get(k)
+        if v == None:
+            raise KeyError(k)
+        return v
+
+    def __contains__(self, k):
+        return self.get(k) != None
+
+    def withPayloads(self, payloads):
+        # A copy of the package, with only some of its payloads.
+        p = copy.copy(self)
+        p._payloads = payloads
+        return p
+
+    def getRecord(self):
+        # The fields as a list of plain values, for storing in JSON.
+        payloads = self._payloads
+        if payloads != None and not isinstance(payloads, str):
+            payloads = json.dumps(payloads, separators=(",", ":"))
+        return [getattr(self, k) for k in Package.__slots__[:-1]] + [payloads]
+
+    def __repr__(self):
+        return "Package(%s)" % (getPackageKey(self))
+
+def packageFromRecord(record):
+    if not isinstance(record, list) or len(record) != len(Package.__slots__):
+        raise ValueError("Invalid package record")
+    p = Package.__new__(Package)
+    p.id, p.version, p.type, p.chip, p.machineArch, p.productArch, p.language, p.dependencies, p.installSize, p.license, p._payloads = record
+    # The dicts of dependencies are kept as loaded; the JSON decoder already
+    # shares equal keys within the index.
+    for k in Package.strings:
+        v = getattr(p, k)
+        if v != None:
+            setattr(p, k, sys.intern(v))
+    return p
+
+class ManifestReader:
+    # Decodes the manifest to text a chunk at a time, as it is parsed, and
+    # drops the text that has been parsed, so that the whole manifest never
+    # is kept as text at once.
+    whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, data, chunkSize):
+        self.data = memoryview(data)
+        self.chunkSize = chunkSize
+        self.read = 0
+        self.utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+        self.decoder = json.JSONDecoder()
+        self.text = ""
+        self.offset = 0
+
+    def more(self, size):
+        if self.read >= len(self.data):
+            return False
+        end = min(self.read + max(size, self.chunkSize), len(self.data))
+        self.text += self.utf8.decode(self.data[self.read:end], end == len(self.data))
+        self.read = end
+        return True
+
+    def peek(self, pos):
+        while pos >= len(self.text) and self.more(0):
+            pass
+        return self.text[pos:pos + 1]
+
+    def skip(self, pos, expected=None):
+        while True:
+            pos = self.whitespace.match(self.text, pos).end()
+            if pos < len(self.text) or not self.more(0):
+                break
+        if expected != None:
+            if self.peek(pos) != expected:
+                raise ValueError("Expected '%s' at offset %d of the installer manifest" % (expected, self.offset + pos))
+            pos = self.skip(pos + 1)
+        return pos
+
+    def value(self, pos):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, pos)
+                # A number may continue in the next chunk.
+                if end < len(self.text) or not self.more(0):
+                    return value, end
+            except json.JSONDecodeError:
+                # Read at least as much as there is of the value so far, to
+                # not parse a long value over and over.
+                if not self.more(len(self.text) - pos):
+                    raise
+
+    def drop(self, pos):
+        # Forget the text before pos, once there is enough of it.
+        if pos < self.chunkSize:
+            return pos
+        self.text = self.text[pos:]
+        self.offset += pos
+        return 0
+
+def parseManifest(data, chunkSize=1 << 20):
+    # Parses the installer manifest one package at a time, turning each one
+    # into a Package before parsing the next, instead of building the whole
+    # manifest as dicts first. Returns the info and the list of packages;
+    # other top level fields are dropped.
+    reader = ManifestReader(data, chunkSize)
+    info = None
+    packages = []
+    pos = reader.skip(0, "{")
+    while reader.peek(pos) != "}":
+        key, pos = reader.value(pos)
+        pos = reader.skip(pos, ":")
+        if key == "packages":
+            pos = reader.skip(pos, "[")
+            while reader.peek(pos) != "]":
+                p, pos = reader.value(pos)
+                packages.append(Package(p))
+                pos = reader.skip(pos)
+                if reader.peek(pos) == ",":
+                    pos = reader.skip(pos + 1)
+                pos = reader.drop(pos)
+            pos += 1
+        else:
+            value, pos = reader.value(pos)
+            if key == "info":
+                info = value
+        pos = reader.skip(pos)
+        if reader.peek(pos) == ",":
+            pos = reader.skip(pos + 1)
+        pos = reader.drop(pos)
+    return info, packages
+
+def getPackages(manifestPackages, arch):
     packages = {}
-    for p in manifest["packages"]:
+    for p in manifestPackages:
         id = p["id"].lower()
         if not id in packages:
             packages[id] = []
@@ -428,68 +734,6 @@ def matchPackageTargetArch(p, archs):
 
     return True
 
-def printDepends(packages, target, constraints, indent, args):
-    chipstr = ""
-    for k in ["chip", "machineArch"]:
-        v = constraints.get(k)
-        if v is not None:
-            chipstr = chipstr + " (" + k + "." + v + ")"
-    deptypestr = ""
-    deptype = constraints.get("type", "")
-    if deptype != "":
-        deptypestr = " (" + deptype + ")"
-    ignorestr = ""
-    ignore = False
-    if target.lower() in args.ignore:
-        ignorestr = " (Ignored)"
-        ignore = True
-    if deptype == "Optional" and not args.include_optional:
-        ignore = True
-    if deptype == "Recommended" and args.skip_recommended:
-        ignore = True
-    if not ignore:
-        p = findPackage(packages, target, constraints, warn=False)
-        if p == None:
-            ignorestr = " (NotFound)"
-            ignore = True
-        elif args.only_host and not matchPackageHostArch(p, args.host_arch):
-            ignorestr = " (HostArchMismatch)"
-            ignore = True
-        elif not matchPackageTargetArch(p, args.architecture):
-            ignorestr = " (TargetArchMismatch)"
-            ignore = True
-    print(indent + target + chipstr + deptypestr + ignorestr)
-    if ignore:
-        return
-    for target, constraints in p.get("dependencies", {}).items():
-        if not isinstance(constraints, dict):
-            constraints = { "version": constraints }
-        target = constraints.get("id", target)
-        printDepends(packages, target, constraints, indent + "  ", args)
-
-def printReverseDepends(packages, target, deptype, indent, args):
-    deptypestr = ""
-    if deptype != "":
-        deptypestr = " (" + deptype + ")"
-    print(indent + target + deptypestr)
-    if deptype == "Optional" and not args.include_optional:
-        return
-    if deptype == "Recommended" and args.skip_recommended:
-        return
-    target = target.lower()
-    for key in packages:
-        p = packages[key][0]
-        if "dependencies" in p:
-            deps = p["dependencies"]
-            for k in deps:
-                if k.lower() != target:
-                    continue
-                dep = deps[k]
-                type = ""
-                if "type" in dep:
-                    type = dep["type"]
-                printReverseDepends(packages, p["id"], type, indent + "  ", args)
-
 def getPackageKey(p):
     packagekey = p["id"]
     if "version" in p:
@@ -500,47 +744,220 @@ def getPackageKey(p):
            packagekey = packagekey + "-" + k + "." + v
     return packagekey
 
-def aggregateDepends(packages, included, target, constraints, args):
-    if target.lower() in args.ignore:
-        return []
-    p = findPackage(packages, target, constraints)
-    if p == None:
-        return []
-    if args.only_host and not matchPackageHostArch(p, args.host_arch):
-        return []
-    if not matchPackageTargetArch(p, args.architecture):
-        return []
-    packagekey = getPackageKey(p)
-    if packagekey in included:
-        return []
-    ret = [p]
-    included[packagekey] = True
-    for target, constraints in p.get("dependencies", {}).items():
-        if not isinstance(constraints, dict):
-            constraints = { "version": constraints }
-        target = constraints.get("id", target)
-        deptype = constraints.get("type")
-        if deptype == "Optional" and not args.include_optional:
-            continue
-        if deptype == "Recommended" and args.skip_recommended:
-            continue
-        ret.extend(aggregateDepends(packages, included, target, constraints, args))
-    return ret
-
-def getSelectedPackages(packages, args):
-    ret = []
-    included = {}
-    for i in args.package:
-        ret.extend(aggregateDepends(packages, included, i, {}, args))
-    return ret
+def normalizeDependency(target, constraints):
+    if not isinstance(constraints, dict):
+        constraints = { "version": constraints }
+    return constraints.get("id", target), constraints
+
+class DependencyGraph:
+    # The dependency graph of the manifest packages. Lookups of packages,
+    # their dependencies, and the reverse dependencies are done once and
+    # memoized, so the selection and the printed trees don't need to rescan
+    # the manifest for each visited node.
+    #
+    # Package resolution depends on args.only_host, args.host_arch and
+    # args.architecture, which are expected to not change after the first
+    # lookup. args.ignore, args.include_optional and args.skip_recommended
+    # are checked on each traversal.
+    def __init__(self, packages, args):
+        self.packages = packages
+        self.args = args
+        self.resolved = {}
+        self.forward = {}
+        self.reverse = None
+
+    def resolve(self, target, constraints):
+        # Returns the package matching the constraints, and the reason for
+        # not picking it, if any.
+        key = (target.lower(), constraints.get("chip"), constraints.get("machineArch"))
+        if key in self.resolved:
+            return self.resolved[key]
+        p = findPackage(self.packages, target, constraints, warn=False)
+        status = None
+        if p == None:
+            status = "NotFound"
+        elif self.args.only_host and not matchPackageHostArch(p, self.args.host_arch):
+            status = "HostArchMismatch"
+        elif not matchPackageTargetArch(p, self.args.architecture):
+            status = "TargetArchMismatch"
+        self.resolved[key] = (p, status)
+        return self.resolved[key]
+
+    def dependencies(self, p):
+        # The forward adjacency list of a package, as a list of
+        # (target, constraints) tuples.
+        key = getPackageKey(p)
+        if key not in self.forward:
+            self.forward[key] = [normalizeDependency(target, constraints) for target, constraints in p.get("dependencies", {}).items()]
+        return self.forward[key]
+
+    def reverseDependencies(self, target):
+        # The reverse index maps each dependency name to the packages that
+        # depend on it, as a list of (id, type) tuples.
+        if self.reverse == None:
+            self.reverse = {}
+            for key in self.packages:
+                p = self.packages[key][0]
+                for k, dep in p.get("dependencies", {}).items():
+                    type = ""
+                    if isinstance(dep, dict):
+                        type = dep.get("type", "")
+                    self.reverse.setdefault(k.lower(), []).append((p["id"], type))
+        return self.reverse.get(target.lower(), [])
+
+    def skipDependency(self, deptype):
+        if deptype == "Optional" and not self.args.include_optional:
+            return True
+        if deptype == "Recommended" and self.args.skip_recommended:
+            return True
+        return False
+
+    def selection(self, targets, warn=True):
+        ret = []
+        included = {}
+        def aggregate(target, constraints):
+            if target.lower() in self.args.ignore:
+                return
+            p, status = self.resolve(target, constraints)
+            if status == "NotFound" and warn:
+                print("WARNING: %s not found" % (target))
+            if status != None:
+                return
+            packagekey = getPackageKey(p)
+            if packagekey in included:
+                return
+            ret.append(p)
+            included[packagekey] = True
+            for target, constraints in self.dependencies(p):
+                if self.skipDependency(constraints.get("type")):
+                    continue
+                aggregate(target, constraints)
+        for i in targets:
+            aggregate(i, {})
+        return ret
+
+    def printDependsTree(self, target, constraints, indent, expanded, active=()):
+        line = target
+        for k in ["chip", "machineArch"]:
+            v = constraints.get(k)
+            if v is not None:
+                line = line + " (" + k + "." + v + ")"
+        deptype = constraints.get("type", "")
+        if deptype != "":
+            line = line + " (" + deptype + ")"
+        ignore = False
+        if target.lower() in self.args.ignore:
+            line = line + " (Ignored)"
+            ignore = True
+        if self.skipDependency(deptype):
+            ignore = True
+        if not ignore:
+            p, status = self.resolve(target, constraints)
+            if status != None:
+                line = line + " (" + status + ")"
+                ignore = True
+            elif getPackageKey(p) in active:
+                line = line + " (Cycle)"
+                ignore = True
+            elif getPackageKey(p) in expanded:
+                if len(self.dependencies(p)) > 0:
+                    line = line + " (see above)"
+                ignore = True
+        print(indent + line)
+        if ignore:
+            return
+        expanded.add(getPackageKey(p))
+        active = active + (getPackageKey(p),)
+        for target, constraints in self.dependencies(p):
+            self.printDependsTree(target, constraints, indent + "  ", expanded, active)
+
+    def printReverseDependsTree(self, target, deptype, indent, expanded, active=()):
+        line = target
+        if deptype != "":
+            line = line + " (" + deptype + ")"
+        key = target.lower()
+        ignore = False
+        if self.skipDependency(deptype):
+            ignore = True
+        elif key in active:
+            line = line + " (Cycle)"
+            ignore = True
+        elif key in expanded:
+            if len(self.reverseDependencies(target)) > 0:
+                line = line + " (see above)"
+            ignore = True
+        print(indent + line)
+        if ignore:
+            return
+        expanded.add(key)
+        active = active + (key,)
+        for id, type in self.reverseDependencies(target):
+            self.printReverseDependsTree(id, type, indent + "  ", expanded, active)
+
+    def printDepends(self, target):
+        # The dependencies of a package are only listed the first time it
+        # is printed; later occurrences refer back to it. Shared subtrees
+        # would otherwise make the output grow exponentially with the depth.
+        self.printDependsTree(target, {}, "", set())
+
+    def printReverseDepends(self, target):
+        self.printReverseDependsTree(target, "", "", set())
+
+    def graph(self, targets):
+        # The resolved graph of the selection, with all edges of the selected
+        # packages, including the ones that were skipped.
+        nodes = {}
+        edges = []
+        for p in self.selection(targets, warn=False):
+            key = getPackageKey(p)
+            node = { "id": p["id"] }
+            for k in ["type", "version", "chip", "machineArch", "productArch", "language"]:
+                if k in p:
+                    node[k] = p[k]
+            nodes[key] = node
+            for target, constraints in self.dependencies(p):
+                edge = { "from": key, "to": target }
+                deptype = constraints.get("type")
+                if deptype is not None:
+                    edge["type"] = deptype
+                dep, status = self.resolve(target, constraints)
+                if target.lower() in self.args.ignore:
+                    status = "Ignored"
+                elif self.skipDependency(deptype):
+                    status = "Skipped"
+                if dep is not None:
+                    edge["key"] = getPackageKey(dep)
+                if status is not None:
+                    edge["status"] = status
+                edges.append(edge)
+        return { "roots": targets, "nodes": nodes, "edges": edges }
+
+    def printGraph(self, targets, format):
+        graph = self.graph(targets)
+        if format == "json":
+            print(json.dumps(graph, indent=2))
+            return
+        print("digraph dependencies {")
+        for key in graph["nodes"]:
+            print("  %s;" % (json.dumps(key)))
+        for edge in graph["edges"]:
+            if "status" in edge or "key" not in edge:
+                continue
+            attrs = ""
+            if "type" in edge:
+                attrs = " [label=%s]" % (json.dumps(edge["type"]))
+            print("  %s -> %s%s;" % (json.dumps(edge["from"]), json.dumps(edge["key"]), attrs))
+        print("}")
+
+def getSelectedPackages(packages, args, graph=None):
+    if graph == None:
+        graph = DependencyGraph(packages, args)
+    return graph.selection(args.package)
 
 def sumInstalledSize(l):
     sum = 0
     for p in l:
-        if "installSizes" in p:
-            sizes = p["installSizes"]
-            for location in sizes:
-                sum = sum + sizes[location]
+        sum = sum + p.get("installSize", 0)
     return sum
 
 def sumDownloadSize(l):
@@ -584,10 +1001,344 @@ def makedirs(dir):
 def sha256File(file):
     sha256Hash = hashlib.sha256()
     with open(file, "rb") as f:
-        for byteBlock in iter(lambda: f.read(4096), b""):
+        for byteBlock in iter(lambda: f.read(1024*1024), b""):
                 sha256Hash.update(byteBlock)
         return sha256Hash.hexdigest()
 
+class ConnectionPool:
+    # Keeps idle HTTP(S) connections for reuse, and limits the number of
+    # concurrent connections to each host. Requests that need a proxy, or
+    # aren't plain HTTP(S), are left to urllib.
+    def __init__(self, perHost=None):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.semaphores = {}
+        self.perHost = perHost
+        self.proxies = urllib.request.getproxies()
+
+    def semaphore(self, key):
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(self.perHost or 1000)
+            return self.semaphores[key]
+
+    def connect(self, key, reuse=True):
+        with self.lock:
+            if reuse and self.idle.get(key):
+                return self.idle[key].pop(), True
+        scheme, host = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=socket.getdefaulttimeout()), False
+        return http.client.HTTPConnection(host, timeout=socket.getdefaulttimeout()), False
+
+    def release(self, key, conn, reuse):
+        if reuse:
+            with self.lock:
+                self.idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self.semaphore(key).release()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def useProxy(self, u):
+        # Like urllib, honour no_proxy for the hosts it lists.
+        return u.scheme in self.proxies and not urllib.request.proxy_bypass(u.hostname or "")
+
+    def open(self, url, headers={}):
+        for redirect in range(10):
+            u = urllib.parse.urlsplit(url)
+            if u.scheme not in ["http", "https"] or u.username != None or self.useProxy(u):
+                return urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+            key = (u.scheme, u.netloc)
+            path = u.path or "/"
+            if u.query:
+                path = path + "?" + u.query
+            self.semaphore(key).acquire()
+            conn, reused = self.connect(key)
+            try:
+                try:
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+                except (http.client.HTTPException, OSError):
+                    if not reused:
+                        raise
+                    # The server may have closed the idle connection; retry
+                    # once with a new connection.
+                    conn.close()
+                    conn, reused = self.connect(key, reuse=False)
+                    conn.request("GET", path, headers=headers)
+                    response = conn.getresponse()
+            except:
+                self.release(key, conn, False)
+                raise
+            if response.status in [301, 302, 303, 307, 308]:
+                if not response.getheader("Location"):
+                    # As with urllib, a redirect without a target is an error.
+                    self.release(key, conn, False)
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                response.read()
+                self.release(key, conn, not response.will_close)
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                self.release(key, conn, False)
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return PooledResponse(self, key, conn, response)
+        raise urllib.error.URLError("Too many redirects for %s" % (url))
+
+class PooledResponse:
+    # An HTTP response that hands its connection back to the pool once the
+    # response has been fully read and closed.
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def close(self):
+        if self.conn == None:
+            return
+        # A response that ended early (the server closed the connection
+        # before sending all of it) also counts as closed.
+        reuse = self.response.isclosed() and not self.response.will_close and not self.response.length
+        self.response.close()
+        self.pool.release(self.key, self.conn, reuse)
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class DownloadProgress:
+    # Tracks the total amount of downloaded data across all workers, and
+    # prints the aggregate progress and bandwidth periodically.
+    def __init__(self, total, interval=5):
+        self.lock = threading.Lock()
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.last = self.start
+        self.interval = interval
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+            now = time.time()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+            done = self.done
+        print("Progress: %s of %s (%s/s)" % (formatSize(done), formatSize(self.total), formatSize(done / (now - self.start))), flush=True)
+
+class Timings:
+    # Records the wall time of the phases of the installation, and of the
+    # download and extraction of each package and payload within them, for
+    # --timings. They are written as Chrome trace events, which can be
+    # viewed in chrome://tracing or https://ui.perfetto.dev.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.workers = {}
+        self.start = time.time()
+
+    def add(self, name, cat, start, end, args={}, worker=None):
+        # The worker is a (pid, thread id, name) tuple, for events recorded
+        # in another process; by default, it is the current thread.
+        if worker == None:
+            worker = getWorker()
+        pid, tid, workerName = worker
+        args = dict(args)
+        args["worker"] = workerName
+        if args.get("bytes") and end > start:
+            args["bytesPerSecond"] = round(args["bytes"] / (end - start))
+        event = { "name": name, "cat": cat, "ph": "X", "pid": pid, "tid": tid,
+                  "ts": round((start - self.start) * 1000000), "dur": round((end - start) * 1000000), "args": args }
+        with self.lock:
+            self.workers[(pid, tid)] = workerName
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        # The caller can add arguments, like the number of bytes, to the
+        # yielded dict.
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.add(name, cat, start, time.time(), args)
+
+    def getPackages(self):
+        # The start and end of the download and extraction of each package.
+        packages = {}
+        for e in self.events:
+            key = e["args"].get("package")
+            if key == None:
+                continue
+            t = packages.setdefault(key, { "start": e["ts"], "end": e["ts"] + e["dur"], "bytes": 0, "download": [], "extract": 0 })
+            t["start"] = min(t["start"], e["ts"])
+            t["end"] = max(t["end"], e["ts"] + e["dur"])
+            t["bytes"] += e["args"].get("bytes", 0)
+            if e["cat"] == "download":
+                t["download"].append((e["ts"], e["ts"] + e["dur"]))
+            else:
+                t["extract"] += e["dur"]
+        for t in packages.values():
+            # The payloads of a package can be downloaded in parallel.
+            t["download"] = max((end for start, end in t["download"]), default=0) - min((start for start, end in t["download"]), default=0)
+        return packages
+
+    def write(self, file):
+        events = list(self.events)
+        for (pid, tid), workerName in self.workers.items():
+            events.append({ "name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": { "name": workerName } })
+        # Show each package as a whole on a track of its own.
+        for i, (key, t) in enumerate(self.getPackages().items()):
+            events.append({ "name": key, "cat": "package", "ph": "b", "id": i, "pid": os.getpid(), "ts": t["start"] })
+            events.append({ "name": key, "cat": "package", "ph": "e", "id": i, "pid": os.getpid(), "ts": t["end"] })
+        writeFileAtomic(file, json.dumps({ "traceEvents": events, "displayTimeUnit": "ms" }).encode("utf-8"))
+
+    def printSummary(self, top=10):
+        print("Timings:")
+        for e in self.events:
+            if e["cat"] == "phase":
+                print("  %-12s %8.2f s" % (e["name"], e["dur"] / 1000000))
+
+        packages = self.getPackages()
+        if len(packages) == 0:
+            return
+        print("Slowest packages:")
+        print("  %10s %10s %10s  %s" % ("Download", "Extract", "Size", "Package"))
+        for key, t in sorted(packages.items(), key=lambda i: i[1]["download"] + i[1]["extract"], reverse=True)[:top]:
+            print("  %8.2f s %8.2f s %10s  %s" % (t["download"] / 1000000, t["extract"] / 1000000, formatSize(t["bytes"]), key))
+
+        # The extraction that is left after the last download finished is
+        # what the download can't hide; with --pipeline, ideally only the
+        # last few packages.
+        downloads = [e for e in self.events if e["cat"] == "download"]
+        downloaded = set(e["args"]["package"] for e in downloads)
+        # Components and workloads don't have anything to extract.
+        extracts = [e for e in self.events if (e["cat"] == "extract" or e["cat"] == "merge") and e["args"]["package"] in downloaded]
+        if len(downloads) == 0 or len(extracts) == 0:
+            return
+        downloadStart = min(e["ts"] for e in downloads)
+        downloadEnd = max(e["ts"] + e["dur"] for e in downloads)
+        last = max(extracts, key=lambda e: e["ts"] + e["dur"])
+        tail = max(last["ts"] + last["dur"] - max(downloadEnd, min(e["ts"] for e in extracts)), 0)
+        print("Critical path: %.2f s downloading, then %.2f s extracting, ending with %s" % ((downloadEnd - downloadStart) / 1000000, tail / 1000000, last["name"]))
+
+def getWorker():
+    name = threading.current_thread().name
+    if multiprocessing.current_process().name != "MainProcess":
+        name = multiprocessing.current_process().name
+    return os.getpid(), threading.get_native_id(), name
+
+timings = None
+
+def timed(name, cat, **args):
+    # Times the block with --timings; without it, this does nothing.
+    if timings == None:
+        return contextlib.nullcontext(args)
+    return timings.span(name, cat, **args)
+
+def openUrl(url, headers={}, connections=None):
+    if connections != None:
+        return connections.open(url, headers)
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+
+def downloadFile(url, file, size=None, sha256=None, state=None, connections=None, progress=None):
+    # Stream the file to disk, hashing the data as it arrives, so the
+    # downloaded file doesn't need to be read back for verification.
+    #
+    # An existing partial file is resumed with a range request, if it was
+    # for the same expected size and hash. The hash state of the data
+    # written so far is kept in state, to avoid rehashing it on retries.
+    if state == None:
+        state = {}
+    info = { "size": size, "sha256": sha256 }
+    infofile = file + ".json"
+    offset = 0
+    if os.path.isfile(file):
+        try:
+            with open(infofile, "r") as f:
+                if json.load(f) == info:
+                    offset = os.path.getsize(file)
+        except (OSError, ValueError):
+            pass
+    if size != None and offset > size:
+        offset = 0
+    if offset == 0:
+        writeFileAtomic(infofile, json.dumps(info).encode("utf-8"))
+
+    sha256Hash = state.get("hash")
+    if sha256Hash == None or state.get("offset") != offset:
+        sha256Hash = hashlib.sha256()
+        if offset > 0:
+            with open(file, "rb") as f:
+                for byteBlock in iter(lambda: f.read(1024*1024), b""):
+                    sha256Hash.update(byteBlock)
+    state["hash"] = sha256Hash
+    state["offset"] = offset
+    if size != None and offset == size:
+        return sha256Hash.hexdigest()
+
+    headers = {}
+    if offset > 0:
+        headers["Range"] = "bytes=%d-" % (offset)
+    try:
+        response = openUrl(url, headers, connections)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or offset == 0:
+            raise
+        # The range wasn't satisfiable; refetch the whole file.
+        offset = 0
+        response = openUrl(url, {}, connections)
+    with response:
+        if offset > 0 and (response.status != 206 or not response.headers.get("Content-Range", "").startswith("bytes %d-" % (offset))):
+            # The server ignored the range request.
+            offset = 0
+        if offset == 0:
+            sha256Hash = hashlib.sha256()
+            state["hash"] = sha256Hash
+            state["offset"] = 0
+        buf = bytearray(1024*1024)
+        view = memoryview(buf)
+        with open(file, "r+b" if offset > 0 else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                n = response.readinto(buf)
+                if n == 0:
+                    break
+                f.write(view[:n])
+                sha256Hash.update(view[:n])
+                state["offset"] += n
+                if progress != None:
+                    progress.add(n)
+        if response.length:
+            # The connection was closed before all the data was received;
+            # keep the partial file for resuming it.
+            raise urllib.error.ContentTooShortError("Got only %d out of %d bytes" % (state["offset"], state["offset"] + response.length), None)
+    return sha256Hash.hexdigest()
+
+def removePartialFile(file):
+    for f in [file, file + ".json"]:
+        if os.access(f, os.F_OK):
+            os.remove(f)
+
 def getPayloadName(payload):
     name = payload["fileName"]
     if "\\" in name:
@@ -596,61 +1347,282 @@ def getPayloadName(payload):
         name = name.split("/")[-1]
     return name
 
-def downloadPackages(selected, cache, allowHashMismatch = False):
-    pool = multiprocessing.Pool(5)
-    tasks = []
-    makedirs(cache)
+def getPayloadFiles(selected, cache):
     for p in selected:
         if not "payloads" in p:
             continue
-        dir = os.path.join(cache, getPackageKey(p))
-        makedirs(dir)
         for payload in p["payloads"]:
             name = getPayloadName(payload)
-            destname = os.path.join(dir, name)
+            destname = os.path.join(cache, getPackageKey(p), name)
             fileid = os.path.join(getPackageKey(p), name)
-            args = (payload, destname, fileid, allowHashMismatch)
-            tasks.append(pool.apply_async(_downloadPayload, args))
+            yield p, payload, destname, fileid
 
-    downloaded = sum(task.get() for task in tasks)
-    pool.close()
-    print("Downloaded %s in total" % (formatSize(downloaded)))
+def loadVerifiedIndex(cache):
+    try:
+        with open(os.path.join(cache, "verified.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def getFileStat(file):
+    st = os.stat(file)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def downloadPackages(selected, cache, allowHashMismatch = False, blobdir = None, paranoid = False, jobs = 5, jobsPerHost = None, packageDone = None):
+    # If packageDone is set, it is called for each selected package (in the
+    # order they are completed), once all of its files are available.
+    makedirs(cache)
+    # Files that have been verified earlier and haven't changed since then
+    # (as far as their size, mtime and inode tell) are trusted as is.
+    index = loadVerifiedIndex(cache)
+    files = []
+    for p, payload, destname, fileid in getPayloadFiles(selected, cache):
+        makedirs(os.path.dirname(destname))
+        sha256 = payload.get("sha256", "").lower()
+        entry = index.get(fileid)
+        if not paranoid and sha256 != "" and entry != None and entry["sha256"] == sha256 and os.access(destname, os.F_OK) and entry["stat"] == getFileStat(destname):
+            print("Using existing file %s" % (fileid), flush=True)
+            if blobdir != None:
+                storeBlob(destname, getBlobName(blobdir, sha256))
+            index[fileid]["stat"] = getFileStat(destname)
+            continue
+        files.append((p, payload, destname, fileid))
+
+    # Verify the remaining existing files using all cores.
+    existing = [destname for p, payload, destname, fileid in files if "sha256" in payload and os.access(destname, os.F_OK)]
+    digests = {}
+    if len(existing) > 0:
+        print("Verifying %d existing files" % (len(existing)), flush=True)
+        with multiprocessing.Pool(os.cpu_count()) as pool:
+            digests = dict(zip(existing, pool.map(sha256File, existing, chunksize=1)))
+
+    # Start with the largest files, to avoid ending up waiting for a single
+    # large file at the end.
+    files.sort(key=lambda f: f[1].get("size", 0), reverse=True)
+    connections = ConnectionPool(jobsPerHost)
+    progress = DownloadProgress(sum(payload.get("size", 0) for p, payload, destname, fileid in files if not os.access(destname, os.F_OK)))
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    remaining = {}
+    for p, payload, destname, fileid in files:
+        remaining[id(p)] = remaining.get(id(p), 0) + 1
+    if packageDone != None:
+        for p in selected:
+            if id(p) not in remaining:
+                packageDone(p)
+    results = queue.Queue()
+    for p, payload, destname, fileid in files:
+        args = (p, payload, destname, fileid, allowHashMismatch, blobdir, digests.get(destname), connections, progress)
+        file = (p, payload, destname, fileid)
+        pool.apply_async(_timedDownloadPayload, args,
+                         callback=lambda result, file=file: results.put((file, result, None)),
+                         error_callback=lambda e, file=file: results.put((file, None, e)))
+
+    downloaded = 0
+    try:
+        for i in range(len(files)):
+            (p, payload, destname, fileid), result, e = results.get()
+            if e != None:
+                raise e
+            size, verified = result
+            downloaded += size
+            if verified and "sha256" in payload:
+                index[fileid] = { "sha256": payload["sha256"].lower(), "stat": getFileStat(destname) }
+            remaining[id(p)] -= 1
+            if remaining[id(p)] == 0 and packageDone != None:
+                packageDone(p)
+    finally:
+        # If a payload failed, don't start any more downloads, but keep the
+        # hashes of the files that were verified so far.
+        pool.terminate()
+        connections.close()
+        writeFileAtomic(os.path.join(cache, "verified.json"), json.dumps(index).encode("utf-8"))
+    elapsed = time.time() - progress.start
+    if downloaded > 0 and elapsed > 0:
+        print("Downloaded %s in total (%s/s)" % (formatSize(downloaded), formatSize(downloaded / elapsed)))
+    else:
+        print("Downloaded %s in total" % (formatSize(downloaded)))
+
+def getBlobName(blobdir, sha256):
+    return os.path.join(blobdir, sha256[0:2], sha256)
+
+def linkFile(src, dest):
+    # Replace dest with a hardlink to src.
+    tmp = dest + ".link"
+    if os.access(tmp, os.F_OK):
+        os.remove(tmp)
+    os.link(src, tmp)
+    os.replace(tmp, dest)
+
+def storeBlob(file, blob):
+    # Make the verified file and the blob with the same hash share their
+    # data, and mark the blob as recently used. If the filesystem doesn't
+    # support hardlinks, the file is kept as is.
+    try:
+        if os.access(blob, os.F_OK):
+            if not os.path.samefile(file, blob):
+                linkFile(blob, file)
+        else:
+            makedirs(os.path.dirname(blob))
+            linkFile(file, blob)
+        # The access time is used for evicting the least recently used
+        # blobs; set it explicitly as it isn't reliably updated on reads.
+        st = os.stat(blob)
+        os.utime(blob, ns=(time.time_ns(), st.st_mtime_ns))
+    except OSError:
+        pass
+
+def _timedDownloadPayload(p, payload, destname, fileid, *args):
+    with timed(fileid, "download", package=getPackageKey(p)) as t:
+        size, verified = _downloadPayload(payload, destname, fileid, *args)
+        t["bytes"] = size
+    return size, verified
 
-def _downloadPayload(payload, destname, fileid, allowHashMismatch):
+def _downloadPayload(payload, destname, fileid, allowHashMismatch, blobdir, existingDigest=None, connections=None, progress=None):
     attempts = 5
+    partname = destname + ".part"
+    size = payload.get("size")
+    sha256 = payload.get("sha256")
+    if sha256 != None:
+        sha256 = sha256.lower()
+    blob = None
+    if blobdir != None and sha256 != None:
+        blob = getBlobName(blobdir, sha256)
+        if os.access(blob, os.F_OK) and not os.access(destname, os.F_OK):
+            try:
+                linkFile(blob, destname)
+            except OSError:
+                pass
+    state = {}
     for attempt in range(attempts):
         try:
             if os.access(destname, os.F_OK):
-                if "sha256" in payload:
-                    if sha256File(destname).lower() != payload["sha256"].lower():
-                        print("Incorrect existing file %s, removing" % (fileid), flush=True)
-                        os.remove(destname)
+                if sha256 != None:
+                    if existingDigest == None:
+                        existingDigest = sha256File(destname)
+                    if existingDigest.lower() != sha256:
+                        if blob != None and os.access(blob, os.F_OK) and os.path.samefile(blob, destname):
+                            os.remove(blob)
+                        if size != None and os.path.getsize(destname) < size and not os.access(partname, os.F_OK):
+                            # Most likely an interrupted download from an
+                            # older version of this script; try to resume it.
+                            print("Incomplete existing file %s, resuming" % (fileid), flush=True)
+                            os.replace(destname, partname)
+                            writeFileAtomic(partname + ".json", json.dumps({ "size": size, "sha256": sha256 }).encode("utf-8"))
+                        else:
+                            print("Incorrect existing file %s, removing" % (fileid), flush=True)
+                            os.remove(destname)
                     else:
                         print("Using existing file %s" % (fileid), flush=True)
-                        return 0
+                        if blob != None:
+                            storeBlob(destname, blob)
+                        return 0, True
                 else:
-                    return 0
-            size = 0
-            if "size" in payload:
-                size = payload["size"]
-            print("Downloading %s (%s)" % (fileid, formatSize(size)), flush=True)
-            urllib.request.urlretrieve(payload["url"], destname)
-            if "sha256" in payload:
-                if sha256File(destname).lower() != payload["sha256"].lower():
+                    return 0, False
+            if os.access(partname, os.F_OK):
+                print("Resuming %s (%s)" % (fileid, formatSize(size or 0)), flush=True)
+            else:
+                print("Downloading %s (%s)" % (fileid, formatSize(size or 0)), flush=True)
+            # Only move the file into place once it has been verified.
+            existingDigest = None
+            digest = downloadFile(payload["url"], partname, size, sha256, state, connections, progress)
+            verified = sha256 != None
+            if sha256 != None:
+                if digest != sha256:
+                    verified = False
                     if allowHashMismatch:
                         print("WARNING: Incorrect hash for downloaded file %s" % (fileid), flush=True)
                     else:
+                        removePartialFile(partname)
+                        state.clear()
                         raise Exception("Incorrect hash for downloaded file %s, aborting" % fileid)
-            return size
+            os.replace(partname, destname)
+            removePartialFile(partname)
+            if blob != None and verified:
+                storeBlob(destname, blob)
+            return size or 0, verified
         except Exception as e:
             if attempt == attempts - 1:
                 raise
             print("%s: %s" % (type(e).__name__, e), flush=True)
 
-def mergeTrees(src, dest):
+def cleanCache(cache, selected, maxSize=None):
+    # Remove blobs, and the per package hardlinks to them, that aren't used
+    # by the current selection. If maxSize is set, only the least recently
+    # used blobs are removed, until the blobs fit within maxSize.
+    blobdir = os.path.join(cache, "blobs")
+    blobs = {}
+    for file in glob.glob(os.path.join(glob.escape(blobdir), "*", "*")):
+        st = os.stat(file)
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        blobs[(st.st_dev, st.st_ino)] = { "files": [file], "size": st.st_size, "atime": st.st_atime_ns }
+    if len(blobs) == 0:
+        return
+    for dir in os.listdir(cache):
+        if dir in ["blobs", "manifests"] or not os.path.isdir(os.path.join(cache, dir)):
+            continue
+        for name in os.listdir(os.path.join(cache, dir)):
+            file = os.path.join(cache, dir, name)
+            st = os.lstat(file)
+            if (st.st_dev, st.st_ino) in blobs:
+                blobs[(st.st_dev, st.st_ino)]["files"].append(file)
+    used = set()
+    for p, payload, destname, fileid in getPayloadFiles(selected, cache):
+        if os.access(destname, os.F_OK):
+            st = os.stat(destname)
+            used.add((st.st_dev, st.st_ino))
+    total = sum(blob["size"] for blob in blobs.values())
+    removed = 0
+    removedSize = 0
+    for key in sorted(blobs, key=lambda key: blobs[key]["atime"]):
+        if maxSize != None and total <= maxSize:
+            break
+        if key in used:
+            continue
+        for file in blobs[key]["files"]:
+            os.remove(file)
+            dir = os.path.dirname(file)
+            if len(os.listdir(dir)) == 0:
+                os.rmdir(dir)
+        total -= blobs[key]["size"]
+        removed += 1
+        removedSize += blobs[key]["size"]
+    print("Removed %d files (%s) from the cache, keeping %s" % (removed, formatSize(removedSize), formatSize(total)))
+
+def parseSize(s):
+    units = { "K": 1024, "M": 1024*1024, "G": 1024*1024*1024, "T": 1024*1024*1024*1024 }
+    s = s.strip().upper()
+    if s.endswith("B"):
+        s = s[:-1]
+    if s[-1:] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def listTree(dir):
+    # List all files and symlinks within dir, relative to dir.
+    files = []
+    for root, dirs, names in os.walk(dir):
+        for n in names + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            files.append(os.path.relpath(os.path.join(root, n), dir))
+    return files
+
+def recordMoved(src, dest, moved):
+    if moved == None:
+        return
+    if os.path.isdir(src) and not os.path.islink(src):
+        for f in listTree(src):
+            moved[os.path.join(src, f)] = os.path.join(dest, f)
+    else:
+        moved[src] = dest
+
+def mergeTrees(src, dest, ignoreCase=True, moved=None, skip=None):
+    # If moved is set, the destination of each file is recorded in it.
+    # If skip is set, files for which skip(src, dest) returns true are left
+    # in src instead of overwriting the existing file in dest.
     if not os.path.isdir(src):
         return
     if not os.path.isdir(dest):
+        recordMoved(src, dest, moved)
         shutil.move(src, dest)
         return
     names = os.listdir(src)
@@ -662,85 +1634,299 @@ def mergeTrees(src, dest):
         destname = os.path.join(dest, n)
         if os.path.isdir(srcname):
             if os.path.isdir(destname):
-                mergeTrees(srcname, destname)
-            elif n.lower() in destnames:
-                mergeTrees(srcname, os.path.join(dest, destnames[n.lower()]))
+                mergeTrees(srcname, destname, ignoreCase, moved, skip)
+            elif ignoreCase and n.lower() in destnames:
+                mergeTrees(srcname, os.path.join(dest, destnames[n.lower()]), ignoreCase, moved, skip)
             else:
+                recordMoved(srcname, destname, moved)
                 shutil.move(srcname, destname)
         else:
+            recordMoved(srcname, destname, moved)
+            if skip != None and os.path.lexists(destname) and skip(srcname, destname):
+                continue
             shutil.move(srcname, destname)
 
-def unzipFiltered(zip, dest):
-    tmp = os.path.join(dest, "extract")
+def getVCSDKComponents():
+    return [
+        "VC",
+        "Windows Kits",
+        # The DIA SDK isn't necessary for normal use, but can be used when e.g.
+        # compiling LLVM.
+        "DIA SDK",
+        # MSBuild is the standard VC build tool.
+        "MSBuild",
+        # This directory contains batch scripts to setup Developer Command Prompt.
+        # Environment variable VS170COMNTOOLS points to this directory, and some
+        # tools use it to locate VS installation root and MSVC toolchains.
+        os.path.join("Common7", "Tools"),
+    ]
+
+def isKeptPath(parts, keep):
+    # Check (case insensitively, like the directories are merged) if a path
+    # within the unpack directory is within one of the components in keep.
+    for dir in keep:
+        dirparts = dir.lower().split(os.sep)
+        if [p.lower() for p in parts[0:len(dirparts)]] == dirparts:
+            return True
+    return False
+
+class CaseInsensitiveDirs:
+    # Resolves directories within a destination tree in the same way as
+    # mergeTrees does; directories that existed before are matched case
+    # insensitively, while new ones are created with the given casing.
+    def __init__(self):
+        self.dirs = {}
+
+    def lookup(self, parent, name):
+        if parent not in self.dirs:
+            names = set()
+            lower = {}
+            if os.path.isdir(parent):
+                for n in os.listdir(parent):
+                    if os.path.isdir(os.path.join(parent, n)):
+                        names.add(n)
+                        lower[n.lower()] = n
+            self.dirs[parent] = (names, lower)
+        names, lower = self.dirs[parent]
+        if name in names:
+            return os.path.join(parent, name)
+        if name.lower() in lower:
+            return os.path.join(parent, lower[name.lower()])
+        makedirs(os.path.join(parent, name))
+        names.add(name)
+        return os.path.join(parent, name)
+
+    def resolve(self, root, parts):
+        dir = root
+        for part in parts:
+            dir = self.lookup(dir, part)
+        return dir
+
+def unzipFiltered(zip, dest, keep=None):
+    # Extract the Contents directory of a VSIX into dest, and the $MSBuild
+    # directory (used in WDK.vsix) into dest/MSBuild, writing each file
+    # directly to its final location. Other files in the archive are
+    # ignored. If keep is set, only files within those components are
+    # extracted.
+    dirs = CaseInsensitiveDirs()
     for f in zip.infolist():
         name = urllib.parse.unquote(f.filename)
-        if "/" in name:
-            sep = name.rfind("/")
-            dir = os.path.join(dest, name[0:sep])
-            makedirs(dir)
-        extracted = zip.extract(f, tmp)
-        shutil.move(extracted, os.path.join(dest, name))
-    shutil.rmtree(tmp)
-
-def unpackVsix(file, dest, listing):
-    temp = os.path.join(dest, "vsix")
-    makedirs(temp)
+        if name.startswith("Contents/"):
+            root = dest
+            parts = name[len("Contents/"):].split("/")
+            prefix = []
+        elif name.startswith("$MSBuild/"):
+            root = os.path.join(dest, "MSBuild")
+            parts = name[len("$MSBuild/"):].split("/")
+            prefix = ["MSBuild"]
+        else:
+            continue
+        if ".." in parts or "" in parts[0:-1]:
+            continue
+        if keep != None and not isKeptPath(prefix + parts, keep):
+            continue
+        if parts[-1] == "":
+            # A directory entry
+            if len(parts) > 1:
+                dirs.resolve(root, parts[0:-1])
+            continue
+        makedirs(root)
+        dir = dirs.resolve(root, parts[0:-1])
+        destname = os.path.join(dir, parts[-1])
+        # Don't write through a link left by --dedupe or --cache-by-hash;
+        # replace it with a file of its own, like moving the file would.
+        if os.path.lexists(destname):
+            os.remove(destname)
+        with zip.open(f) as src, open(destname, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+def unpackVsix(file, dest, listing, keep=None):
     with zipfile.ZipFile(file, "r") as zip:
-        unzipFiltered(zip, temp)
+        unzipFiltered(zip, dest, keep)
         with open(listing, "w") as f:
             for n in zip.namelist():
                 f.write(n + "\n")
-    contents = os.path.join(temp, "Contents")
-    if os.access(contents, os.F_OK):
-        mergeTrees(contents, dest)
-    # This archive directory structure is used in WDK.vsix.
-    msbuild = os.path.join(temp, "$MSBuild")
-    if os.access(msbuild, os.F_OK):
-        mergeTrees(msbuild, os.path.join(dest, "MSBuild"))
-    shutil.rmtree(temp)
-
-def unpackWin10SDK(src, payloads, dest):
-    # We could try to unpack only the MSIs we need here.
+
+def extractMsis(msis, dest, jobs=1):
+    # Extract a list of (msi, listing) in parallel, each into a separate
+    # staging directory. The staging directories are merged into dest in
+    # order, without ignoring case, to get the same result as when
+    # extracting them directly into dest one at a time.
+    def extract(i, srcfile, listing):
+        print("Extracting " + os.path.basename(srcfile), flush=True)
+        staging = os.path.join(dest, ".msi-%d" % (i))
+        shutil.rmtree(staging, ignore_errors=True)
+        makedirs(staging)
+        if sys.platform == "win32":
+            # The path to TARGETDIR need to be quoted in the case of spaces.
+            cmd = "msiexec /a \"%s\" /qn TARGETDIR=\"%s\"" % (srcfile, os.path.abspath(staging))
+        else:
+            cmd = ["msiextract", "-C", staging, srcfile]
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        with open(listing, "w") as log:
+            log.write(output.replace(staging, dest))
+        return staging
+
+    with multiprocessing.pool.ThreadPool(max(jobs, 1)) as pool:
+        tasks = [pool.apply_async(extract, (i, srcfile, listing)) for i, (srcfile, listing) in enumerate(msis)]
+        for task in tasks:
+            mergeStaging(task.get(), dest, ignoreCase=False)
+
+def linkProgramFiles(dest):
+    if sys.platform != "win32" and not os.access(os.path.join(dest, "Program Files"), os.F_OK):
+        os.symlink(".", os.path.join(dest, "Program Files"), target_is_directory=True)
+
+def readMsiTable(msi, table):
+    # Export a table of an MSI with msiinfo, as a list of dicts mapping the
+    # column names to the values. The export starts with the column names,
+    # their types and the table name with its keys.
+    output = subprocess.run(["msiinfo", "export", msi, table], stdout=subprocess.PIPE, check=True, universal_newlines=True, errors="replace").stdout
+    lines = output.split("\n")
+    columns = lines[0].split("\t")
+    rows = []
+    for line in lines[3:]:
+        if line == "":
+            continue
+        values = line.split("\t")
+        if len(values) > len(columns):
+            raise ValueError("Unexpected row in the %s table of %s" % (table, msi))
+        rows.append(dict(zip(columns, values + [""] * (len(columns) - len(values)))))
+    return rows
+
+def getMsiFileDirs(msi):
+    # The directories that files of an MSI are installed into, as lists of
+    # path components, resolved from its Directory, Component and File
+    # tables. The root directory and special folders (like
+    # ProgramFilesFolder) may be named differently when extracted, so the
+    # paths are only matched by what they end with.
+    dirs = {}
+    for row in readMsiTable(msi, "Directory"):
+        # DefaultDir is [target:]source, each [short|]long; "." means the
+        # parent directory itself.
+        name = row["DefaultDir"].split(":")[0].split("|")[-1]
+        dirs[row["Directory"]] = (row["Directory_Parent"], name)
+    def resolve(dir):
+        path = []
+        while dir in dirs and len(path) <= len(dirs):
+            parent, name = dirs[dir]
+            if parent == "" or parent == dir:
+                break
+            if name != ".":
+                path.insert(0, name)
+            dir = parent
+        if dir not in dirs:
+            raise ValueError("Unknown directory %s in %s" % (dir, msi))
+        return path
+    components = {}
+    for row in readMsiTable(msi, "Component"):
+        components[row["Component"]] = row["Directory_"]
+    found = []
+    for dir in set(components[row["Component_"]] for row in readMsiTable(msi, "File")):
+        found.append(resolve(dir))
+    return found
+
+def isMsiNeeded(msi, keep):
+    # Check if an MSI installs any files within the components in keep.
+    for path in getMsiFileDirs(msi):
+        if any(isKeptPath(path[i:], keep) for i in range(len(path))):
+            return True
+    return False
+
+def getMsiCabinets(msi):
+    # The names of the external CABs in the Media table of an MSI; the names
+    # of embedded ones start with "#".
+    return [row["Cabinet"] for row in readMsiTable(msi, "Media") if row["Cabinet"] != "" and not row["Cabinet"].startswith("#")]
+
+def selectSDKInstallers(selected, cache, keep, download):
+    # Pick the MSIs of the SDK packages that install files within the
+    # components in keep, and the external CABs they refer to. The MSIs are
+    # small, so they are downloaded first (with download(packages)), to read
+    # their tables with msiinfo. If the tables of an MSI can't be read, it
+    # and all CABs are kept. Returns the selection with the SDK packages
+    # replaced by copies with only those payloads.
+    if shutil.which("msiinfo") == None:
+        return selected
+    sdk = []
+    for p in selected:
+        if isSDKPackage(p):
+            sdk.append((p, [payload for payload in p["payloads"] if getPayloadName(payload).lower().endswith(".msi")]))
+    if len(sdk) == 0:
+        return selected
+    download([p.withPayloads(msis) for p, msis in sdk])
+
+    replaced = {}
+    for p, msis in sdk:
+        cabs = {}
+        for payload in p["payloads"]:
+            if getPayloadName(payload).lower().endswith(".cab"):
+                cabs[getPayloadName(payload).lower()] = payload
+        referenced = set()
+        needed = 0
+        for payload in msis:
+            msi = os.path.join(cache, getPackageKey(p), getPayloadName(payload))
+            try:
+                if not isMsiNeeded(msi, keep):
+                    continue
+                names = [name.split("\\")[-1].lower() for name in getMsiCabinets(msi)]
+            except (OSError, ValueError, KeyError, IndexError, subprocess.CalledProcessError) as e:
+                print("Unable to read the tables of %s, keeping all cabinets: %s" % (getPayloadName(payload), e))
+                names = list(cabs.keys())
+            needed += 1
+            referenced.add(id(payload))
+            referenced.update(id(cabs[name]) for name in names if name in cabs)
+        payloads = [payload for payload in p["payloads"] if id(payload) in referenced or not getPayloadName(payload).lower().endswith((".msi", ".cab"))]
+        print("Using %d of %d installers and %d of %d cabinets of %s, %s of %s" % (needed, len(msis), len(referenced) - needed, len(cabs), p["id"], formatSize(sumDownloadSize([p.withPayloads(payloads)])), formatSize(sumDownloadSize([p]))), flush=True)
+        replaced[id(p)] = p.withPayloads(payloads)
+    return [replaced.get(id(p), p) for p in selected]
+
+def unpackWin10SDK(src, payloads, dest, jobs=1):
     # Note, this extracts some files into Program Files/..., and some
     # files directly in the root unpack directory. The files we need
     # are under Program Files/... though.
     # On Windows, msiexec extracts files to the root unpack directory.
     # To be consistent, symlink Program Files to root.
-    if sys.platform != "win32" and not os.access(os.path.join(dest, "Program Files"), os.F_OK):
-        os.symlink(".", os.path.join(dest, "Program Files"), target_is_directory=True)
+    linkProgramFiles(dest)
 
+    msis = []
     for payload in payloads:
         name = getPayloadName(payload)
         if name.endswith(".msi"):
-            print("Extracting " + name)
-            srcfile = os.path.join(src, name)
-            if sys.platform == "win32":
-                # The path to TARGETDIR need to be quoted in the case of spaces.
-                cmd = "msiexec /a \"%s\" /qn TARGETDIR=\"%s\"" % (srcfile, os.path.abspath(dest))
-            else:
-                cmd = ["msiextract", "-C", dest, srcfile]
-            with open(os.path.join(dest, "WinSDK-" + getPayloadName(payload) + "-listing.txt"), "w") as log:
-                subprocess.check_call(cmd, stdout=log)
+            msis.append((os.path.join(src, name), os.path.join(dest, "WinSDK-" + name + "-listing.txt")))
+    extractMsis(msis, dest, jobs)
+
+def findListedFiles(listings, dest, name):
+    # Find extracted files with the given name, from the MSI listings.
+    found = []
+    for listing in listings:
+        with open(listing, "r") as f:
+            for line in f:
+                line = line.strip()
+                if os.path.basename(line.replace("\\", "/")) != name:
+                    continue
+                for path in [line, os.path.join(dest, line)]:
+                    if os.path.isfile(path) and path not in found:
+                        found.append(path)
+                        break
+    return found
 
-def unpackWin10WDK(src, dest):
+def unpackWin10WDK(src, dest, jobs=1):
     print("Unpacking WDK installers from", src)
 
     # WDK installers downloaded by wdksetup.exe include a huge pile of
     # non-WDK installers, just skip these.
+    # Do not try to run msiexec here because TARGETDIR
+    # does not work with WDK installers.
+    msis = []
     for srcfile in glob.glob(src + "/Windows Driver*.msi"):
-        name = os.path.basename(srcfile)
-        print("Extracting", name)
-
-        # Do not try to run msiexec here because TARGETDIR
-        # does not work with WDK installers.
-        cmd = ["msiextract", "-C", dest, srcfile]
-
-        payloadName, _ = os.path.splitext(name)
-        with open(os.path.join(dest, "WDK-" + payloadName + "-listing.txt"), "w") as log:
-            subprocess.check_call(cmd, stdout=log)
+        payloadName, _ = os.path.splitext(os.path.basename(srcfile))
+        msis.append((srcfile, os.path.join(dest, "WDK-" + payloadName + "-listing.txt")))
+    extractMsis(msis, dest, jobs)
 
     # WDK includes a VS extension, unpack it before copying the extracted files.
-    for vsix in glob.glob(dest + "/**/WDK.vsix", recursive=True):
+    vsixes = findListedFiles([listing for srcfile, listing in msis], dest, "WDK.vsix")
+    if len(vsixes) == 0:
+        vsixes = glob.glob(dest + "/**/WDK.vsix", recursive=True)
+    for vsix in vsixes:
         name = os.path.basename(vsix)
         print("Unpacking WDK VS extension", name)
 
@@ -767,25 +1953,117 @@ def unpackWin10WDK(src, dest):
         print("Moving", filename, "into version", wdkVersion);
         shutil.move(props, os.path.join(versionedPath, filename))
 
-def extractPackages(selected, cache, dest):
+def isSDKPackage(p):
+    return p["id"].startswith("Win10SDK") or p["id"].startswith("Win11SDK")
+
+def extractPackage(p, cache, dest, jobs=1, keep=None):
+    type = p["type"]
+    dir = os.path.join(cache, getPackageKey(p))
+    if type == "Component" or type == "Workload" or type == "Group":
+        return
+    if type == "Vsix":
+        print("Unpacking " + p["id"], flush=True)
+        for payload in p["payloads"]:
+            unpackVsix(os.path.join(dir, getPayloadName(payload)), dest, os.path.join(dest, getPackageKey(p) + "-listing.txt"), keep)
+    elif isSDKPackage(p):
+        print("Unpacking " + p["id"], flush=True)
+        unpackWin10SDK(dir, p["payloads"], dest, jobs)
+    else:
+        print("Skipping unpacking of " + p["id"] + " of type " + type, flush=True)
+
+def extractPackages(selected, cache, dest, jobs=1, keep=None, track=False):
+    # If track is set, return the files extracted for each package key.
+    if jobs > 1 or track:
+        extractor = StagedExtractor(selected, cache, dest, jobs, keep, track)
+        for p in selected:
+            extractor.submit(p)
+        extractor.finish()
+        return extractor.files
     makedirs(dest)
     # The path name casing is not consistent across packages, or even within a single package.
     # Manually create top-level folders before extracting packages to ensure the desired casing.
     makedirs(os.path.join(dest, "MSBuild"))
     for p in selected:
-        type = p["type"]
-        dir = os.path.join(cache, getPackageKey(p))
-        if type == "Component" or type == "Workload" or type == "Group":
-            continue
-        if type == "Vsix":
-            print("Unpacking " + p["id"])
-            for payload in p["payloads"]:
-                unpackVsix(os.path.join(dir, getPayloadName(payload)), dest, os.path.join(dest, getPackageKey(p) + "-listing.txt"))
-        elif p["id"].startswith("Win10SDK") or p["id"].startswith("Win11SDK"):
-            print("Unpacking " + p["id"])
-            unpackWin10SDK(dir, p["payloads"], dest)
-        else:
-            print("Skipping unpacking of " + p["id"] + " of type " + type)
+        with timed(p["id"], "extract", package=getPackageKey(p)):
+            extractPackage(p, cache, dest, keep=keep)
+    return None
+
+def mergeStaging(staging, dest, ignoreCase=True, moved=None):
+    # Symlinks (like the "Program Files" symlink created when unpacking the
+    # SDK) point within the staging directory; keep the existing ones in dest.
+    for n in os.listdir(staging):
+        if os.path.islink(os.path.join(staging, n)):
+            if not os.path.lexists(os.path.join(dest, n)):
+                os.rename(os.path.join(staging, n), os.path.join(dest, n))
+            else:
+                os.remove(os.path.join(staging, n))
+    mergeTrees(staging, dest, ignoreCase, moved)
+    shutil.rmtree(staging)
+
+def _extractStaged(p, cache, staging, dest, jobs, keep):
+    start = time.time()
+    makedirs(os.path.join(staging, "MSBuild"))
+    extractPackage(p, cache, staging, jobs, keep)
+    # Make the listings refer to the final destination.
+    for listing in glob.glob(os.path.join(glob.escape(staging), "*-listing.txt")):
+        with open(listing, "r") as f:
+            content = f.read()
+        if staging in content:
+            with open(listing, "w") as f:
+                f.write(content.replace(staging, dest))
+    # The MSIs of the SDK are extracted as is, without ignoring case,
+    # when extracted directly in the destination directory. The timing is
+    # recorded by the parent process.
+    return staging, not isSDKPackage(p), (start, time.time(), getWorker())
+
+class StagedExtractor:
+    # Extracts packages in parallel, in a pool of processes. Each package is
+    # extracted into a separate staging directory, which are merged into
+    # dest in the order of the selection, to get the same result as when
+    # extracting them one at a time. Packages can be submitted in any order,
+    # e.g. as they finish downloading. If track is set, the files merged
+    # into dest are recorded in files, for each package key.
+    def __init__(self, selected, cache, dest, jobs, keep=None, track=False):
+        self.cache = cache
+        self.dest = dest
+        self.jobs = jobs
+        self.keep = keep
+        self.files = {} if track else None
+        self.staging = os.path.join(dest, ".staging")
+        self.selected = selected
+        self.order = [id(p) for p in selected]
+        self.tasks = {}
+        self.merged = 0
+        makedirs(dest)
+        makedirs(os.path.join(dest, "MSBuild"))
+        shutil.rmtree(self.staging, ignore_errors=True)
+        self.pool = multiprocessing.Pool(jobs)
+
+    def submit(self, p):
+        staging = os.path.join(self.staging, str(self.order.index(id(p))))
+        self.tasks[id(p)] = self.pool.apply_async(_extractStaged, (p, self.cache, staging, self.dest, self.jobs, self.keep))
+        self.mergeReady()
+
+    def mergeReady(self, wait=False):
+        while self.merged < len(self.order):
+            task = self.tasks.get(self.order[self.merged])
+            if task == None or (not wait and not task.ready()):
+                return
+            staging, ignoreCase, (start, end, worker) = task.get()
+            p = self.selected[self.merged]
+            if timings != None:
+                timings.add(p["id"], "extract", start, end, { "package": getPackageKey(p) }, worker)
+            moved = {} if self.files != None else None
+            with timed(p["id"], "merge", package=getPackageKey(p)):
+                mergeStaging(staging, self.dest, ignoreCase, moved)
+            if moved != None:
+                self.files[getPackageKey(p)] = list(moved.values())
+            self.merged += 1
+
+    def finish(self):
+        self.mergeReady(wait=True)
+        self.pool.close()
+        shutil.rmtree(self.staging, ignore_errors=True)
 
 def patchPackages(dest):
     patches = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patches")
@@ -809,6 +2087,9 @@ def patchPackages(dest):
         else:
             print("Copying " + p)
             os.makedirs(os.path.dirname(os.path.join(dest, p)), exist_ok=True)
+            # Don't write into a file that is hardlinked by --dedupe.
+            if os.path.lexists(os.path.join(dest, p)):
+                os.remove(os.path.join(dest, p))
             shutil.copyfile(patch, os.path.join(dest, p))
 
 def copyDependentAssemblies(app):
@@ -823,32 +2104,428 @@ def copyDependentAssemblies(app):
         if os.path.isfile(src):
             shutil.copy(src, dest)
 
-def moveVCSDK(unpack, dest):
+def moveVCSDK(unpack, dest, moved=None, skip=None):
     # Move some components out from the unpack directory,
     # allowing the rest of unpacked files to be removed.
-    components = [
-        "VC",
-        "Windows Kits",
-        # The DIA SDK isn't necessary for normal use, but can be used when e.g.
-        # compiling LLVM.
-        "DIA SDK",
-        # MSBuild is the standard VC build tool.
-        "MSBuild",
-        # This directory contains batch scripts to setup Developer Command Prompt.
-        # Environment variable VS170COMNTOOLS points to this directory, and some
-        # tools use it to locate VS installation root and MSVC toolchains.
-        os.path.join("Common7", "Tools"),
-    ]
-    for dir in filter(None, components):
-        mergeTrees(os.path.join(unpack, dir), os.path.join(dest, dir))
+    for dir in getVCSDKComponents():
+        mergeTrees(os.path.join(unpack, dir), os.path.join(dest, dir), moved=moved, skip=skip)
+
+def getInstallStateFile(dest):
+    return os.path.join(dest, ".vsdownload-state.json")
+
+def loadInstallState(dest):
+    # The install state maps the key of each installed package to the
+    # digests of its payloads and the files it installed, relative to dest.
+    try:
+        with open(getInstallStateFile(dest), "r") as f:
+            return json.load(f)["packages"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def saveInstallState(dest, state):
+    writeFileAtomic(getInstallStateFile(dest), json.dumps({ "packages": state }, indent=1, sort_keys=True).encode("utf-8"))
+
+def getPayloadDigests(p):
+    return [payload.get("sha256") for payload in p.get("payloads", [])]
+
+def getWDKDigests(src):
+    # The WDK installers are unpacked like a package, identified by the
+    # names, sizes and modification times of the installers.
+    digests = []
+    for srcfile in sorted(glob.glob(src + "/Windows Driver*.msi")):
+        st = os.stat(srcfile)
+        digests.append("%s:%d:%d" % (os.path.basename(srcfile), st.st_size, st.st_mtime_ns))
+    return digests
+
+def getInstallDelta(selected, state, wdk=None):
+    # Split the selected packages into the ones that need to be installed,
+    # and the state of the ones that already are installed.
+    installed = {}
+    for p in selected:
+        key = getPackageKey(p)
+        entry = state.get(key)
+        if entry != None and entry["payloads"] == getPayloadDigests(p):
+            installed[key] = entry
+    if wdk != None and "$WDK" in state and state["$WDK"]["payloads"] == wdk:
+        installed["$WDK"] = state["$WDK"]
+    elif wdk != None or "$WDK" in state:
+        # Unpacking the WDK restructures files from the SDK packages.
+        for p in selected:
+            if isSDKPackage(p):
+                installed.pop(getPackageKey(p), None)
+    # Files of removed packages may have overwritten files of the packages
+    # that are kept; reinstall those packages to restore such files.
+    dropped = set()
+    for key, entry in state.items():
+        if key not in installed:
+            dropped.update(entry["files"])
+    for key in list(installed.keys()):
+        if not dropped.isdisjoint(installed[key]["files"]):
+            del installed[key]
+    install = [p for p in selected if getPackageKey(p) not in installed]
+    return install, installed
+
+def getInstalledFilter(dest, selected, extracted, installed):
+    # When installing all packages, files extracted by later packages
+    # overwrite files from earlier ones. Return a function for mergeTrees,
+    # that skips overwriting files in dest that belong to an installed
+    # package that is later than the package that extracted the file.
+    order = {}
+    for i, p in enumerate(selected):
+        order[getPackageKey(p)] = i
+    order["$WDK"] = len(selected)
+    writers = {}
+    for key in sorted(extracted.keys(), key=lambda key: order[key]):
+        for f in extracted[key]:
+            writers[f] = order[key]
+    owners = {}
+    for key, entry in installed.items():
+        for f in entry["files"]:
+            owners[f] = max(owners.get(f, -1), order[key])
+    def skip(src, destname):
+        if src not in writers:
+            return False
+        return owners.get(os.path.relpath(destname, dest), -1) > writers[src]
+    return skip
+
+def removeEmptyDirs(dir, top, removed=None):
+    # If removed is set, the removed directories are added to it.
+    while dir != top and dir.startswith(top):
+        try:
+            os.rmdir(dir)
+        except OSError:
+            return
+        if removed != None:
+            removed.add(dir)
+        dir = os.path.dirname(dir)
+
+def removeDroppedFiles(dest, state, installed):
+    # Remove the files of packages that no longer are installed, unless
+    # they also belong to a package that is kept.
+    keep = set()
+    for entry in installed.values():
+        keep.update(entry["files"])
+    removed = set()
+    for key, entry in state.items():
+        if key in installed:
+            continue
+        print("Removing " + key)
+        for f in entry["files"]:
+            if f in keep:
+                continue
+            path = os.path.join(dest, f)
+            if os.path.islink(path) or os.path.isfile(path):
+                os.remove(path)
+                removed.add(path)
+                removeEmptyDirs(os.path.dirname(path), dest, removed)
+    if len(removed) == 0:
+        return
+    # Also remove the symlinks that pointed at the removed files, like the
+    # ones added by install.sh (e.g. the lowercase names).
+    def isRemoved(path):
+        while path != dest and path.startswith(dest):
+            if path in removed:
+                return True
+            path = os.path.dirname(path)
+        return False
+    # Removing the links may leave more directories empty, which other
+    # links may point at.
+    while True:
+        links = []
+        for dir, dirs, files in os.walk(dest):
+            for n in dirs + files:
+                path = os.path.join(dir, n)
+                if os.path.islink(path) and not os.path.exists(path) and isRemoved(os.path.normpath(os.path.join(dir, os.readlink(path)))):
+                    links.append(path)
+        if len(links) == 0:
+            break
+        for path in links:
+            os.remove(path)
+        for path in links:
+            removeEmptyDirs(os.path.dirname(path), dest, removed)
+
+def snapshotTree(dir):
+    snapshot = {}
+    for f in listTree(dir):
+        st = os.lstat(os.path.join(dir, f))
+        snapshot[os.path.join(dir, f)] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    return snapshot
+
+def getInstalledFiles(dest, extracted, moved):
+    # Map the files extracted into the unpack directory, to the files that
+    # were moved into dest.
+    files = set()
+    for f in extracted:
+        if f in moved:
+            files.add(os.path.relpath(moved[f], dest))
+    return sorted(files)
+
+def findDuplicates(dir, jobs=1):
+    # Group the files by size first, and only hash the ones that have the
+    # same size as another file. Files that already are hardlinked to each
+    # other are treated as one.
+    bySize = {}
+    for f in listTree(dir):
+        path = os.path.join(dir, f)
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            continue
+        inodes = bySize.setdefault((st.st_dev, st.st_size), {})
+        inodes.setdefault(st.st_ino, []).append(path)
+    candidates = [sorted(paths) for inodes in bySize.values() if len(inodes) > 1 for paths in inodes.values()]
+    if len(candidates) == 0:
+        return []
+    print("Hashing %d files with the same size as another file" % (len(candidates)), flush=True)
+    with multiprocessing.Pool(max(jobs, 1)) as pool:
+        digests = pool.map(sha256File, [paths[0] for paths in candidates], chunksize=16)
+    groups = {}
+    for paths, digest in zip(candidates, digests):
+        st = os.lstat(paths[0])
+        groups.setdefault((st.st_dev, st.st_size, digest), []).append(paths)
+    return [sorted(g) for g in groups.values() if len(g) > 1]
+
+def reflinkFile(src, dest):
+    # Replace dest with a copy-on-write clone of src, on filesystems that
+    # support it (like Btrfs and XFS on Linux).
+    import fcntl
+    FICLONE = 0x40049409
+    tmp = dest + ".link"
+    try:
+        with open(src, "rb") as s, open(tmp, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copymode(dest, tmp)
+        os.replace(tmp, dest)
+    except:
+        if os.access(tmp, os.F_OK):
+            os.remove(tmp)
+        raise
+
+def dedupeTree(dir, mode="hardlink", dryRun=False, jobs=1):
+    groups = findDuplicates(dir, jobs)
+    files = 0
+    saved = 0
+    try:
+        for g in groups:
+            src = g[0][0]
+            for paths in g[1:]:
+                st = os.lstat(paths[0])
+                if not dryRun:
+                    for path in paths:
+                        if mode == "reflink":
+                            reflinkFile(src, path)
+                        else:
+                            linkFile(src, path)
+                files += len(paths)
+                # The space only is freed if there are no other links to the
+                # file, outside of dir.
+                if st.st_nlink <= len(paths):
+                    saved += st.st_size
+    except OSError as e:
+        print("Unable to %s files: %s" % (mode, e))
+    if dryRun:
+        print("Deduplicating would replace %d files with %ss, saving %s" % (files, mode, formatSize(saved)))
+    else:
+        print("Replaced %d files with %ss, saving %s" % (files, mode, formatSize(saved)))
+
+def getLayoutEntries(dest, exclude=None):
+    # The directories and the files and symlinks of a destination directory,
+    # relative to it, with the files grouped by inode, so that hardlinks can
+    # be kept in the same chunk of the archive.
+    dirs = []
+    inodes = {}
+    for root, dirnames, filenames in os.walk(dest):
+        rel = os.path.relpath(root, dest)
+        for n in list(dirnames):
+            if os.path.islink(os.path.join(root, n)):
+                dirnames.remove(n)
+                filenames.append(n)
+            else:
+                dirs.append(os.path.normpath(os.path.join(rel, n)))
+        for n in filenames:
+            path = os.path.join(root, n)
+            if path == exclude:
+                continue
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                inodes.setdefault((st.st_dev, st.st_ino), []).append(os.path.normpath(os.path.join(rel, n)))
+            elif stat.S_ISLNK(st.st_mode):
+                inodes[path] = [os.path.normpath(os.path.join(rel, n))]
+    return sorted(dirs), [sorted(paths) for paths in inodes.values()]
+
+def getRelocatedFiles(dest, files):
+    # The files written by install.sh that contain the absolute path of the
+    # destination, like the VFS overlay. The unpacked components aren't
+    # searched, as they can't refer to it.
+    components = set(c.lower() for c in getVCSDKComponents()) | set(["vc", "kits"])
+    root = os.path.abspath(dest).encode("utf-8")
+    found = []
+    for f in files:
+        if f.split(os.sep)[0].lower() in components or f.replace(os.sep, "/").lower().startswith("common7/tools/"):
+            continue
+        path = os.path.join(dest, f)
+        if os.path.islink(path):
+            continue
+        if root in readFile(path):
+            found.append(f)
+    return found
+
+def _exportLayoutChunk(dest, groups, file):
+    # Write the files of a chunk into a compressed tar file, and return their
+    # entries for the manifest.
+    entries = {}
+    with tarfile.open(file, "w:gz", compresslevel=6) as tar:
+        for paths in groups:
+            for f in paths:
+                path = os.path.join(dest, f)
+                info = tar.gettarinfo(path, f.replace(os.sep, "/"))
+                info.uid = info.gid = 0
+                info.uname = info.gname = ""
+                if info.isreg():
+                    with open(path, "rb") as fh:
+                        tar.addfile(info, fh)
+                    entries[f] = { "size": info.size, "sha256": sha256File(path) }
+                else:
+                    tar.addfile(info)
+                    if info.issym():
+                        entries[f] = { "symlink": info.linkname }
+                    else:
+                        entries[f] = { "link": info.linkname.replace("/", os.sep) }
+    return entries
+
+def exportLayout(dest, file, jobs=1, chunks=16):
+    # Pack an installed destination directory into an uncompressed tar file
+    # of a manifest and a number of independently compressed chunks, which
+    # can be unpacked in parallel.
+    dest = os.path.abspath(dest)
+    file = os.path.abspath(file)
+    if not os.path.isdir(os.path.join(dest, "bin")):
+        print("WARNING: %s doesn't look like a directory that install.sh has been run in" % (dest))
+    dirs, groups = getLayoutEntries(dest, exclude=file)
+    # Spread the files over the chunks by size, largest first.
+    assigned = [[] for i in range(chunks)]
+    sizes = [0] * chunks
+    for paths in sorted(groups, key=lambda g: os.lstat(os.path.join(dest, g[0])).st_size, reverse=True):
+        i = sizes.index(min(sizes))
+        assigned[i].append(paths)
+        sizes[i] += os.lstat(os.path.join(dest, paths[0])).st_size
+    assigned = [a for a in assigned if len(a) > 0]
+    print("Packing %d files, %s, from %s" % (sum(len(g) for g in groups), formatSize(sum(sizes)), dest), flush=True)
+
+    tmpdir = tempfile.mkdtemp(prefix="vslayout-", dir=os.path.dirname(file))
+    try:
+        names = ["chunk-%d.tar.gz" % (i) for i in range(len(assigned))]
+        with multiprocessing.Pool(max(jobs, 1)) as pool:
+            results = pool.starmap(_exportLayoutChunk, [(dest, a, os.path.join(tmpdir, n)) for a, n in zip(assigned, names)])
+        files = {}
+        for i, entries in enumerate(results):
+            for f, entry in entries.items():
+                entry["chunk"] = names[i]
+                files[f] = entry
+        manifest = {
+            "version": 1,
+            "root": dest,
+            "chunks": names,
+            "dirs": dirs,
+            "files": files,
+            "relocate": getRelocatedFiles(dest, [f for f, entry in files.items() if "size" in entry]),
+        }
+        data = json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8")
+        tmp = file + ".tmp%d" % (os.getpid())
+        with tarfile.open(tmp, "w") as tar:
+            info = tarfile.TarInfo("manifest.json")
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+            for n in names:
+                tar.add(os.path.join(tmpdir, n), n)
+        os.replace(tmp, file)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    print("Wrote %s (%s)" % (file, formatSize(os.path.getsize(file))))
+
+def readLayoutManifest(file):
+    with tarfile.open(file, "r:") as tar:
+        manifest = json.loads(tar.extractfile("manifest.json").read())
+    if manifest.get("version") != 1:
+        raise Exception("Unsupported layout archive %s" % (file))
+    return manifest
+
+def _importLayoutChunk(file, name, dest, entries):
+    # Unpack a chunk and check its files against their entries in the
+    # manifest, while they still are cached. Returns the mismatching files.
+    with tarfile.open(file, "r:") as outer:
+        with tarfile.open(fileobj=outer.extractfile(name), mode="r|gz") as tar:
+            if hasattr(tarfile, "tar_filter"):
+                tar.extractall(dest, filter="tar")
+            else:
+                tar.extractall(dest)
+    bad = []
+    for f, entry in entries.items():
+        path = os.path.join(dest, f)
+        if "symlink" in entry:
+            ok = os.path.islink(path) and os.readlink(path) == entry["symlink"]
+        elif "link" in entry:
+            ok = os.path.isfile(path) and os.path.samefile(path, os.path.join(dest, entry["link"]))
+        else:
+            ok = os.path.isfile(path) and not os.path.islink(path) and os.path.getsize(path) == entry["size"] and sha256File(path) == entry["sha256"]
+        if not ok:
+            bad.append(f)
+    return bad
+
+def relocateLayout(dest, root, files):
+    # Replace the path the layout was exported from with dest, where it is
+    # followed by the end of the path.
+    pattern = re.compile(re.escape(root.encode("utf-8")) + rb"(?=[/\\\"'\s]|$)")
+    for f in files:
+        path = os.path.join(dest, f)
+        data = readFile(path)
+        mode = os.stat(path).st_mode
+        writeFileAtomic(path, pattern.sub(lambda m: dest.encode("utf-8"), data))
+        os.chmod(path, stat.S_IMODE(mode))
+
+def importLayout(file, dest, jobs=1):
+    dest = os.path.abspath(dest)
+    if os.path.isdir(dest) and len(os.listdir(dest)) > 0:
+        print("%s is not empty!" % (dest))
+        sys.exit(1)
+    start = time.time()
+    manifest = readLayoutManifest(file)
+    for d in manifest["dirs"]:
+        makedirs(os.path.join(dest, d))
+    byChunk = {}
+    for f, entry in manifest["files"].items():
+        byChunk.setdefault(entry["chunk"], {})[f] = entry
+    print("Unpacking %d files from %s" % (len(manifest["files"]), file), flush=True)
+    with multiprocessing.Pool(max(jobs, 1)) as pool:
+        results = pool.starmap(_importLayoutChunk, [(file, n, dest, byChunk.get(n, {})) for n in manifest["chunks"]])
+    bad = [f for r in results for f in r]
+    if len(bad) > 0:
+        for f in sorted(bad)[:20]:
+            print("Mismatching file %s" % (f))
+        raise Exception("%d files of %s don't match its manifest" % (len(bad), file))
+    if manifest["root"] != dest:
+        relocateLayout(dest, manifest["root"], manifest["relocate"])
+    print("Installed %s into %s in %.1f s" % (formatSize(sum(e.get("size", 0) for e in manifest["files"].values())), dest, time.time() - start))
 
 if __name__ == "__main__":
     parser = getArgsParser()
     args = parser.parse_args()
     lowercaseIgnores(args)
+    if args.timings != None:
+        timings = Timings()
 
     socket.setdefaulttimeout(15)
 
+    if args.export_layout != None or args.import_layout != None:
+        if args.dest == None:
+            print("No destination directory set!")
+            sys.exit(1)
+        if args.export_layout != None:
+            exportLayout(args.dest, args.export_layout, args.unpack_jobs)
+        else:
+            importLayout(args.import_layout, args.dest, args.unpack_jobs)
+        sys.exit(0)
+
     if args.host_arch is None:
         args.host_arch = platform.machine().lower()
         if platform.system() == "Darwin":
@@ -868,19 +2545,21 @@ if __name__ == "__main__":
     else:
         print("Install packages for %s host architecture" % args.host_arch)
 
-    packages = getPackages(getManifest(args), args.host_arch)
+    with timed("manifest", "phase"):
+        packages = loadPackages(args)
 
     if args.print_version:
         sys.exit(0)
 
     if not args.accept_license:
-        response = input("Do you accept the license at " + findPackage(packages, "Microsoft.VisualStudio.Product.BuildTools")["localizedResources"][0]["license"] + " (yes/no)? ")
+        response = input("Do you accept the license at " + findPackage(packages, "Microsoft.VisualStudio.Product.BuildTools")["license"] + " (yes/no)? ")
         while response != "yes" and response != "no":
             response = input("Do you accept the license? Answer \"yes\" or \"no\": ")
         if response == "no":
             sys.exit(0)
 
-    setPackageSelection(args, packages)
+    with timed("selection", "phase"):
+        setPackageSelection(args, packages)
 
     if args.list_components or args.list_workloads or args.list_packages:
         if args.list_components:
@@ -891,17 +2570,25 @@ if __name__ == "__main__":
             listPackageType(packages, None)
         sys.exit(0)
 
+    with timed("dependencies", "phase"):
+        graph = DependencyGraph(packages, args)
+
     if args.print_deps_tree:
         for i in args.package:
-            printDepends(packages, i, {}, "", args)
+            graph.printDepends(i)
         sys.exit(0)
 
     if args.print_reverse_deps:
         for i in args.package:
-            printReverseDepends(packages, i, "", "", args)
+            graph.printReverseDepends(i)
+        sys.exit(0)
+
+    if args.print_deps_graph:
+        graph.printGraph(args.package, args.print_deps_graph)
         sys.exit(0)
 
-    selected = getSelectedPackages(packages, args)
+    with timed("resolve", "phase"):
+        selected = getSelectedPackages(packages, args, graph)
 
     if args.print_selection:
         printPackageList(selected)
@@ -911,6 +2598,17 @@ if __name__ == "__main__":
     if args.print_selection:
         sys.exit(0)
 
+    if args.cache_gc:
+        if args.cache == None:
+            print("No cache directory set!")
+            sys.exit(1)
+        cleanCache(os.path.abspath(args.cache), selected)
+        sys.exit(0)
+
+    if args.incremental and (args.only_unpack or args.keep_unpack):
+        print("--incremental can't be used with --only-unpack or --keep-unpack")
+        sys.exit(1)
+
     tempcache = None
     if args.cache != None:
         cache = os.path.abspath(args.cache)
@@ -923,21 +2621,81 @@ if __name__ == "__main__":
         sys.exit(1)
 
     try:
-        downloadPackages(selected, cache, allowHashMismatch=args.only_download)
+        blobdir = None
+        if args.cache_by_hash and tempcache == None:
+            blobdir = os.path.join(cache, "blobs")
+        extractor = None
+        install = selected
+        track = False
+        state = None
+        installed = {}
+        if not args.only_download:
+            dest = os.path.abspath(args.dest)
+
+            if args.only_unpack:
+                unpack = dest
+            else:
+                unpack = os.path.join(dest, "unpack")
+
+            # Only the components that are moved out of the unpack directory
+            # need to be extracted from the VSIX packages, unless the whole
+            # unpack directory is kept.
+            keep = None
+            if not args.only_unpack and not args.keep_unpack:
+                keep = getVCSDKComponents()
+                # Likewise, only the installers of the SDK with files in
+                # those components need to be downloaded and extracted.
+                with timed("sdk", "phase"):
+                    selected = selectSDKInstallers(selected, cache, keep, lambda l: downloadPackages(l, cache, blobdir=blobdir, paranoid=args.paranoid, jobs=args.jobs, jobsPerHost=args.jobs_per_host))
+                install = selected
+
+            # Keep track of which files each package installed, so that a
+            # later run only needs to install the packages that changed, and
+            # remove the files of packages that no longer are selected.
+            track = args.incremental
+            if track:
+                state = loadInstallState(dest)
+                if state != None and not args.full_install:
+                    wdk = None
+                    if args.with_wdk_installers is not None:
+                        wdk = getWDKDigests(args.with_wdk_installers)
+                    install, installed = getInstallDelta(selected, state, wdk)
+                    print("%d packages already installed, %d packages to install" % (len(selected) - len(install), len(install)))
+                shutil.rmtree(unpack, ignore_errors=True)
+            elif os.access(getInstallStateFile(dest), os.F_OK):
+                # The files installed now aren't tracked.
+                os.remove(getInstallStateFile(dest))
+
+            if args.pipeline:
+                extractor = StagedExtractor(install, cache, unpack, max(args.unpack_jobs, 1), keep, track)
+
+        with timed("download", "phase"):
+            downloadPackages(install, cache, allowHashMismatch=args.only_download, blobdir=blobdir, paranoid=args.paranoid, jobs=args.jobs, jobsPerHost=args.jobs_per_host, packageDone=extractor.submit if extractor != None else None)
+        if args.cache_max_size != None and tempcache == None:
+            cleanCache(cache, selected, args.cache_max_size)
         if args.only_download:
             sys.exit(0)
 
-        dest = os.path.abspath(args.dest)
-
-        if args.only_unpack:
-            unpack = dest
-        else:
-            unpack = os.path.join(dest, "unpack")
-
-        extractPackages(selected, cache, unpack)
-
-        if args.with_wdk_installers is not None:
-            unpackWin10WDK(args.with_wdk_installers, unpack)
+        with timed("extract", "phase"):
+            if extractor != None:
+                extractor.finish()
+                extracted = extractor.files
+            else:
+                extracted = extractPackages(install, cache, unpack, args.unpack_jobs, keep, track)
+
+        if args.with_wdk_installers is not None and "$WDK" not in installed:
+            if track:
+                # The SDK packages may already be installed; unpack the WDK
+                # in the same layout as if they were unpacked now.
+                if any(isSDKPackage(p) for p in selected):
+                    makedirs(unpack)
+                    linkProgramFiles(unpack)
+                before = snapshotTree(unpack)
+            with timed("wdk", "phase"):
+                unpackWin10WDK(args.with_wdk_installers, unpack, args.unpack_jobs)
+            if track:
+                extracted["$WDK"] = [f for f, st in snapshotTree(unpack).items() if before.get(f) != st]
+                wdk = getWDKDigests(args.with_wdk_installers)
 
         if sys.platform != "win32":
             # Wine doesn't support dependentAssembly yet.
@@ -946,11 +2704,35 @@ if __name__ == "__main__":
             copyDependentAssemblies(os.path.join(unpack, "MSBuild", "Current", "Bin", "arm64", "MSBuild.exe"))
 
         if not args.only_unpack:
-            moveVCSDK(unpack, dest)
-            if not args.keep_unpack:
-                shutil.rmtree(unpack)
+            if state != None:
+                removeDroppedFiles(dest, state, installed)
+            moved = None
+            skip = None
+            if track:
+                moved = {}
+                skip = getInstalledFilter(dest, selected, extracted, installed)
+            with timed("move", "phase"):
+                moveVCSDK(unpack, dest, moved, skip)
+                if not args.keep_unpack:
+                    shutil.rmtree(unpack)
             if not args.skip_patch and args.major == 18: # Only apply patches to latest VS
-                patchPackages(dest)
+                with timed("patch", "phase"):
+                    patchPackages(dest)
+            if track:
+                for key, files in extracted.items():
+                    installed[key] = { "payloads": [], "files": getInstalledFiles(dest, files, moved) }
+                for p in install:
+                    installed[getPackageKey(p)]["payloads"] = getPayloadDigests(p)
+                if "$WDK" in extracted:
+                    installed["$WDK"]["payloads"] = wdk
+                saveInstallState(dest, installed)
+
+        if args.dedupe != None or args.dedupe_dry_run:
+            with timed("dedupe", "phase"):
+                dedupeTree(dest, args.dedupe or "hardlink", args.dedupe_dry_run, args.unpack_jobs)
     finally:
         if tempcache != None:
             shutil.rmtree(tempcache)
+        if timings != None:
+            timings.write(args.timings)
+            timings.printSummary()
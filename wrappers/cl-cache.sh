@@ -0,0 +1,451 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2026 Martin Storsjo
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# A cache of compiled objects for the cl wrapper, used when WINE_MSVC_CACHE
+# is set to a directory. WINE_MSVC_CACHE_SIZE sets its maximum size (like
+# 500M or 10G, 5G by default); the least recently used objects are removed
+# when it gets larger than that.
+#
+# Each source file of a compile is looked up by a hash of its contents, its
+# name, the other arguments and the toolchain version. The entry holds the
+# object file, the output of the compiler, and a manifest with hashes of
+# the source and all the headers it included (from /showIncludes), which
+# all need to be unchanged for the entry to be used. The source files that
+# miss are compiled in one call of cl, like without the cache.
+#
+# Only the headers that were included are checked: a new header that would
+# be found before one of them in the include path (like a new header next
+# to the source file, shadowing one in an /I directory) isn't noticed, and
+# the object from the cache is used. Clear the cache after adding such a
+# header.
+#
+# "cl --cache-stats" shows the statistics, "cl --cache-clear" empties it.
+
+CACHE=$WINE_MSVC_CACHE
+
+if command -v sha256sum >/dev/null; then
+    HASH=(sha256sum)
+else
+    HASH=(shasum -a 256)
+fi
+
+# Add $2 (or 1) to the counter $1 in $CACHE/counters. It is updated under
+# a lock, which is taken over after a second if a killed process left it
+# behind; the counts are only statistics, so losing an update then is fine.
+cache_count() {
+    local name=$1 n=${2:-1} tries=0 key value
+    local -A counts
+    until mkdir "$CACHE/counters.lock" 2>/dev/null; do
+        (( ++tries >= 100 )) && break
+        sleep 0.01
+    done
+    if [ -f "$CACHE/counters" ]; then
+        while read -r key value; do
+            counts[$key]=$value
+        done <"$CACHE/counters"
+    fi
+    counts[$name]=$(( ${counts[$name]:-0} + n ))
+    for key in "${!counts[@]}"; do
+        printf '%s %d\n' "$key" "${counts[$key]}"
+    done >"$CACHE/counters.tmp$$" && mv "$CACHE/counters.tmp$$" "$CACHE/counters"
+    rmdir "$CACHE/counters.lock" 2>/dev/null
+}
+
+cache_max_size() {
+    # In KiB, like du -k.
+    local size=${WINE_MSVC_CACHE_SIZE:-5G}
+    case "$size" in
+    *[kK]) max_size=$(( ${size%?} )) ;;
+    *[mM]) max_size=$(( ${size%?} * 1024 )) ;;
+    *[gG]) max_size=$(( ${size%?} * 1024 * 1024 )) ;;
+    *) max_size=$(( size / 1024 )) ;;
+    esac
+}
+
+cache_stats() {
+    local entries=("$CACHE"/??/*/) size
+    [ -d "${entries[0]}" ] || entries=()
+    size=$(du -sk "$CACHE" 2>/dev/null)
+    cache_max_size
+    cat "$CACHE/counters" 2>/dev/null | awk -v dir="$CACHE" -v entries=${#entries[@]} \
+        -v size=${size%%[!0-9]*} -v max=$max_size '
+        { count[$1] = $2 }
+        END {
+            lookups = count["hit"] + count["miss"]
+            printf "Cache directory  %s\n", dir
+            printf "Hits             %d\n", count["hit"]
+            printf "Misses           %d\n", count["miss"]
+            printf "Uncacheable      %d\n", count["uncacheable"]
+            printf "Hit rate         %.1f %%\n", lookups ? 100 * count["hit"] / lookups : 0
+            printf "Entries          %d\n", entries
+            printf "Size             %.1f MiB (max %.1f MiB)\n", size / 1024, max / 1024
+        }'
+}
+
+cache_clear() {
+    rm -rf "$CACHE"/?? "$CACHE"/tmp.* "$CACHE/counters"
+}
+
+# Remove the least recently used entries, until the cache is below 90% of
+# its maximum size.
+cache_evict() {
+    local size entry total
+    cache_max_size
+    total=$(du -sk "$CACHE")
+    total=${total%%[!0-9]*}
+    [ $total -le $max_size ] && return
+
+    local entries=("$CACHE"/??/*/)
+    ls -dtr -- "${entries[@]}" | tr '\n' '\0' | xargs -0 du -sk |
+    while IFS=$'\t' read -r size entry; do
+        [ $total -le $(( max_size * 9 / 10 )) ] && break
+        rm -rf "$entry"
+        rmdir "${entry%/*/}" 2>/dev/null
+        total=$(( total - size ))
+    done
+}
+
+# Find the file for a path printed by cl. Within Wine, the path can differ
+# in case from the file on disk, e.g. for headers that only have lowercase
+# names in a VFS overlay.
+cache_resolve() {
+    resolved=$1
+    [ -f "$resolved" ] && return 0
+
+    case "$resolved" in
+    *[][*?\\]*)
+        return 1
+        ;;
+    esac
+
+    # Match each component case insensitively, by making it a glob.
+    local IFS=/ part pattern= matches
+    for part in ${resolved#/}; do
+        case "$part" in
+        ''|.|..)
+            pattern+=${part:+/$part}
+            ;;
+        [!^!]*)
+            pattern+=/[${part:0:1}]${part:1}
+            ;;
+        *)
+            pattern+=/?${part:1}
+            ;;
+        esac
+    done
+    IFS=
+    shopt -s nocaseglob nullglob
+    matches=($pattern)
+    shopt -u nocaseglob nullglob
+    [ ${#matches[@]} -eq 1 ] && [ -f "${matches[0]}" ] || return 1
+    resolved=${matches[0]}
+}
+
+# Write the manifest for a source file, from the compiler output in $1.
+cache_manifest() {
+    local dir=$1 src=${2//\\//} line path file
+    [[ $src == /* ]] || src=$PWD/$src
+    local files=("$src")
+    local -A seen
+    for file in "$dir/stdout" "$dir/stderr"; do
+        while IFS= read -r line; do
+            case "$line" in
+            'Note: including file: '*)
+                path=${line#Note: including file: }
+                path=${path#"${path%%[! ]*}"}
+                [[ $path == /* ]] || path=$PWD/$path
+                cache_resolve "$path" || return 1
+                if [ -z "${seen[$resolved]}" ]; then
+                    seen[$resolved]=1
+                    files+=("$resolved")
+                fi
+                ;;
+            esac
+        done <"$file"
+    done
+    # Don't trust a missing list of headers, e.g. with a localized cl.
+    if [ ${#files[@]} -eq 1 ] && grep -q '#[[:blank:]]*\(include\|import\)' "$src"; then
+        return 1
+    fi
+    "${HASH[@]}" -- "${files[@]}" >"$dir/manifest"
+}
+
+# Replay the output stored in $1. The output on stderr is only about the
+# arguments, like unknown options, so it is replayed once for all source
+# files, unless $2 is set.
+cache_replay() {
+    if [ -n "$showincludes" ]; then
+        cat "$1/stdout"
+        [ -n "$2" ] || cat "$1/stderr" >&2
+    else
+        grep -v '^Note: including file: ' "$1/stdout"
+        [ -n "$2" ] || grep -v '^Note: including file: ' "$1/stderr" >&2
+    fi
+    return 0
+}
+
+# Set object (and pdb) to the output files for the source file $1.
+cache_outputs() {
+    local base=${1//\\//}
+    base=${base##*/}
+    base=${base%.*}.obj
+    case "$fo" in
+    '')
+        object=$base
+        ;;
+    */)
+        object=$fo$base
+        ;;
+    *)
+        if [ -d "$fo" ]; then
+            object=$fo/$base
+        else
+            object=$fo
+            [[ ${object##*/} == *.* ]] || object+=.obj
+        fi
+        ;;
+    esac
+
+    pdb=
+    if [ -n "$debug" ]; then
+        pdb=$fd
+        [[ ${pdb##*/} == *.* ]] || pdb+=.pdb
+    fi
+}
+
+# Copy the object (and pdb) of the entry $1 for the source file $2 into
+# place. This fails if the entry was replaced or evicted meanwhile.
+cache_restore() {
+    local entry=$1 src=$2
+    cache_outputs "$src"
+    cp "$entry/object" "$object" 2>/dev/null &&
+        { [ -z "$pdb" ] || cp "$entry/pdb" "$pdb" 2>/dev/null; }
+}
+
+# Move the entry $1 out of the way, if it exists, and remove it.
+cache_remove() {
+    local stale
+    [ -d "$1" ] || return 0
+    stale=$(mktemp -d "$CACHE/tmp.XXXXXX") || return 1
+    mv "$1" "$stale/" 2>/dev/null
+    rm -rf "$stale"
+}
+
+# Store the output in $1 for the source file $2 as the entry for the key $3.
+cache_store() {
+    local dir=$1 src=$2 key=$3
+    local entry=$CACHE/${key:0:2}/$key
+    cache_outputs "$src"
+    cache_manifest "$dir" "$src" && cp "$object" "$dir/object" &&
+        { [ -z "$pdb" ] || cp "$pdb" "$dir/pdb"; } || return 1
+    mkdir -p "${entry%/*}"
+    # Renaming the complete entry into place is atomic. If another build
+    # stored the same entry meanwhile, keep that one; mv then moves this one
+    # into it instead, which is removed again.
+    [ -e "$entry" ] || mv "$dir" "$entry" 2>/dev/null
+    rm -rf "$entry/${dir##*/}"
+}
+
+# Split the output of compiling the source files in missed, in $1/stdout,
+# into $1/<index>/stdout for each of them. cl prints the name of each source
+# file before compiling it, also with /MP. The output on stderr is the same
+# for all of them.
+cache_split() {
+    local dir=$1 i names=()
+    for i in "${!missed[@]}"; do
+        mkdir "$dir/$i" && cp "$dir/stderr" "$dir/$i/stderr" && : >"$dir/$i/stdout" || return 1
+        names+=("${missed[$i]//\\//}")
+        names[$i]=${names[$i]##*/}
+    done
+    awk -v dir="$dir" -v names="$(printf '%s\n' "${names[@]}")" '
+        BEGIN {
+            n = split(names, a, "\n")
+            for (i = 1; i <= n; i++)
+                idx[a[i]] = i - 1
+            cur = 0
+        }
+        {
+            name = $0
+            sub(/\r$/, "", name)
+            if (name in idx)
+                cur = idx[name]
+            print > (dir "/" cur "/stdout")
+        }' "$dir/stdout"
+}
+
+# Compile the source files in missed in one call of cl, and store the
+# result of each of them for its key in keys.
+cache_compile() {
+    local tmp ec i
+    tmp=$(mktemp -d "$CACHE/tmp.XXXXXX") || return 1
+
+    "$(dirname "$0")"/wine-msvc.sh "$BINDIR"/cl.exe "${args[@]}" /showIncludes "${missed[@]}" \
+        >"$tmp/stdout" 2>"$tmp/stderr"
+    ec=$?
+    cache_replay "$tmp"
+
+    # If any of them failed, it isn't known which; store none of them.
+    if [ $ec -eq 0 ] && cache_split "$tmp"; then
+        for i in "${!missed[@]}"; do
+            cache_store "$tmp/$i" "${missed[$i]}" "${keys[$i]}"
+        done
+        # Checking the size of the cache takes a while, so only do it now
+        # and then.
+        if [ $(( RANDOM % 16 )) -eq 0 ]; then
+            cache_evict
+        fi
+    fi
+    rm -rf "$tmp"
+    return $ec
+}
+
+cl_cache() {
+    if [ $# -eq 1 ]; then
+        case "$1" in
+        --cache-stats)
+            cache_stats
+            return
+            ;;
+        --cache-clear)
+            cache_clear
+            return
+            ;;
+        esac
+    fi
+
+    mkdir -p "$CACHE" || return 1
+
+    local a value= compile= uncacheable= fo= fd=
+    local showincludes= debug=
+    local sources=() args=()
+    for a; do
+        if [ -n "$value" ]; then
+            args+=("$a")
+            value=
+            continue
+        fi
+        case "$a" in
+        [!-]*.[cC]|[!-]*.[cC][cC]|[!-]*.[cC][pP][pP]|[!-]*.[cC][xX][xX]|[!-]*.[cC]++)
+            # Unix paths look like options, but exist.
+            if [ "${a:0:1}" != / ] || [ -f "$a" ]; then
+                sources+=("$a")
+                continue
+            fi
+            ;;
+        esac
+        case "$a" in
+        [-/]c)
+            compile=1
+            ;;
+        [-/]showIncludes)
+            showincludes=1
+            continue
+            ;;
+        [-/]Fo:*)
+            fo=${a:4}
+            ;;
+        [-/]Fo*)
+            fo=${a:3}
+            ;;
+        [-/]Fd:*)
+            fd=${a:4}
+            ;;
+        [-/]Fd*)
+            fd=${a:3}
+            ;;
+        [-/]Zi|[-/]ZI)
+            debug=1
+            ;;
+        [-/][IDU]|[-/]FI|[-/]AI|[-/]FU|[-/]external:I)
+            # The value is in the next argument.
+            value=1
+            ;;
+        [-/]E|[-/]EP|[-/]P|[-/]Y[cu]*|[-/]T[cp]*|[-/]link|[-/]F[aeimpRr]*|[-/]FA*|[-/]doc*|[-/]analyze*|[-/]sourceDependencies*|@*)
+            # Preprocessing, precompiled headers, linking and other outputs
+            # aren't handled.
+            uncacheable=1
+            ;;
+        esac
+        args+=("$a")
+    done
+    fo=${fo//\\//}
+    fd=${fd//\\//}
+
+    # Multiple source files need /Fo to be a directory.
+    if [ ${#sources[@]} -gt 1 ] && [ -n "$fo" ] && [[ $fo != */ ]] && [ ! -d "$fo" ]; then
+        uncacheable=1
+    fi
+    # The PDB file of /Zi can only be restored if it only is for this
+    # object, like with /Fdfoo.pdb for foo.obj.
+    if [ -n "$debug" ]; then
+        if [ ${#sources[@]} -eq 1 ] && [ -n "$fd" ] && [[ $fd != */ ]] && [ ! -d "$fd" ]; then
+            cache_outputs "${sources[0]}"
+            object=${object##*/}
+            case "${pdb##*/}" in
+            "${object%.*}.pdb"|"$object.pdb") ;;
+            *) uncacheable=1 ;;
+            esac
+        else
+            uncacheable=1
+        fi
+    fi
+    # The output of cl is split by the names of the source files.
+    local src
+    local -A names
+    for src in "${sources[@]}"; do
+        src=${src//\\//}
+        [ -z "${names[${src##*/}]}" ] || uncacheable=1
+        names[${src##*/}]=1
+    done
+    if [ -z "$compile" ] || [ ${#sources[@]} -eq 0 ] || [ -n "$uncacheable" ]; then
+        cache_count uncacheable
+        "$(dirname "$0")"/wine-msvc.sh "$BINDIR"/cl.exe "$@"
+        return
+    fi
+
+    local key entry ec=0
+    local hits=() missed=() keys=()
+    for src in "${sources[@]}"; do
+        key=$( { printf '%s\0' "$MSVCVER" "$SDKVER" "$ARCH" "$PWD" "$INCLUDE" "$CL" "$_CL_" "$VSLANG" \
+                 "${args[@]}" "$src"; cat -- "$src"; } | "${HASH[@]}" )
+        key=${key%% *}
+        entry=$CACHE/${key:0:2}/$key
+
+        if [ -f "$entry/object" ] && "${HASH[@]}" -c --status "$entry/manifest" 2>/dev/null &&
+           cache_restore "$entry" "$src"; then
+            hits+=("$entry")
+            touch "$entry"
+        else
+            # An entry with other headers is replaced.
+            cache_remove "$entry"
+            missed+=("$src")
+            keys+=("$key")
+        fi
+    done
+
+    # The output on stderr comes from cl itself if any source file missed.
+    local replayed=${missed[0]:+1}
+    for entry in "${hits[@]}"; do
+        cache_replay "$entry" $replayed
+        replayed=1
+    done
+    [ ${#hits[@]} -eq 0 ] || cache_count hit ${#hits[@]}
+    if [ ${#missed[@]} -gt 0 ]; then
+        cache_count miss ${#missed[@]}
+        cache_compile || ec=$?
+    fi
+    return $ec
+}
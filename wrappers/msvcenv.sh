@@ -17,11 +17,13 @@
 SDK=kits\\10
 SDK_UNIX=kits/10
 BASE_UNIX=$(cd "$(dirname "${BASH_SOURCE[0]}")"/.. && pwd)
-# Support having the wrappers in a directory one or two levels below the
-# installation directory.
-if [ ! -d "$BASE_UNIX/vc" ]; then
-    BASE_UNIX=$(cd "$BASE_UNIX"/.. && pwd)
-fi
+# Support having the wrappers in a directory one to three levels below the
+# installation directory (like bin/<msvcver>/<arch>).
+for i in 1 2; do
+    if [ ! -d "$BASE_UNIX/vc" ]; then
+        BASE_UNIX=$(cd "$BASE_UNIX"/.. && pwd)
+    fi
+done
 BASE=z:${BASE_UNIX//\//\\}
 MSVCVER=14.13.26128
 SDKVER=10.0.16299.0
@@ -18,12 +18,23 @@ MSVCTRICKS_EXE="$(dirname $0)/../msvctricks.exe"
 EXE=$1
 shift
 
-ARGS=()
-for a; do
-	path=
-	case "$a" in
+TMPFILES=()
+
+cleanup() {
+	wait
+	rm -rf "${TMPFILES[@]}"
+}
+
+trap cleanup EXIT
+
+# Rewrite an argument containing an absolute path into a z: path, setting
+# arg. This runs for every argument, so it avoids spawning any processes.
+translate() {
+	arg=$1
+	local path= dir
+	case "$arg" in
 	[-/][A-Za-z]/*)
-		path=${a#??}
+		path=${arg#??}
 		# Rewrite options like -I/absolute/path into -Iz:/absolute/path.
 		# This is needed to avoid what seems like a cl.exe/Wine bug combination
 		# in some very rare cases, see https://bugs.winehq.org/show_bug.cgi?id=55200
@@ -32,29 +43,178 @@ for a; do
 		# they have been specified as -Iz:/absolute/path.
 		;;
 	[-/][A-Za-z][A-Za-z]/*)
-		path=${a#???}
+		path=${arg#???}
 		# Rewrite options like -Fo/absolute/path into -Foz:/absolute/path.
 		# This doesn't seem to be strictly needed for any known case at the moment, but
 		# might have been needed with some version of MSVC or Wine earlier.
 		;;
 	[-/][A-Za-z][A-Za-z][A-Za-z]*:/*)
-		path=${a#*:}
+		path=${arg#*:}
 		# Rewrite options like -MANIFESTINPUT:/absolute/path into -MANIFESTINPUT:z:/absolute/path.
 		;;
 	/*)
 		# Rewrite options like /absolute/path into z:/absolute/path.
 		# This is essential for disambiguating e.g. /home/user/file from the
 		# tool option /h with the value ome/user/file.
-		path=$a
+		path=$arg
 		;;
 	*)
+		return
 		;;
 	esac
-	if [ -n "$path" ] && [ -d "$(dirname "$path")" ] && [ "$(dirname "$path")" != "/" ]; then
-		opt=${a%$path}
-		a=${opt}z:$path
+	# The same as $(dirname "$path"), except for giving an empty string
+	# instead of the root directory.
+	dir=${path%"${path##*[!/]}"}
+	dir=${dir%/*}
+	dir=${dir%"${dir##*[!/]}"}
+	if [ -n "$dir" ] && [ -d "$dir" ]; then
+		arg=${arg%"$path"}z:$path
 	fi
-	ARGS+=("$a")
+}
+
+# Split a line of a response file into arguments the way the tools do,
+# appending them to rsp_args.
+splitQuoted() {
+	local line=$1 i c cur= bs= inarg= quoted=
+	for ((i = 0; i < ${#line}; i++)); do
+		c=${line:i:1}
+		case "$c" in
+		'\')
+			bs+='\'
+			;;
+		'"')
+			# 2n backslashes followed by a quote give n backslashes, and
+			# 2n+1 backslashes give n backslashes and a literal quote.
+			cur+=${bs:0:${#bs}/2}
+			if [ $((${#bs} % 2)) -eq 1 ]; then
+				cur+='"'
+			elif [ -n "$quoted" ]; then
+				quoted=
+			else
+				quoted=1
+			fi
+			bs=
+			inarg=1
+			;;
+		' '|$'\t')
+			cur+=$bs
+			if [ -n "$quoted" ]; then
+				cur+=$c
+			elif [ -n "$inarg$bs" ]; then
+				rsp_args+=("$cur")
+				cur=
+				inarg=
+			fi
+			bs=
+			;;
+		*)
+			cur+=$bs$c
+			bs=
+			inarg=1
+			;;
+		esac
+	done
+	if [ -n "$inarg$bs" ]; then
+		rsp_args+=("$cur$bs")
+	fi
+}
+
+# Quote an argument for a response file, setting quoted_arg.
+quoteArg() {
+	case "$1" in
+	''|*[\ $'\t'\"]*)
+		local i c bs=
+		quoted_arg='"'
+		for ((i = 0; i < ${#1}; i++)); do
+			c=${1:i:1}
+			case "$c" in
+			'\')
+				bs+='\'
+				continue
+				;;
+			'"')
+				quoted_arg+=$bs$bs'\"'
+				;;
+			*)
+				quoted_arg+=$bs$c
+				;;
+			esac
+			bs=
+		done
+		quoted_arg+=$bs$bs'"'
+		;;
+	*)
+		quoted_arg=$1
+		;;
+	esac
+}
+
+# Write a copy of the response file $1 with the paths in it rewritten like
+# for the arguments, setting rsp to its name. Fails if nothing needs to be
+# rewritten.
+rewriteRsp() {
+	local LC_ALL=C
+	local line a words bom= changed= first=1
+	rsp_args=()
+	while IFS= read -r line || [ -n "$line" ]; do
+		line=${line%$'\r'}
+		if [ -n "$first" ]; then
+			first=
+			case "$line" in
+			$'\xff\xfe'*|$'\xfe\xff'*)
+				# Leave UTF-16 files alone.
+				return 1
+				;;
+			$'\xef\xbb\xbf'*)
+				bom=$'\xef\xbb\xbf'
+				line=${line#$bom}
+				;;
+			esac
+		fi
+		case "$line" in
+		*\"*)
+			splitQuoted "$line"
+			;;
+		*)
+			set -f
+			words=($line)
+			set +f
+			rsp_args+=("${words[@]}")
+			;;
+		esac
+	done <"$1"
+
+	local lines=()
+	for a in "${rsp_args[@]}"; do
+		translate "$a"
+		[ "$arg" != "$a" ] && changed=1
+		quoteArg "$arg"
+		lines+=("$quoted_arg")
+	done
+	[ -n "$changed" ] || return 1
+
+	rsp=${TMPDIR:-/tmp}/wine-msvc.rsp.$$.${#TMPFILES[@]}
+	TMPFILES+=("$rsp")
+	{
+		printf '%s' "$bom"
+		printf '%s\n' "${lines[@]}"
+	} >"$rsp"
+}
+
+ARGS=()
+for a; do
+	case "$a" in
+	@*)
+		# Response files, as written by e.g. CMake and Ninja for long
+		# command lines, can contain absolute paths just the same.
+		if [ -f "${a#@}" ] && rewriteRsp "${a#@}"; then
+			ARGS+=("@z:$rsp")
+			continue
+		fi
+		;;
+	esac
+	translate "$a"
+	ARGS+=("$arg")
 done
 
 WINE=$(command -v wine64 || command -v wine || false)
@@ -65,28 +225,107 @@ if [ -n "$WINE_MSVC_RAW_STDOUT" ]; then
 	exit $?
 fi
 
-WINE_MSVC_STDOUT_SED='s/\r//;'"$WINE_MSVC_STDOUT_SED"
-WINE_MSVC_STDERR_SED='s/\r//;'"$WINE_MSVC_STDERR_SED"
+# msvctricks (and the msvctricks server) translates the output with
+# WINE_MSVC_STDOUT_RULES and WINE_MSVC_STDERR_RULES, which the wrappers set
+# as the equivalent of their WINE_MSVC_STDOUT_SED and WINE_MSVC_STDERR_SED.
+# For an output without rules, a sed expression still is applied with sed,
+# e.g. one set by the user for tools whose wrappers don't set one.
+STDOUT_SED=
+STDERR_SED=
+if [ -z "$WINE_MSVC_STDOUT_RULES" ]; then
+	STDOUT_SED=$WINE_MSVC_STDOUT_SED
+fi
+if [ -z "$WINE_MSVC_STDERR_RULES" ]; then
+	STDERR_SED=$WINE_MSVC_STDERR_SED
+fi
 
-if [ ! -f "$MSVCTRICKS_EXE" ]; then
-	"$WINE" "$EXE" "${ARGS[@]}" 2> >(sed -E "$WINE_MSVC_STDERR_SED" >&2) | sed -E "$WINE_MSVC_STDOUT_SED"
-	exit $PIPESTATUS
-else
-	export WINE_MSVC_STDOUT=${TMPDIR:-/tmp}/wine-msvc.stdout.$$
-	export WINE_MSVC_STDERR=${TMPDIR:-/tmp}/wine-msvc.stderr.$$
+# Copy stdin to stdout, applying the sed expression $1 if it is set.
+filter() {
+	if [ -n "$1" ]; then
+		sed -E "$1"
+	else
+		cat
+	fi
+}
+
+MSVCTRICKS_SERVER=${WINE_MSVC_SERVER:-${WINEPREFIX:-$HOME/.wine}/msvctricks-server}
+
+# Check that the process $1 is running, and is msvctricks, not another
+# process that got the pid of a server that died.
+server_alive() {
+	local pid=$1 args= a
+	kill -0 "$pid" 2>/dev/null || return 1
+	if [ -r "/proc/$pid/cmdline" ]; then
+		while IFS= read -r -d '' a; do
+			args+=" $a"
+		done <"/proc/$pid/cmdline"
+	else
+		args=$(ps -p "$pid" -o args= 2>/dev/null)
+	fi
+	[[ ${args,,} == *msvctricks* ]]
+}
+
+if [ -p "$MSVCTRICKS_SERVER/requests" ] && [ -f "$MSVCTRICKS_SERVER/pid" ] &&
+   pid=$(<"$MSVCTRICKS_SERVER/pid") && server_alive "$pid"; then
+	# Let the already running msvctricks server (see msvctricks-server) spawn
+	# the tool, instead of starting up a new Wine process for it.
+	req=$(mktemp -d "$MSVCTRICKS_SERVER/req.XXXXXX") || exit 1
+	TMPFILES+=("$req")
+	mkfifo "$req/stdout" "$req/stderr" "$req/status" || exit 1
 
-	cleanup() {
-		wait
-		rm -f $WINE_MSVC_STDOUT $WINE_MSVC_STDERR
-	}
+	exe=$EXE
+	case "$exe" in
+	/*)
+		exe=z:$exe
+		;;
+	esac
+	{
+		printf '%s\0' "z:$PWD" $((${#ARGS[@]} + 1)) "$exe" "${ARGS[@]}"
+		for name in $(compgen -e); do
+			printf '%s=%s\0' "$name" "${!name}"
+		done
+	} >"$req/request"
 
-	trap cleanup EXIT
+	filter "$STDOUT_SED" <"$req/stdout" &
+	out=$!
+	filter "$STDERR_SED" <"$req/stderr" >&2 &
+	err=$!
+	# If the server dies while the request is pending, open the fifos of
+	# the request (opening them for reading and writing doesn't block), so
+	# that the reads of them see the end of file instead of waiting forever.
+	(
+		while server_alive "$pid"; do
+			sleep 1
+		done
+		: 1<>"$req/stdout" 1<>"$req/stderr" 1<>"$req/status"
+	) </dev/null >/dev/null 2>&1 &
+	watchdog=$!
+	# Likewise, writing the request doesn't block if the server is gone.
+	echo "z:$req" 1<>"$MSVCTRICKS_SERVER/requests"
+	read -r ec <"$req/status"
+	kill $watchdog 2>/dev/null
+	wait $out $err
+	if [ -n "$ec" ]; then
+		exit $ec
+	fi
+	# The server died; run the tool directly, like without a server.
+	rm -f "$MSVCTRICKS_SERVER/pid"
+fi
 
-	cleanup && mkfifo $WINE_MSVC_STDOUT $WINE_MSVC_STDERR || exit 1
+if [ ! -f "$MSVCTRICKS_EXE" ]; then
+	WINE_MSVC_STDOUT_SED='s/\r//;'"$WINE_MSVC_STDOUT_SED"
+	WINE_MSVC_STDERR_SED='s/\r//;'"$WINE_MSVC_STDERR_SED"
 
-	"$WINE" "$MSVCTRICKS_EXE" "$EXE" "${ARGS[@]}" &>/dev/null &
-	pid=$!
-	sed -E "$WINE_MSVC_STDOUT_SED" <$WINE_MSVC_STDOUT     || kill $pid &>/dev/null &
-	sed -E "$WINE_MSVC_STDERR_SED" <$WINE_MSVC_STDERR >&2 || kill $pid &>/dev/null &
-	wait $pid &>/dev/null
+	"$WINE" "$EXE" "${ARGS[@]}" 2> >(sed -E "$WINE_MSVC_STDERR_SED" >&2) | sed -E "$WINE_MSVC_STDOUT_SED"
+	exit $PIPESTATUS
+elif [ -t 1 ] || [ -t 2 ] || [ -n "$STDOUT_SED$STDERR_SED" ]; then
+	# Wine sets up a console for a terminal, which would be slower and can
+	# add escape sequences to the output, so pass it through a pipe.
+	"$WINE" "$MSVCTRICKS_EXE" "$EXE" "${ARGS[@]}" </dev/null 2> >(filter "$STDERR_SED" >&2) | filter "$STDOUT_SED"
+	exit $PIPESTATUS
+else
+	# msvctricks writes the translated output directly to our stdout and
+	# stderr.
+	"$WINE" "$MSVCTRICKS_EXE" "$EXE" "${ARGS[@]}" </dev/null
+	exit $?
 fi